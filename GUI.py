@@ -1,8 +1,82 @@
 import sys
-from os import walk
-from main import analyze_song, compare_songs
+import ntpath
+import numpy as np
+from batch import list_songs
+from background import POLL_INTERVAL, analysis_job, library_job, library_ranking_job
+from ranking import LibraryCache
 from PyQt5 import uic
-from PyQt5.QtWidgets import QMainWindow, QFileDialog, QApplication, QTableWidgetItem
+from PyQt5.QtCore import Qt, QTimer, QAbstractTableModel, QVariant
+from PyQt5.QtWidgets import QMainWindow, QFileDialog, QApplication
+
+HEADERS = ["Song Name", "HC(%)", "T(st)", "THC(%)"]
+SORT_COLUMNS = [None, 'HC', 'T', 'THC']  # ranking column of each table column (None: folder order)
+
+class RankingModel(QAbstractTableModel):
+    """Table of the tracks of the folder and their ranking with respect to the target track.
+    The view only asks for the rows it displays, and sorting reorders the cached ranking."""
+
+    def __init__(self):
+        super().__init__()
+        self.songs = []
+        self.ranking = None
+        self.sort_column = None
+        self.descending = True
+        self.order = np.arange(0)
+
+    def rowCount(self, parent=None):
+        return len(self.songs)
+
+    def columnCount(self, parent=None):
+        return len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return HEADERS[section]
+        return QVariant()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return QVariant()
+        position = self.order[index.row()]
+        if self.ranking is None:
+            row = (self.songs[position], None, None, None)
+        else:
+            row = self.ranking.row(position)
+        if index.column() == 0:
+            return ntpath.basename(row[0]).replace(".mp3", "")
+        value = row[index.column()]
+        if value is None:
+            return ''
+        return str(value) if index.column() == 2 else str(round(value, 2))
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self.sort_column = SORT_COLUMNS[column]
+        self.descending = order == Qt.DescendingOrder
+        self._update_order()
+        self.layoutChanged.emit()
+
+    def _update_order(self):
+        if self.ranking is None:
+            self.order = np.arange(len(self.songs))
+        else:
+            self.order = self.ranking.order(self.sort_column, self.descending)
+
+    def set_songs(self, songs):
+        self.beginResetModel()
+        self.songs = songs
+        self.ranking = None
+        self._update_order()
+        self.endResetModel()
+
+    def set_ranking(self, ranking):
+        self.layoutAboutToBeChanged.emit()
+        self.ranking = ranking
+        self._update_order()
+        self.layoutChanged.emit()
+
+    def song_path(self, row):
+        return self.songs[self.order[row]]
 
 class programGUI(QMainWindow):
 
@@ -10,8 +84,14 @@ class programGUI(QMainWindow):
         super().__init__()
         uic.loadUi("GUI.ui", self)
         self.analyze_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
         self.music_button.clicked.connect(self.path_click)
         self.analyze_button.clicked.connect(self.analyze_click)
+        self.cancel_button.clicked.connect(self.cancel_click)
+        self.model = RankingModel()
+        self.tableWidget.setModel(self.model)
+        self.tableWidget.setSortingEnabled(True)
+        self.tableWidget.doubleClicked.connect(self.main_song_selected)
         self.label_print1.setText("Holu :)")
         self.tableWidget.setColumnWidth(0, 416)
         self.tableWidget.setColumnWidth(1, 60)
@@ -21,90 +101,126 @@ class programGUI(QMainWindow):
         # Global variables initialization
         self._path = []  # <---container
         self.current_song = ''
-        self.song_name_list = []
-        self.harmonic_compatibility_list = []
-        self.pitch_shift_list = []
-        self.min_small_scale_comp_list = []
+        self.target = None  # path of the target track
+        self.library = None  # in-memory TIVs of the folder and cached rankings
+        self.analysis = None  # background analysis job
+        self.ranking = None  # background ranking job
+        self.loading = None  # background library loading job
         self._path.append('')
 
+        # The messages of the background jobs are displayed from the GUI thread
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(POLL_INTERVAL)
+
     def path_click(self):
 
         folderpath = QFileDialog.getExistingDirectory(self, 'Select Folder')
         self._path[0] = (folderpath)
-        if self._path[0]!= []:
+        if self._path[0]!= '':
             self.analyze_button.setEnabled(True)
-        self.label_path_1.setText(folderpath[0:82])
-        self.label_path_2.setText(folderpath[82:])
+        self.label_path_1.setText(folderpath[0:70])
+        self.label_path_2.setText(folderpath[70:])
         print(folderpath)
-        for (dirpath, dirnames, filenames) in walk(folderpath):
-            number_songs = len(filenames)
-        self.tableWidget.setRowCount(number_songs)
+        self.cancel_ranking()
+        songs = list_songs(folderpath) if folderpath else []
+        self.library = LibraryCache(songs)
+        self.loading = library_job(self.library)
+        self.target = None
+        self.model.set_songs(songs)
 
-        folder_name = self._path[0]
         self.label_print1.setText('')
         self.label_print2.setText('')
-        # Compute harmonic compatibility
-        row=0
-        for (dirpath, dirnames, filenames) in walk(folder_name):
-            for file in filenames:
-                self.tableWidget.setItem(row, 0, QTableWidgetItem(file.replace(".mp3", "")))
-                self.tableWidget.setItem(row, 1, QTableWidgetItem(''))
-                self.tableWidget.setItem(row, 2, QTableWidgetItem(''))
-                self.tableWidget.setItem(row, 3, QTableWidgetItem(''))
-                row=row+1
-            break
         self.show()
         self.tableWidget.activateWindow()
-        self.tableWidget.doubleClicked.connect(self.main_song_selected)
         print(self._path[0])
 
     def main_song_selected(self, index):
         print(index.row())
-        folder_name = self._path[0]
-        row=0
-        for (dirpath, dirnames, filenames) in walk(folder_name):
-            for file in filenames:
-                if row == index.row():
-                    self.current_song = file.replace(".mp3", "")
-                row=row+1
-            break
+        current_song_path = self.model.song_path(index.row())
+        self.current_song = ntpath.basename(current_song_path).replace(".mp3", "")
 
         self.label_print1.setText('Now playing: ')
         self.label_print2.setText(self.current_song)
-        self.tableWidget.clearContents()
-
-        # Write song path
-        current_song_path = folder_name + '/' + self.current_song + ".mp3"
-        row=0
-        # Compute harmonic compatibility
-        for (dirpath, dirnames, filenames) in walk(folder_name):
-            for file in filenames:
-                candidate_song_path = dirpath + '/' + file
-                harmonic_compatibility, pitch_shift, min_small_scale_comp = compare_songs(current_song_path,
-                                                                                          candidate_song_path)
-
-                self.tableWidget.setItem(row, 0, QTableWidgetItem(file.replace(".mp3", "")))
-                self.tableWidget.setItem(row, 1, QTableWidgetItem(str(round(harmonic_compatibility, 2))))
-                self.tableWidget.setItem(row, 2, QTableWidgetItem(str(pitch_shift)))
-                self.tableWidget.setItem(row, 3, QTableWidgetItem(str(round(min_small_scale_comp, 2))))
-                row=row+1
-            break
-        self.show()
+
+        # The ranking is taken from the cache, or computed in the background (see poll)
+        self.cancel_ranking()
+        self.target = current_song_path
+        cached = self.library.cached(current_song_path)
+        if cached is not None:
+            self.model.set_ranking(cached)
+        elif self.loading is None:
+            self.start_ranking()
 
     def analyze_click(self):
+        if self.analysis is not None and self.analysis.is_running():
+            return
         self.label_print2.setText("Analyzing...")
-        folder_name = self._path[0]
-        i = 0
-        for (dirpath, dirnames, filenames) in walk(folder_name):
-            for file in filenames:
-                song_path = dirpath + '/' + file
-                analyze_song(song_path)
-                i = i + 1
-                self.label_print1.setText(str(round(i * 100 / len(filenames), 1)) + '% progress completed')
-                print(round(i * 100 / len(filenames), 1), '% progress completed')
-            break
-        self.label_print2.setText("Analysis completed")
-        print("Analysis completed")
+        self.analysis = analysis_job(self._path[0], self.library)
+        self.cancel_button.setEnabled(True)
+
+    def cancel_click(self):
+        self.cancel_ranking()
+        if self.analysis is not None and self.analysis.is_running():
+            self.analysis.cancel()
+            self.label_print2.setText("Cancelling...")
+
+    def start_ranking(self):
+        self.ranking = library_ranking_job(self.library, self.target)
+        self.cancel_button.setEnabled(True)
+
+    def cancel_ranking(self):
+        if self.ranking is not None:
+            self.ranking.cancel()
+            self.ranking = None
+
+    def poll(self):
+        if self.analysis is not None:
+            analyzed = False
+            for kind, payload in self.analysis.poll():
+                if kind == 'progress':
+                    done, total, song_path, error = payload
+                    analyzed = analyzed or error is None
+                    self.label_print1.setText(str(round(done * 100 / total, 1)) + '% progress completed')
+                    print(round(done * 100 / total, 1), '% progress completed')
+                elif kind == 'done':
+                    self.label_print2.setText("Analysis completed")
+                    print("Analysis completed")
+                elif kind == 'cancelled':
+                    self.label_print2.setText("Analysis cancelled")
+                    print("Analysis cancelled")
+                elif kind == 'error':
+                    self.label_print2.setText("Analysis failed")
+                    print("Analysis failed:", payload)
+            if analyzed and self.target is not None and self.loading is None and \
+                    self.library.is_analyzed(self.target):
+                # The tracks analyzed since the last poll are in the library: the cached ranking
+                # of the target track was updated with them
+                self.cancel_ranking()
+                self.start_ranking()
+            if not self.analysis.is_running() and self.analysis.messages.empty():
+                self.analysis = None
+
+        if self.loading is not None:
+            for kind, payload in self.loading.poll():
+                if kind == 'error':
+                    print("Loading failed:", payload)
+            if not self.loading.is_running() and self.loading.messages.empty():
+                self.loading = None
+                if self.target is not None:
+                    self.start_ranking()
+
+        if self.ranking is not None:
+            for kind, payload in self.ranking.poll():
+                if kind == 'done' and payload.current_song_path == self.target:
+                    self.model.set_ranking(payload)
+                elif kind == 'error':
+                    self.label_print1.setText("You need to analyze first")
+                    print("Ranking failed:", payload)
+            if not self.ranking.is_running() and self.ranking.messages.empty():
+                self.ranking = None
+
+        self.cancel_button.setEnabled(self.analysis is not None or self.ranking is not None)
 
 
 if __name__ == '__main__':
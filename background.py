@@ -0,0 +1,121 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module runs the analysis of a music folder and the ranking of its
+tracks in the background, so that the graphical interfaces stay
+responsive. The analysis is handed to the process pool of batch.py. The
+TIVs of the folder are read into an in-memory library, and the ranking
+is computed at once from it (see ranking.py). Each track is read into
+the library as soon as it is analyzed, so the interfaces can rank it
+while the rest of the folder is being analyzed.
+
+Each job runs in its own thread and sends its results through a queue.
+Tk and Qt widgets can only be used from the thread that created them,
+so the interfaces poll the queue from a timer. Messages are
+(kind, payload) tuples:
+    ('progress', (done, total, song_path, error)) -- a track was analyzed (and read
+                                                    into the library of the job)
+    ('done', result), ('cancelled', None) or ('error', message) -- last message
+
+An analysis job can be cancelled at any time: it stops at the next track.
+A cancelled loading or ranking job finishes, and its result is ignored."""
+
+import queue
+import threading
+from batch import analyze_folder
+
+POLL_INTERVAL = 100  # milliseconds between two polls of the queue by the interfaces
+
+
+class BackgroundJob:
+    """
+    Runs a function in a background thread. The function is called as
+    target(job, *args, **kwargs) and sends its messages with job.send.
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(target, args, kwargs), daemon=True)
+        self._thread.start()
+
+    def _run(self, target, args, kwargs):
+        try:
+            result = target(self, *args, **kwargs)
+        except Exception as error:
+            self.send('error', repr(error))
+        else:
+            self.send('cancelled' if self.cancelled.is_set() else 'done', result)
+
+    def send(self, kind, payload=None):
+        self.messages.put((kind, payload))
+
+    def cancel(self):
+        """Asks the job to stop. The job sends a 'cancelled' message when it stops"""
+        self.cancelled.set()
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def poll(self):
+        """
+        Takes the messages sent since the last poll, without blocking
+
+        :return: List of (kind, payload) tuples
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+
+def _analysis(job, folder_path, library, **options):
+    def progress(done, total, song_path, error):
+        if library is not None and error is None:
+            library.load([song_path])
+        job.send('progress', (done, total, song_path, error))
+
+    return analyze_folder(folder_path, progress=progress, cancel=job.cancelled, **options)
+
+
+def analysis_job(folder_path, library=None, **options):
+    """
+    Analyzes a music folder in the background (see batch.analyze_folder)
+
+    :param folder_path: Path of the music folder
+    :param library: ranking.LibraryCache instance into which each track is read once it is analyzed
+            (see ranking.LibraryCache.load). Default: None
+    :param options: Keyword arguments of batch.analyze_folder (workers, preset...)
+    :return: BackgroundJob sending a 'progress' message per track, once the track is in the library.
+            Its result is the dictionary with the error message of every track whose analysis failed.
+    """
+
+    return BackgroundJob(_analysis, folder_path, library, **options)
+
+
+def library_job(library, song_paths=None):
+    """
+    Reads in the background the TIVs of a music folder (see ranking.LibraryCache.load)
+
+    :param library: ranking.LibraryCache instance
+    :param song_paths: List with the paths of the tracks to read. Default: all the tracks.
+    :return: BackgroundJob whose result is the number of analyzed tracks read
+    """
+
+    return BackgroundJob(lambda job: library.load(song_paths))
+
+
+def library_ranking_job(library, current_song_path):
+    """
+    Ranks in the background the tracks of an in-memory library (see ranking.LibraryCache.ranking)
+
+    :param library: ranking.LibraryCache instance
+    :param current_song_path: The path of the target track
+    :return: BackgroundJob whose result is the ranking.Ranking of the target track
+    """
+
+    return BackgroundJob(lambda job: library.ranking(current_song_path))
@@ -0,0 +1,220 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module analyzes all the audio tracks of a music folder in
+parallel, using a pool of processes. Tracks that already have an
+annotation are skipped, so an interrupted batch can simply be re-run."""
+
+import argparse
+import contextlib
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from main import PRESETS, analyze_song, get_analysis, get_annotation_path, is_analyzed
+from segments import analyze_segments, has_segments
+from cache import scan_folders
+
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS']
+CANCEL_INTERVAL = 0.2  # seconds between checks of the cancel event
+
+
+def list_songs(folder_path):
+    """Lists the audio tracks (.mp3) of a music folder
+
+    :param folder_path: Path of the music folder
+    :return: Sorted list with the paths of the tracks
+    """
+
+    return sorted(folder_path + '/' + file for file in os.listdir(folder_path)
+                  if file.endswith('.mp3'))
+
+
+def pending_songs(song_paths, analysis=None, segments=False):
+    """Selects the tracks that have not been analyzed yet
+
+    :param song_paths: List with the paths of the tracks
+    :param analysis: Dictionary with the analysis parameters. Default: reference analysis.
+    :param segments: If True, tracks without a segment analysis (see segments.py) are also selected
+    :return: List with the paths of the tracks without an annotation computed with that analysis
+    """
+
+    analysis = analysis if analysis is not None else get_analysis()
+    return [song_path for song_path in song_paths if not is_analyzed(song_path, analysis)
+            or (segments and not has_segments(song_path, analysis))]
+
+
+@contextlib.contextmanager
+def thread_limits(blas_threads):
+    """Sets the number of BLAS/OpenMP threads in the environment that the worker processes inherit.
+    The libraries read it when they are loaded, which happens in the workers when main is imported,
+    before _init_worker runs. The environment of this process is restored on exit.
+
+    :param blas_threads: Number of BLAS/OpenMP threads of each worker
+    """
+
+    saved = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update({variable: str(blas_threads) for variable in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def _init_worker(blas_threads, fft_threads):
+    """Limits the number of threads used by each worker process (see thread_limits, which sets
+    them when the libraries are loaded; threadpoolctl also limits them afterwards, if installed)"""
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=blas_threads)
+    except ImportError:
+        pass
+
+    if fft_threads > 1:
+        import librosa
+        import scipy.fft
+        librosa.set_fftlib(scipy.fft)
+
+
+def _analyze(song_path, streaming, spectral, preset, segments, windows=None):
+    if segments:
+        # The segment analysis also computes the TIV of the song, from the same decoded and separated audio
+        analyze_segments(song_path, spectral, preset)
+    else:
+        analyze_song(song_path, streaming, spectral, preset, windows)
+
+
+def _analyze_worker(song_path, fft_threads, streaming, spectral, preset, segments, windows=None):
+    """Analyzes a track in a worker process
+
+    :return: The path of the track and None, or the error message if the analysis failed
+    """
+
+    try:
+        if fft_threads > 1:
+            import scipy.fft
+            with scipy.fft.set_workers(fft_threads):
+                _analyze(song_path, streaming, spectral, preset, segments, windows)
+        else:
+            _analyze(song_path, streaming, spectral, preset, segments, windows)
+    except Exception as error:
+        return song_path, repr(error)
+    return song_path, None
+
+
+def analyze_songs(song_paths, workers=None, blas_threads=1, fft_threads=1, progress=None, streaming=False,
+                  spectral=False, preset='reference', segments=False, cancel=None, windows=None):
+    """
+    Analyzes a list of tracks in parallel. Tracks that already have an
+    annotation are skipped.
+
+    :param song_paths: List with the paths of the tracks
+    :param workers: Number of worker processes. Default: number of CPUs
+    :param blas_threads: Number of BLAS/OpenMP threads of each worker
+    :param fft_threads: Number of FFT threads of each worker
+    :param progress: Optional function called as progress(done, total, song_path, error)
+            every time a track is finished
+    :param streaming: If True, tracks are analyzed block by block (bounded memory per worker)
+    :param spectral: If True, the chroma is computed with the spectral fast path
+    :param preset: Name of the analysis preset (see main.PRESETS)
+    :param segments: If True, the intro and outro of the tracks are also analyzed (see segments.py)
+    :param cancel: Optional threading.Event. Once it is set, the tracks that are not being analyzed yet
+            are skipped. The tracks being analyzed are finished, so no annotation is left half-written.
+    :param windows: If given, tracks are analyzed from this number of windows decoded by seeking
+            (see sampling.py). It can not be combined with segments.
+    :return: Dictionary with the error message of every track whose analysis failed
+    """
+
+    if segments and windows is not None:
+        raise ValueError("The segments and the sampled analysis can not be combined")
+    # The segment analysis does not stream (see _analyze)
+    streaming = streaming and not segments
+    songs = pending_songs(song_paths, get_analysis(preset, spectral, windows, streaming), segments)
+    for song_path in songs:
+        os.makedirs(os.path.dirname(get_annotation_path(song_path)), exist_ok=True)
+    if not songs:
+        return {}
+
+    workers = min(workers or os.cpu_count(), len(songs))
+    errors = {}
+    # Spawned workers start with a fresh interpreter, so the thread limits apply to every library
+    with thread_limits(blas_threads), \
+            ProcessPoolExecutor(max_workers=workers,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker,
+                                initargs=(blas_threads, fft_threads)) as executor:
+        def submit(song_paths):
+            return {executor.submit(_analyze_worker, song_path, fft_threads, streaming, spectral, preset, segments,
+                                    windows)
+                    for song_path in song_paths}
+
+        # Tracks are submitted as the workers become free, so that a cancelled batch stops
+        # as soon as the tracks being analyzed are finished
+        queued = iter(songs)
+        pending = submit(itertools.islice(queued, workers))
+        done = 0
+        while pending:
+            finished, pending = wait(pending, CANCEL_INTERVAL if cancel is not None else None, FIRST_COMPLETED)
+            for future in finished:
+                song_path, error = future.result()
+                done += 1
+                if error is not None:
+                    errors[song_path] = error
+                if progress is not None:
+                    progress(done, len(songs), song_path, error)
+            if cancel is None or not cancel.is_set():
+                pending |= submit(itertools.islice(queued, len(finished)))
+    return errors
+
+
+def analyze_folder(folder_path, workers=None, blas_threads=1, fft_threads=1, progress=None, streaming=False,
+                   spectral=False, preset='reference', segments=False, cancel=None, windows=None):
+    """
+    Analyzes in parallel the tracks of a music folder that have not been analyzed yet.
+    The annotations of renamed tracks are reused (see cache.scan_folders).
+
+    :param folder_path: Path of the music folder
+    :param workers, blas_threads, fft_threads, progress, streaming, spectral, preset, segments, cancel, windows:
+            As in analyze_songs
+    :return: Dictionary with the error message of every track whose analysis failed
+    """
+
+    scan_folders([folder_path], get_analysis(preset, spectral, windows, streaming and not segments))
+    return analyze_songs(list_songs(folder_path), workers, blas_threads, fft_threads, progress, streaming,
+                         spectral, preset, segments, cancel, windows)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Analyze the tracks of music folders in parallel")
+    parser.add_argument('folders', nargs='+', help="music folders")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--blas-threads', type=int, default=1, help="BLAS threads per worker")
+    parser.add_argument('--fft-threads', type=int, default=1, help="FFT threads per worker")
+    parser.add_argument('--streaming', action='store_true', help="analyze long tracks with bounded memory")
+    parser.add_argument('--spectral', action='store_true', help="use the spectral fast path")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    parser.add_argument('--segments', action='store_true', help="also analyze the intro and outro of the tracks")
+    parser.add_argument('--windows', type=int, default=None,
+                        help="analyze this number of windows spread across each track, decoding only them")
+    args = parser.parse_args()
+
+    def print_progress(done, total, song_path, error):
+        status = 'failed: ' + error if error is not None else 'done'
+        print(round(done * 100 / total, 1), '% progress completed -', os.path.basename(song_path), status)
+
+    # Annotations follow the tracks that were renamed or moved between the folders
+    scan_folders(args.folders, get_analysis(args.preset, args.spectral, args.windows,
+                                            args.streaming and not args.segments))
+    song_paths = [song_path for folder in args.folders for song_path in list_songs(folder)]
+    errors = analyze_songs(song_paths, args.workers, args.blas_threads, args.fft_threads, print_progress,
+                           args.streaming, args.spectral, args.preset, args.segments, windows=args.windows)
+    print("Analysis completed" if not errors else "Analysis completed, %d tracks failed" % len(errors))
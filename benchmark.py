@@ -0,0 +1,244 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module measures where the analysis of a track spends its time.
+Every stage of analyze_song (decoding, cutting the song, source
+separation, NNLS chroma and TIV) is timed separately, reporting its
+wall time, CPU time and peak resident memory.
+
+The suite runs on the audio files of the "miscellaneous" folder and on
+synthetic chord progressions. The results can be saved as a JSON
+baseline and compared with the results of a later run:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from scipy.io import wavfile
+from harmonic_mix.tivlib import TIV
+from main import PRESETS, get_analysis, get_analysis_label, decode_file, decompose_harmonic, audio_to_nnls
+
+MISCELLANEOUS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'miscellaneous')
+STAGES = ['decode', 'slice', 'decompose_harmonic', 'audio_to_nnls', 'from_pcp']
+RSS_INTERVAL = 0.005  # seconds between memory samples
+CHORD_DURATION = 2.0  # seconds of each chord of the synthetic progressions
+# Synthetic progressions: name -> list of chords (MIDI notes)
+PROGRESSIONS = {
+    'synthetic C major I-IV-V-I': [[60, 64, 67], [65, 69, 72], [67, 71, 74], [60, 64, 67]],
+    'synthetic A minor i-iv-v-i': [[57, 60, 64], [62, 65, 69], [64, 67, 71], [57, 60, 64]],
+}
+
+
+def _current_rss():
+    """Resident memory of the process, in bytes (None if it can not be read)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class StageTimer:
+    """Context manager that measures the wall time, the CPU time and the peak
+    resident memory of a block of code. The memory is sampled by a thread every
+    RSS_INTERVAL seconds; where it can not be sampled, the peak of the process is used."""
+
+    def __init__(self):
+        self.wall = self.cpu = None
+        self.peak_rss = self.start_rss = None
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.wait(RSS_INTERVAL):
+            rss = _current_rss()
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def __enter__(self):
+        self.start_rss = _current_rss()
+        self.peak_rss = self.start_rss
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self._done.set()
+        self._sampler.join()
+        rss = _current_rss()
+        if rss is None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.peak_rss = max_rss if sys.platform == 'darwin' else max_rss * 1024
+        else:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        return False
+
+    def result(self):
+        return {'wall': self.wall, 'cpu': self.cpu, 'peak_rss': self.peak_rss,
+                'rss_increase': None if self.start_rss is None else self.peak_rss - self.start_rss}
+
+
+def synthetic_chords(path, chords, sample_rate=44100, chord_duration=CHORD_DURATION):
+    """Writes a chord progression (sawtooth-like tones with 8 harmonics) as a .wav file
+
+    :param path: Path of the .wav file
+    :param chords: List of chords, each one a list of MIDI notes
+    :param sample_rate: Sample rate of the file
+    :param chord_duration: Duration of each chord, in seconds
+    """
+
+    t = np.arange(int(chord_duration * sample_rate)) / sample_rate
+    envelope = np.minimum(1, np.minimum(t, chord_duration - t) / 0.02)  # 20 ms fades
+    audio = []
+    for chord in chords:
+        signal = np.zeros_like(t)
+        for note in chord:
+            frequency = 440 * 2 ** ((note - 69) / 12)
+            for harmonic in range(1, 9):
+                if harmonic * frequency < sample_rate / 2:
+                    signal += np.sin(2 * np.pi * harmonic * frequency * t) / harmonic
+        audio.append(signal * envelope)
+    audio = np.concatenate(audio)
+    wavfile.write(path, sample_rate, (0.5 * audio / np.max(np.abs(audio)) * 32767).astype(np.int16))
+
+
+def benchmark_file(song_path, analysis):
+    """
+    Runs the stages of the analysis of a track, measuring each one
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters (see main.get_analysis)
+    :return: Dictionary with the measures of each stage (wall and CPU time in seconds,
+            peak resident memory and its increase during the stage in bytes)
+    """
+
+    measures = {}
+    with StageTimer() as timer:
+        # Decoded without the feature cache, so that every run is measured cold
+        song_audio = decode_file(song_path, analysis['sample_rate'])
+    measures['decode'] = timer.result()
+
+    with StageTimer() as timer:
+        kept = analysis['song_kept'] / 2
+        song_audio = song_audio[int(song_audio.size / 2 - song_audio.size * kept):int(
+            song_audio.size / 2 + song_audio.size * kept)]
+    measures['slice'] = timer.result()
+
+    with StageTimer() as timer:
+        harmonic = decompose_harmonic(song_audio, analysis['n_fft'], analysis['hop_length'],
+                                      analysis['kernel_size'])
+    measures['decompose_harmonic'] = timer.result()
+
+    with StageTimer() as timer:
+        chroma = audio_to_nnls(harmonic, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+    measures['audio_to_nnls'] = timer.result()
+
+    with StageTimer() as timer:
+        TIV.from_pcp(chroma)
+    measures['from_pcp'] = timer.result()
+
+    measures['duration'] = song_audio.size / analysis['sample_rate'] / analysis['song_kept']
+    return measures
+
+
+def run_suite(song_paths=None, preset='reference', repeat=1, synthetic=True):
+    """
+    Runs the benchmark suite
+
+    :param song_paths: List with the paths of the tracks. Default: the files of the "miscellaneous" folder
+    :param preset: Name of the analysis preset (see main.PRESETS)
+    :param repeat: Number of runs of each track. The fastest times and the highest memory are kept.
+    :param synthetic: If True, the synthetic chord progressions are also analyzed
+    :return: Dictionary with the machine, the analysis and the measures of each track
+    """
+
+    analysis = get_analysis(preset)
+    if song_paths is None:
+        song_paths = sorted(os.path.join(MISCELLANEOUS_FOLDER, file) for file in os.listdir(MISCELLANEOUS_FOLDER)
+                            if file.endswith(('.mp3', '.wav')))
+    tracks = [(os.path.basename(song_path), song_path) for song_path in song_paths]
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        if synthetic:
+            for name, chords in PROGRESSIONS.items():
+                path = os.path.join(temp_folder, name + '.wav')
+                synthetic_chords(path, chords)
+                tracks.append((name, path))
+
+        results = {}
+        for name, song_path in tracks:
+            runs = [benchmark_file(song_path, analysis) for _ in range(repeat)]
+            results[name] = {stage: {'wall': min(run[stage]['wall'] for run in runs),
+                                     'cpu': min(run[stage]['cpu'] for run in runs),
+                                     'peak_rss': max(run[stage]['peak_rss'] for run in runs),
+                                     'rss_increase': max(run[stage]['rss_increase'] or 0 for run in runs)}
+                             for stage in STAGES}
+            results[name]['duration'] = runs[0]['duration']
+
+    return {'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                        'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+                        'numpy': np.__version__},
+            'analysis': analysis, 'repeat': repeat, 'tracks': results}
+
+
+def print_results(results, baseline=None):
+    """
+    Prints the measures of each stage, and their ratio to a baseline
+
+    :param results: Dictionary returned by run_suite
+    :param baseline: Optional dictionary returned by an earlier run_suite
+    """
+
+    for name, stages in results['tracks'].items():
+        print("%s (%.1f s)" % (name, stages['duration']))
+        for stage in STAGES:
+            measure = stages[stage]
+            line = "  %-20s wall %8.3f s  cpu %8.3f s  peak RSS %7.1f MB (+%.1f MB)" % (
+                stage, measure['wall'], measure['cpu'], measure['peak_rss'] / 2 ** 20,
+                measure['rss_increase'] / 2 ** 20)
+            reference = (baseline or {}).get('tracks', {}).get(name, {}).get(stage)
+            if reference is not None and reference['wall'] > 0:
+                line += "  %5.2fx wall vs baseline" % (measure['wall'] / reference['wall'])
+            print(line)
+        total = sum(stages[stage]['wall'] for stage in STAGES)
+        print("  %-20s wall %8.3f s" % ('total', total))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the analysis")
+    parser.add_argument('songs', nargs='*', help="audio tracks. Default: the files of the miscellaneous folder")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each track")
+    parser.add_argument('--no-synthetic', action='store_true', help="skip the synthetic chord progressions")
+    parser.add_argument('--save', help="save the results as a JSON baseline")
+    parser.add_argument('--compare', help="compare with a JSON baseline")
+    args = parser.parse_args()
+
+    results = run_suite(args.songs or None, args.preset, args.repeat, not args.no_synthetic)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('analysis') != results['analysis']:
+            print("Warning: the baseline was run with the %s analysis" % get_analysis_label(baseline['analysis']))
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
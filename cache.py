@@ -0,0 +1,218 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module ties every annotation to the content of the audio file it
+was computed from, so that the analysis of a track is reused when the
+file is renamed or moved, and redone when the file is replaced.
+
+The annotation stores a hash of the audio file, together with its size
+and modification time: the file is only hashed again when they change.
+An annotation is valid for a track when its content hash and its
+analysis parameters (see main.get_analysis) match, so annotations are
+found by content hash and analysis fingerprint.
+
+scan_folders looks for the annotations whose audio file disappeared
+(renamed or moved tracks) and moves them next to the file with the same
+content, so that only new or changed content is analyzed again."""
+
+import argparse
+import hashlib
+import json
+import ntpath
+import os
+import instrumentation
+from main import PRESETS, annotation_analysis, get_analysis, get_annotation_path, read_annotation, write_annotation
+
+HASH_BLOCK_SIZE = 2 ** 20  # bytes read at once when hashing a file
+
+
+def content_hash(song_path):
+    """Hashes the content of an audio file
+
+    :param song_path: The path of the track
+    :return: Hexadecimal BLAKE2b digest (32 characters) of the file bytes
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    with instrumentation.span('io', 'content_hash', path=song_path) as event:
+        with open(song_path, 'rb') as song_file:
+            for block in iter(lambda: song_file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+                event.add_bytes(len(block))
+    return digest.hexdigest()
+
+
+def analysis_fingerprint(analysis):
+    """Short fingerprint of the analysis parameters
+
+    :param analysis: Dictionary with the analysis parameters (see main.get_analysis)
+    :return: Hexadecimal digest (16 characters)
+    """
+
+    return hashlib.blake2b(json.dumps(analysis, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def _file_stat(song_path):
+    stat = os.stat(song_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def content_fields(song_path, song_hash=None):
+    """Returns the annotation field with the content hash, size and modification time of a track
+
+    :param song_path: The path of the track
+    :param song_hash: Content hash of the track, if it is already known
+    :return: Dictionary with the field (see main.write_annotation)
+    """
+
+    size, mtime_ns = _file_stat(song_path)
+    return {"content": {"hash": song_hash or content_hash(song_path), "size": size, "mtime_ns": mtime_ns}}
+
+
+def record_content(song_path, song_hash=None):
+    """Saves the content hash of a track in its annotation
+
+    :param song_path: The path of the track
+    :param song_hash: Content hash of the track, if it is already known
+    """
+
+    write_annotation(get_annotation_path(song_path), content_fields(song_path, song_hash))
+
+
+def content_matches(song_path, annotation):
+    """Checks that an annotation was computed from the current content of a track.
+    The track is only hashed if its size or modification time changed.
+
+    :param song_path: The path of the track
+    :param annotation: Dictionary with the content of the annotation of the track
+    :return: True if the content hash matches, or if the annotation has no content hash
+            (annotations written before the hash was stored)
+    """
+
+    content = annotation.get('content')
+    if content is None:
+        return True
+    size, mtime_ns = _file_stat(song_path)
+    if content.get('size') == size and content.get('mtime_ns') == mtime_ns:
+        return True
+    if content.get('hash') != content_hash(song_path):
+        return False
+    record_content(song_path, content['hash'])  # touched but not modified
+    return True
+
+
+def _analyzed_with(annotation, analysis):
+    """Checks that an annotation has a TIV computed with the given analysis parameters (see main.load_annotation)"""
+
+    return 'TIV.energy.real' in annotation and annotation_analysis(annotation) == analysis
+
+
+def _orphan_annotations(folders):
+    """Annotations whose audio file is no longer in the folder, by content hash, with the fingerprint of
+    their analysis"""
+
+    orphans = {}
+    for folder in folders:
+        annotations_folder = folder + '/annotations/'
+        if not os.path.isdir(annotations_folder):
+            continue
+        for file in sorted(os.listdir(annotations_folder)):
+            if not file.endswith('.json') or os.path.isfile(folder + '/' + file[:-len('.json')] + '.mp3'):
+                continue
+            annotation = read_annotation(annotations_folder + file)
+            if 'content' in annotation:
+                fingerprint = analysis_fingerprint(annotation_analysis(annotation))
+                orphans.setdefault(annotation['content']['hash'], []).append((fingerprint, annotations_folder + file))
+    return orphans
+
+
+def _take_orphan(orphans, song_hash, fingerprint):
+    """Takes the orphan annotation of a content hash, preferring the one computed with the given analysis"""
+
+    candidates = orphans.get(song_hash)
+    if not candidates:
+        return None
+    matching = [i for i, (orphan_fingerprint, _) in enumerate(candidates) if orphan_fingerprint == fingerprint]
+    position = matching[0] if matching else 0
+    return candidates.pop(position)[1]
+
+
+def scan_folders(folders, analysis=None):
+    """
+    Scans music folders, reusing the annotations of renamed or moved tracks
+
+    :param folders: List of music folders
+    :param analysis: Dictionary with the analysis parameters. Default: reference analysis.
+    :return: Dictionary with the lists of tracks that are 'current' (valid annotation), 'moved'
+            (annotation taken from a renamed or moved track) and 'pending' (to be analyzed)
+    """
+
+    analysis = analysis if analysis is not None else get_analysis()
+    orphans = _orphan_annotations(folders)
+    fingerprint = analysis_fingerprint(analysis)
+    result = {'current': [], 'moved': [], 'pending': []}
+
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            if not file.endswith('.mp3'):
+                continue
+            song_path = folder + '/' + file
+            annotation_path = get_annotation_path(song_path)
+            annotation = read_annotation(annotation_path)
+
+            content = annotation.get('content')
+            analyzed = _analyzed_with(annotation, analysis)
+            if content is None and analyzed:
+                # Annotation written before the content hash was stored
+                record_content(song_path)
+                result['current'].append(song_path)
+                continue
+
+            song_hash = None
+            if content is not None:
+                unchanged = (content.get('size'), content.get('mtime_ns')) == _file_stat(song_path)
+                if not unchanged:
+                    song_hash = content_hash(song_path)
+                    unchanged = song_hash == content.get('hash')
+                    if unchanged:
+                        record_content(song_path, song_hash)  # touched but not modified
+                if unchanged:
+                    result['current' if analyzed else 'pending'].append(song_path)
+                    continue
+
+            if not any(orphans.values()):
+                # No annotation left to reuse: new tracks are not read before they are analyzed
+                result['pending'].append(song_path)
+                continue
+            song_hash = song_hash or content_hash(song_path)
+            orphan_path = _take_orphan(orphans, song_hash, fingerprint)
+            if orphan_path is None:
+                result['pending'].append(song_path)
+                continue
+
+            # Renamed or moved track: its annotation follows it, keeping the fields of the
+            # existing annotation (e.g. the intro and outro times) that it does not have
+            os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+            write_annotation(annotation_path, read_annotation(orphan_path))
+            os.remove(orphan_path)
+            record_content(song_path, song_hash)
+            moved = _analyzed_with(read_annotation(annotation_path), analysis)
+            result['moved' if moved else 'pending'].append(song_path)
+            print(ntpath.basename(orphan_path).replace(".json", "") + ' moved to ' + file.replace(".mp3", ""))
+
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Reuse the annotations of renamed or moved tracks")
+    parser.add_argument('folders', nargs='+', help="music folders")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    parser.add_argument('--spectral', action='store_true', help="spectral fast path analysis")
+    args = parser.parse_args()
+
+    result = scan_folders(args.folders, get_analysis(args.preset, args.spectral))
+    print("%d tracks up to date, %d moved, %d to analyze" % (
+        len(result['current']), len(result['moved']), len(result['pending'])))
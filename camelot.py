@@ -0,0 +1,138 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module estimates the key of the tracks of a music library and
+indexes them by their Camelot code (the codes used in the file names of
+the dataset, e.g. "11A"), so that the tracks in a given set of codes
+are found with a lookup instead of a scan of the library.
+
+Camelot codes number the keys along the circle of fifths: "B" codes are
+major keys (8B = C major) and "A" codes are minor keys (8A = A minor).
+Neighbouring codes (same number, or one step away with the same letter)
+are the usual harmonic mixing choices."""
+
+import numpy as np
+from harmonic_mix.tivlib import estimate_keys
+
+# Camelot code of each key, in TIV.key_labels order (C ... B major, then c ... b minor)
+CAMELOT_CODES = ['%dB' % ((7 * pitch + 7) % 12 + 1) for pitch in range(12)] + \
+                ['%dA' % ((7 * (pitch + 3) + 7) % 12 + 1) for pitch in range(12)]
+
+
+def camelot_code(key_index):
+    """Returns the Camelot code of a key
+
+    :param key_index: Index of the key in TIV.key_labels (as returned by tivlib.estimate_keys)
+    :return: Camelot code, e.g. '8B' for C major
+    """
+
+    return CAMELOT_CODES[int(key_index)]
+
+
+def tiv_camelot_code(tiv, mode='temperley'):
+    """Estimates the key of a TIV and returns its Camelot code
+
+    :param tiv: TIV instance
+    :param mode: Key profiles ('temperley' or 'shaath')
+    :return: Camelot code of the estimated key
+    """
+
+    return camelot_code(estimate_keys(tiv.vector, mode))
+
+
+def camelot_neighbours(code):
+    """Returns the Camelot codes that mix harmonically with a given one
+
+    :param code: Camelot code, e.g. '7A'
+    :return: List with the code itself, the codes one step away on the wheel and the
+            relative major/minor code, e.g. ['7A', '8A', '6A', '7B']
+    """
+
+    number, letter = int(code[:-1]), code[-1].upper()
+    if not 1 <= number <= 12 or letter not in 'AB':
+        raise ValueError("Invalid Camelot code: " + str(code))
+    return ['%d%s' % (number, letter), '%d%s' % (number % 12 + 1, letter),
+            '%d%s' % ((number - 2) % 12 + 1, letter), '%d%s' % (number, 'B' if letter == 'A' else 'A')]
+
+
+class CamelotIndex:
+    """
+    Index of the tracks of a music library by the Camelot code of their estimated key
+    """
+
+    def __init__(self, track_ids, key_indices):
+        """
+        Builds the index
+
+        :param track_ids: List of track ids
+        :param key_indices: Index of the key of each track in TIV.key_labels (see tivlib.estimate_keys)
+        """
+        self.track_ids = list(track_ids)
+        self.positions = {track_id: position for position, track_id in enumerate(self.track_ids)}
+        self.key_indices = np.asarray(key_indices, dtype=np.uint8)
+        if len(self.track_ids) != len(self.key_indices):
+            raise ValueError("There must be one key per track id")
+
+        order = np.argsort(self.key_indices, kind='stable')
+        bounds = np.searchsorted(self.key_indices[order], np.arange(25))
+        self.rows = {CAMELOT_CODES[key]: order[bounds[key]:bounds[key + 1]] for key in range(24)}
+
+    @classmethod
+    def from_tivs(cls, track_ids, tivs, mode='temperley'):
+        """
+        Estimates the keys of a list of TIVs and indexes them
+
+        :param track_ids: List of track ids
+        :param tivs: A list of TIV objects, a TIVCollection or an array of TIV vectors (Nx6)
+        :param mode: Key profiles ('temperley' or 'shaath')
+        :return: CamelotIndex object
+        """
+        from compatibility import library_vectors
+        return cls(track_ids, estimate_keys(library_vectors(tivs), mode))
+
+    @classmethod
+    def from_library(cls, library):
+        """
+        Indexes the tracks of a TIVLibrary, with the keys stored next to its TIVs
+
+        :param library: library.TIVLibrary instance
+        :return: CamelotIndex object
+        """
+        return cls(library.track_ids, library.keys)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def code(self, track_id):
+        """Camelot code of the estimated key of a track"""
+        return CAMELOT_CODES[self.key_indices[self.positions[track_id]]]
+
+    def codes(self):
+        """Camelot code of every track, in track order"""
+        return [CAMELOT_CODES[key] for key in self.key_indices]
+
+    def lookup(self, codes):
+        """
+        Finds the tracks whose key has one of the given Camelot codes
+
+        :param codes: A Camelot code or a list of them, e.g. ['7A', '8A', '6A', '7B']
+        :return: List of track ids, grouped by code in the given order
+        """
+        if isinstance(codes, str):
+            codes = [codes]
+        return [self.track_ids[row] for code in codes for row in self.rows[code.upper()]]
+
+    def compatible(self, code):
+        """
+        Finds the tracks in the Camelot codes that mix harmonically with a given one
+
+        :param code: Camelot code, e.g. '7A'
+        :return: List of track ids (see camelot_neighbours)
+        """
+        return self.lookup(camelot_neighbours(code))
+
+    def counts(self):
+        """Number of tracks of each Camelot code"""
+        return {code: len(rows) for code, rows in self.rows.items()}
@@ -0,0 +1,216 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module computes the NNLS chroma with NumPy only, as an
+alternative to the essentia frontend of audio_to_nnls (Windowing,
+Spectrum and LogSpectrum called once per frame, then NNLSChroma).
+
+The audio is framed with a strided view (see spectral.frame_audio), and
+the windows and FFTs of all the frames are computed in a few batched
+calls. The magnitude spectra are mapped to the log-frequency bins of
+LogSpectrum (one third of a semitone, 7 octaves from A0) with a sparse
+matrix that is built once per sample rate and frame size, following the
+construction of LogSpectrum (cosine kernels on an oversampled frequency
+axis). The tuning, the whitening and the semitone and chroma mapping of
+NNLSChroma (useNNLS=False, global tuning) are then applied to all the
+frames at once.
+
+The chroma matches the essentia output up to float32 rounding, so the
+two frontends give the same TIVs within a small tolerance. The NumPy
+frontend is used when essentia is not installed, or when the
+HARMONIC_MIX_CHROMA_FRONTEND environment variable is set to "numpy"
+(see main.CHROMA_FRONTEND).
+
+Running this module prints how far the chroma of the two frontends
+differ on a few tracks."""
+
+import argparse
+import functools
+import numpy as np
+import scipy.fft
+import scipy.sparse
+
+BINS_PER_SEMITONE = 3
+N_NOTES = 256  # 7 octaves of log-frequency bins, plus some overlap at the bottom and top
+OVERSAMPLING = 80  # points of the oversampled frequency axis per FFT bin
+MIN_MIDI = 20  # one semitone below A0
+MAX_MIDI = 105
+FFT_CHUNK = 256  # frames transformed at once
+WHITENING = 1.0  # spectral whitening of NNLSChroma
+TUNING_BINS = 160  # log-frequency bins whose energy estimates the tuning
+
+
+def _cosine_pulse(x, centre, width):
+    return np.where(np.abs(x - centre) <= 0.5 * width, np.cos((x - centre) * 2 * np.pi / width) * .5 + .5, 0.0)
+
+
+@functools.lru_cache(maxsize=8)
+def logfreq_matrix(sample_rate, frame_size):
+    """Builds the matrix that maps a magnitude spectrum to the log-frequency bins of LogSpectrum
+
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames (the spectra have frame_size/2+1 bins)
+    :return: Sparse matrix (N_NOTES x frame_size/2). Bin frame_size/2 of the spectra is not used.
+    """
+
+    n_bins = frame_size // 2
+    bin_width = np.float32(sample_rate / frame_size)
+    fft_width = np.float32(sample_rate * 2.0 / frame_size)
+    fft_frequencies = (np.arange(n_bins) * bin_width).astype(np.float32)
+    note_frequencies = np.append(
+        440 * 2.0 ** (0.083333333333 * (np.arange(MIN_MIDI, MAX_MIDI, 1 / BINS_PER_SEMITONE) - 69)),
+        440 * 2.0 ** (0.083333 * (MAX_MIDI - 69))).astype(np.float32)[:N_NOTES]
+
+    # Pairs of (note, FFT bin) whose kernels can overlap
+    notes, bins = np.nonzero((note_frequencies[:, None] * 2 ** 0.084 + fft_width > fft_frequencies) &
+                             (note_frequencies[:, None] * 2 ** (-0.084 * 2) - fft_width < fft_frequencies))
+    keep = bins > 0
+    notes, bins = notes[keep], bins[keep]
+
+    # Oversampled frequencies within one FFT bin of each bin, and the FFT bin kernel on them
+    offsets = np.arange(2 * OVERSAMPLING)
+    fft_kernel = _cosine_pulse((offsets * (bin_width / OVERSAMPLING)).astype(np.float32), fft_frequencies[1],
+                               fft_width)
+    frequencies = (((bins[:, None] - 1) * OVERSAMPLING + offsets) * (bin_width / OVERSAMPLING)).astype(np.float32)
+
+    # Note kernel: cosine pulse on the log-frequency axis, scaled for the density of the notes
+    bins_per_octave = BINS_PER_SEMITONE * 12
+    with np.errstate(divide='ignore'):
+        warped = -bins_per_octave * (np.log2(note_frequencies[notes, None]) - np.log2(frequencies))
+        note_kernel = np.where(frequencies > 0, _cosine_pulse(warped, 0.0, 2.0) /
+                               (np.log(2.0) / bins_per_octave * frequencies), 0.0)
+    values = note_kernel @ fft_kernel
+    keep = values > 0
+    return scipy.sparse.csr_matrix((values[keep], (notes[keep], bins[keep])), shape=(N_NOTES, n_bins))
+
+
+def log_spectrogram(spectrogram, sample_rate):
+    """Maps magnitude spectra to log-frequency bins, as LogSpectrum does frame by frame
+
+    :param spectrogram: Magnitude spectrogram (number of frames x frame_size/2+1)
+    :param sample_rate: Sample rate of the audio
+    :return: Log-frequency spectrogram (number of frames x N_NOTES), and the mean tuning
+            (BINS_PER_SEMITONE values, the last meanTuning output of LogSpectrum)
+    """
+
+    frame_size = (spectrogram.shape[1] - 1) * 2
+    matrix = logfreq_matrix(sample_rate, frame_size)
+    # Frames with a very low magnitude are left at zero. Only the bins read by the matrix are converted.
+    loud = spectrogram[:, :frame_size // 2].max(axis=1, initial=0) >= 2
+    used = matrix.indices.max() + 1 if matrix.nnz else 0
+    magnitude = np.minimum(np.asarray(spectrogram[:, :used], dtype=np.float64), frame_size) * loud[:, None]
+    logfreq = np.asarray(matrix[:, :used].dot(magnitude.T).T)
+    tuning_bins = logfreq[:, :TUNING_BINS + BINS_PER_SEMITONE - 1]
+    mean_tuning = np.array([tuning_bins[:, shift::BINS_PER_SEMITONE][:, :TUNING_BINS // BINS_PER_SEMITONE + 1]
+                            .sum(axis=1).mean() if len(logfreq) else 0.0 for shift in range(BINS_PER_SEMITONE)])
+    return logfreq, mean_tuning
+
+
+def _running_mean(spectrogram, window):
+    """Moving average of each frame, with the edge values repeated at both ends (as NNLSChroma)"""
+
+    half = len(window) // 2
+    smoothed = np.empty_like(spectrogram)
+    smoothed[:, half:-half] = np.lib.stride_tricks.sliding_window_view(spectrogram, len(window), axis=1) @ window
+    smoothed[:, :half] = smoothed[:, half:half + 1]
+    smoothed[:, -half:] = smoothed[:, -half - 1:-half]
+    return smoothed
+
+
+def nnls_chromagram(logfreq, mean_tuning):
+    """Computes the chroma of log-frequency spectra, as NNLSChroma(useNNLS=False) does
+
+    :param logfreq: Log-frequency spectrogram (number of frames x N_NOTES), see log_spectrogram
+    :param mean_tuning: Mean tuning, see log_spectrogram
+    :return: Chromagram (number of frames x 12), each chroma starting in A (as NNLSChroma)
+    """
+
+    # Global tuning, applied by linear interpolation between the log-frequency bins
+    phases = 2 * np.pi * np.arange(BINS_PER_SEMITONE) / BINS_PER_SEMITONE
+    tuning = np.arctan2(np.sum(mean_tuning * np.sin(phases)), np.sum(mean_tuning * np.cos(phases))) / (2 * np.pi)
+    shift = int(np.floor(tuning * BINS_PER_SEMITONE))
+    fraction = tuning * BINS_PER_SEMITONE - shift
+    notes = np.arange(2, N_NOTES - 3)
+    tuned = np.zeros_like(logfreq)
+    tuned[:, notes] = logfreq[:, notes + shift] * (1 - fraction) + logfreq[:, notes + shift + 1] * fraction
+
+    # Whitening: distance to the running mean, divided by the running standard deviation
+    length = BINS_PER_SEMITONE * 6 + 1
+    window = 0.54 - 0.46 * np.cos(2 * np.pi * np.arange(length) / (length - 1))
+    window = window / window.sum()
+    mean = _running_mean(tuned, window)
+    deviation = np.sqrt(_running_mean((tuned - mean) ** 2, window))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        whitened = np.where(deviation > 0, np.maximum(tuned - mean, 0) / deviation ** WHITENING, tuned)
+
+    # Semitone spectrum (triangular weights over the bins of each semitone), then treble chroma
+    centres = np.arange(BINS_PER_SEMITONE // 2 + 2, N_NOTES - BINS_PER_SEMITONE // 2, BINS_PER_SEMITONE)
+    semitones = whitened[:, centres - 1] * 0.5 + whitened[:, centres] + whitened[:, centres + 1] * 0.5
+    treble_window = np.sin(np.pi * (np.arange(len(centres)) + 0.5) / len(centres)) ** 2
+    weighted = semitones * treble_window
+    return weighted.reshape(len(weighted), -1, 12).sum(axis=1)
+
+
+def spectrogram_to_chromagram(spectrogram, sample_rate):
+    """Computes the NNLS chroma of each frame of a magnitude spectrogram
+
+    :param spectrogram: Magnitude spectrogram (number of frames x frame_size/2+1)
+    :param sample_rate: Sample rate of the audio
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
+    """
+
+    logfreq, mean_tuning = log_spectrogram(spectrogram, sample_rate)
+    #Rotate the chroma so that it starts in C
+    return np.roll(nnls_chromagram(logfreq, mean_tuning), -3, axis=1)
+
+
+def audio_to_chromagram(audio, sample_rate, frame_size, hop_size):
+    """Computes the NNLS chroma of each frame of the audio, with the framing of
+    FrameGenerator(startFromZero=True) and a Hann window
+
+    :param audio: Audio sample arrangement
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames (frame i starts at sample i*hop_size)
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
+    """
+
+    from spectral import frame_audio
+    frames = frame_audio(np.asarray(audio, dtype=np.float32), frame_size, hop_size)
+    # Same window as essentia's Windowing(type='hann', normalized=False)
+    window = np.hanning(frame_size).astype(np.float32)
+    spectrogram = np.empty((len(frames), frame_size // 2 + 1), dtype=np.float32)
+    for start in range(0, len(frames), FFT_CHUNK):
+        spectrogram[start:start + FFT_CHUNK] = np.abs(scipy.fft.rfft(frames[start:start + FFT_CHUNK] * window, axis=1))
+    return spectrogram_to_chromagram(spectrogram, sample_rate)
+
+
+def drift_report(song_paths, preset='reference'):
+    """Prints how far the chroma of the NumPy frontend is from the essentia chroma
+
+    :param song_paths: List with the paths of the tracks
+    :param preset: Name of the analysis preset (see main.PRESETS)
+    """
+
+    import main
+    analysis = main.get_analysis(preset)
+    for song_path in song_paths:
+        harmonic = main.harmonic_part(song_path, analysis)
+        arguments = (harmonic, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+        reference = main.essentia_chromagram(*arguments)
+        chromagram = audio_to_chromagram(*arguments)
+        scale = np.abs(reference).max() or 1
+        print("%s: largest difference %.2e (relative to the largest chroma value), mean chroma difference %.2e" % (
+            song_path, np.abs(chromagram - reference).max() / scale,
+            np.abs(chromagram.mean(axis=0) - reference.mean(axis=0)).max() / scale))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the NumPy and essentia chroma frontends")
+    parser.add_argument('songs', nargs='+', help="audio tracks")
+    parser.add_argument('--preset', default='reference', help="analysis preset")
+    args = parser.parse_args()
+    drift_report(args.songs, args.preset)
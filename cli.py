@@ -0,0 +1,289 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""Command-line tool to analyze and rank music libraries without the
+graphical interfaces, with machine-readable output.
+
+Subcommands:
+    analyze -- analyzes tracks in parallel (see batch.py)
+    rank    -- the k candidates most compatible with a target track (see search.py)
+    matrix  -- harmonic compatibility of every pair of tracks (see compatibility.py)
+    key     -- estimated key and Camelot code of every track (see camelot.py)
+
+Tracks are given as music folders, .mp3 files or glob patterns (quoted
+so that the shell does not expand them). rank, matrix and key read the
+TIVs from the annotations of the tracks, or from a TIV library file
+(see library.py) with --library.
+
+Results are written to the standard output or to --output, as CSV
+(default), JSON lines, or NumPy arrays (.npz, one array per column;
+matrix writes the full matrices):
+
+    python cli.py analyze music/techno --workers 8 --preset fast
+    python cli.py rank music/techno/track.mp3 music/techno -k 20 --max-shift 2 --format jsonl
+    python cli.py matrix music/techno --format npz --output techno_matrix.npz
+    python cli.py key "music/*/*.mp3"
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import numpy as np
+from harmonic_mix.tivlib import TIV, estimate_keys
+from main import PRESETS, get_analysis, get_annotation_path, load_annotation
+
+FORMATS = ['csv', 'jsonl', 'npz']
+
+
+class RowWriter:
+    """
+    Writes rows of results as CSV or JSON lines (one row at a time, so results can be
+    consumed while they are produced), or as .npz arrays (one array per field, written on close)
+    """
+
+    def __init__(self, fields, output_format='csv', output=None):
+        """
+        :param fields: List with the names of the fields of the rows
+        :param output_format: 'csv', 'jsonl' or 'npz'
+        :param output: Path of the output file, or an open text file. Default: standard output
+                (not allowed for 'npz')
+        """
+        if output_format not in FORMATS:
+            raise ValueError("Unknown output format: " + str(output_format))
+        if output_format == 'npz' and (output is None or hasattr(output, 'write')):
+            raise ValueError("The npz format needs an output file")
+        self.fields = fields
+        self.output_format = output_format
+        self.output = output
+        self.columns = {field: [] for field in fields}
+        self._owned = output_format != 'npz' and isinstance(output, str)
+        if output_format != 'npz':
+            self.file = open(output, 'w', newline='', encoding='utf-8') if self._owned else output or sys.stdout
+        if output_format == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(fields)
+
+    def write(self, *values):
+        if self.output_format == 'csv':
+            self.csv.writerow(values)
+        elif self.output_format == 'jsonl':
+            self.file.write(json.dumps(dict(zip(self.fields, values))) + '\n')
+        else:
+            for field, value in zip(self.fields, values):
+                self.columns[field].append(value)
+            return
+        self.file.flush()
+
+    def close(self):
+        if self.output_format == 'npz':
+            np.savez(self.output, **{field: np.array(column) for field, column in self.columns.items()})
+        elif self._owned:
+            self.file.close()
+
+
+def expand_songs(inputs):
+    """
+    Lists the audio tracks given as music folders, .mp3 files or glob patterns
+
+    :param inputs: List of folders, files or patterns
+    :return: List with the paths of the tracks, without repetitions, in the given order
+    """
+
+    from batch import list_songs
+    song_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            song_paths.extend(list_songs(item.rstrip('/')))
+        elif os.path.isfile(item):
+            song_paths.append(item)
+        else:
+            song_paths.extend(sorted(path for path in glob.glob(item) if path.endswith('.mp3')))
+    return list(dict.fromkeys(song_paths))
+
+
+def load_tracks(inputs, library_path=None):
+    """
+    Reads the TIVs of the analyzed tracks. Tracks without annotation are skipped, with a warning.
+
+    :param inputs: List of folders, files or patterns (see expand_songs)
+    :param library_path: Path of a TIV library file, read instead of the annotations
+    :return: List of track ids (the song paths, or the ids of the library), TIV vectors (Nx6), energies (N),
+            and a function that checks if some analysis parameters are the ones of the TIVs
+            (see TIVLibrary.matches; always True if no track was read)
+    """
+
+    if library_path is not None:
+        from library import TIVLibrary
+        library = TIVLibrary(library_path)
+        return list(library.track_ids), np.array(library.vectors), np.array(library.energies), library.matches
+
+    track_ids, vectors, energies = [], [], []
+    analysis = None
+    for song_path in expand_songs(inputs):
+        try:
+            tiv, song_analysis = load_annotation(get_annotation_path(song_path))
+        except (IOError, KeyError, TypeError, ValueError):
+            print("Skipping %s: not analyzed" % song_path, file=sys.stderr)
+            continue
+        if analysis is not None and song_analysis != analysis:
+            raise ValueError("%s was analyzed with different analysis parameters" % song_path)
+        analysis = song_analysis
+        track_ids.append(song_path)
+        vectors.append(tiv.vector)
+        energies.append(tiv.energy)
+    return track_ids, np.array(vectors, dtype=np.complex128).reshape(-1, 6), np.array(energies), \
+        lambda other_analysis: analysis is None or other_analysis == analysis
+
+
+def analyze_command(args):
+    from batch import analyze_songs
+    from cache import scan_folders
+
+    song_paths = expand_songs(args.inputs)
+    output = args.output
+    if output is None and args.format != 'npz':
+        # The analysis prints its progress (also from the worker processes, which inherit the standard
+        # output): it is sent to the standard error, and the standard output is kept for the results
+        sys.stdout.flush()
+        output = os.fdopen(os.dup(sys.stdout.fileno()), 'w', newline='')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    writer = RowWriter(['track', 'done', 'total', 'error'], args.format, output)
+
+    def write_progress(done, total, song_path, error):
+        writer.write(song_path, done, total, error)
+
+    # Annotations follow the tracks that were renamed or moved between the folders
+    scan_folders(sorted({os.path.dirname(song_path) or '.' for song_path in song_paths}),
+                 get_analysis(args.preset, args.spectral, args.windows, args.streaming and not args.segments))
+    errors = analyze_songs(song_paths, args.workers, args.blas_threads, args.fft_threads, write_progress,
+                           args.streaming, args.spectral, args.preset, args.segments, windows=args.windows)
+    writer.close()
+    return 1 if errors else 0
+
+
+def rank_command(args):
+    from search import CompatibilityIndex
+
+    track_ids, vectors, energies, matches = load_tracks(args.inputs, args.library)
+    index = CompatibilityIndex(track_ids, vectors, energies)
+    if args.target in index.positions:
+        query = args.target
+    else:
+        query, query_analysis = load_annotation(get_annotation_path(args.target))
+        if not matches(query_analysis):
+            raise ValueError("%s was analyzed with other parameters than the ranked tracks" % args.target)
+
+    writer = RowWriter(['rank', 'target', 'candidate', 'harmonic_compatibility', 'pitch_shift'],
+                       args.format, args.output)
+    for rank, (track_id, harmonic_compatibility, pitch_shift) in enumerate(
+            index.top_k(query, args.k, args.max_shift), 1):
+        writer.write(rank, args.target, track_id, harmonic_compatibility, pitch_shift)
+    writer.close()
+    return 0
+
+
+def matrix_command(args):
+    from compatibility import BLOCK_SIZE, compatibility_matrices
+
+    track_ids, vectors, _, _ = load_tracks(args.inputs, args.library)
+    if args.format == 'npz':
+        if args.output is None:
+            raise ValueError("The npz format needs an output file")
+        harmonic_compatibility, pitch_shift, min_small_scale_comp = compatibility_matrices(vectors)
+        np.savez(args.output, track_ids=np.array(track_ids), harmonic_compatibility=harmonic_compatibility,
+                 pitch_shift=pitch_shift, min_small_scale_comp=min_small_scale_comp)
+        return 0
+
+    writer = RowWriter(['target', 'candidate', 'harmonic_compatibility', 'pitch_shift',
+                        'transposed_harmonic_compatibility'], args.format, args.output)
+    # Pairs are computed and written one block of targets at a time, with bounded memory
+    for start in range(0, len(track_ids), BLOCK_SIZE):
+        harmonic_compatibility, pitch_shift, min_small_scale_comp = \
+            compatibility_matrices(vectors[start:start + BLOCK_SIZE], vectors)
+        for row, target in enumerate(track_ids[start:start + BLOCK_SIZE]):
+            for column, candidate in enumerate(track_ids):
+                if column != start + row:
+                    writer.write(target, candidate, float(harmonic_compatibility[row, column]),
+                                 int(pitch_shift[row, column]), float(min_small_scale_comp[row, column]))
+    writer.close()
+    return 0
+
+
+def key_command(args):
+    from camelot import CAMELOT_CODES
+
+    track_ids, vectors, _, _ = load_tracks(args.inputs, args.library)
+    keys = np.atleast_1d(estimate_keys(vectors, args.profiles)) if len(track_ids) else []
+    writer = RowWriter(['track', 'key', 'mode', 'camelot'], args.format, args.output)
+    for track_id, key in zip(track_ids, keys):
+        writer.write(track_id, TIV.key_labels[key], 'min' if key >= 12 else 'maj', CAMELOT_CODES[key])
+    writer.close()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Analyze and rank music libraries from the command line")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_output(subparser):
+        subparser.add_argument('--format', default='csv', choices=FORMATS, help="output format")
+        subparser.add_argument('--output', default=None, help="output file. Default: standard output")
+
+    def add_tracks(subparser):
+        subparser.add_argument('inputs', nargs='*', help="music folders, .mp3 files or glob patterns")
+        subparser.add_argument('--library', default=None, help="TIV library file, read instead of the annotations")
+
+    analyze = subparsers.add_parser('analyze', help="analyze tracks in parallel")
+    analyze.add_argument('inputs', nargs='+', help="music folders, .mp3 files or glob patterns")
+    analyze.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    analyze.add_argument('--blas-threads', type=int, default=1, help="BLAS threads per worker")
+    analyze.add_argument('--fft-threads', type=int, default=1, help="FFT threads per worker")
+    analyze.add_argument('--streaming', action='store_true', help="analyze long tracks with bounded memory")
+    analyze.add_argument('--spectral', action='store_true', help="use the spectral fast path")
+    analyze.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    analyze.add_argument('--segments', action='store_true', help="also analyze the intro and outro of the tracks")
+    analyze.add_argument('--windows', type=int, default=None,
+                         help="analyze this number of windows spread across each track, decoding only them")
+    add_output(analyze)
+    analyze.set_defaults(function=analyze_command)
+
+    rank = subparsers.add_parser('rank', help="top-k candidates for a target track")
+    rank.add_argument('target', help="target track (its path, or its id in the library)")
+    add_tracks(rank)
+    rank.add_argument('-k', type=int, default=10, help="number of candidates")
+    rank.add_argument('--max-shift', type=int, default=0, help="largest pitch shift of the candidates, in semitones")
+    add_output(rank)
+    rank.set_defaults(function=rank_command)
+
+    matrix = subparsers.add_parser('matrix', help="harmonic compatibility of every pair of tracks")
+    add_tracks(matrix)
+    add_output(matrix)
+    matrix.set_defaults(function=matrix_command)
+
+    key = subparsers.add_parser('key', help="estimated key and Camelot code of every track")
+    add_tracks(key)
+    key.add_argument('--profiles', default='temperley', choices=['temperley', 'shaath'], help="key profiles")
+    add_output(key)
+    key.set_defaults(function=key_command)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command != 'analyze' and not args.inputs and args.library is None:
+        parser.error("give the tracks (folders, files or patterns) or a --library file")
+    try:
+        return args.function(args)
+    except (IOError, ValueError) as error:
+        print("Error: %s" % error, file=sys.stderr)
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module computes the harmonic compatibility between every pair
+of tracks of a music library, in all 12 pitch transpositions, with a
+single vectorized pass instead of one compare_songs call per pair."""
+
+import numpy as np
+import instrumentation
+from harmonic_mix.tivlib import TIV, TIVCollection, TRANSPOSITIONS, transpose_vectors
+from main import get_annotation_path, load_annotation, scale
+from segments import load_region
+
+BLOCK_SIZE = 1024  # rows of the target library scored at once (bounds memory)
+
+
+def library_vectors(tivs):
+    """Stacks the TIV vectors of a library into a single complex array
+
+    :param tivs: A list of TIV objects, a TIVCollection or an array of TIV vectors (Nx6)
+    :return: Complex array (Nx6) with one TIV vector per track
+    """
+
+    if isinstance(tivs, TIVCollection):
+        return np.asarray(tivs.vectors).reshape(-1, 6)
+    if len(tivs) > 0 and isinstance(tivs[0], TIV):
+        return np.array([tiv.vector for tiv in tivs], dtype=np.complex128)
+    return np.asarray(tivs, dtype=np.complex128).reshape(-1, 6)
+
+
+def _real_form(vectors):
+    """Splits complex TIV vectors (Nx6) into their real form (Nx12)"""
+    return np.concatenate((vectors.real, vectors.imag), axis=1)
+
+
+def _small_scale_comp(current_block, candidate_transpose, energy_sum, weights_norm):
+    """Small scale compatibility between real form TIV vectors (BxM), from their inner products"""
+    cross = 2 * (current_block @ candidate_transpose.T)
+    relatedness = np.sqrt(np.maximum(energy_sum - cross, 0)) / (2 * weights_norm)
+    dissonance = 1 - np.sqrt(np.maximum(energy_sum + cross, 0)) / (2 * weights_norm)
+    return dissonance * relatedness
+
+
+def transposition_matrices(current_vectors, candidate_vectors=None):
+    """
+    Computes the harmonic compatibility between each pair of tracks (target, candidate)
+    with the candidate transposed by each of the 12 pitch transpositions
+
+    :param current_vectors: TIV vectors of the target tracks (Nx6), or anything accepted by library_vectors
+    :param candidate_vectors: TIV vectors of the candidate tracks (Mx6). Default: the target tracks.
+    :return: Harmonic compatibility array (12xNxM); element [k, i, j] is the compatibility of
+            target i with candidate j transposed by k semitones.
+    """
+
+    current = library_vectors(current_vectors)
+    candidate = current if candidate_vectors is None else library_vectors(candidate_vectors)
+
+    weights_norm = np.linalg.norm(TIV.weights)
+    energy_sum = np.sum(np.abs(current) ** 2, axis=1)[:, np.newaxis] + np.sum(np.abs(candidate) ** 2, axis=1)
+    current_real = _real_form(current)
+    small_scale_comp = np.array([_small_scale_comp(current_real, _real_form(candidate * rotation),
+                                                   energy_sum, weights_norm) for rotation in TRANSPOSITIONS])
+    return scale(100 * (1 - small_scale_comp))
+
+
+def compatibility_matrices(current_vectors, candidate_vectors=None, transpose_candidate=0,
+                           block_size=BLOCK_SIZE):
+    """
+    Computes the harmonic compatibility between each pair of tracks
+    (target, candidate) and the pitch transposition that maximizes it.
+    Gives the same values as calling compare_songs for every pair.
+
+    :param current_vectors: TIV vectors of the target tracks (Nx6), or anything accepted by library_vectors
+    :param candidate_vectors: TIV vectors of the candidate tracks (Mx6). Default: the target tracks.
+    :param transpose_candidate: An interval (in positive or negative semitones) with which the
+            pitch transposition of the candidate tracks will be simulated. Default zero.
+    :param block_size: Number of target tracks scored at once.
+    :return: The harmonic compatibility matrix (NxM), all tracks in their original versions.
+            The suggested pitch transposition interval matrix (NxM, in semitones).
+            The resulting harmonic compatibility matrix (NxM) if the suggested pitch transposition were applied.
+    """
+
+    current = library_vectors(current_vectors)
+    candidate = current if candidate_vectors is None else library_vectors(candidate_vectors)
+
+    candidate = transpose_vectors(candidate, transpose_candidate)
+    candidate_transposes = [_real_form(candidate * rotation) for rotation in TRANSPOSITIONS]
+
+    weights_norm = np.linalg.norm(TIV.weights)
+    current_energy = np.sum(np.abs(current) ** 2, axis=1)
+    candidate_energy = np.sum(np.abs(candidate) ** 2, axis=1)
+
+    n, m = current.shape[0], candidate.shape[0]
+    harmonic_compatibility = np.empty((n, m))
+    pitch_shift = np.empty((n, m), dtype=np.int8)
+    min_small_scale_comp = np.empty((n, m))
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        current_block = _real_form(current[start:stop])
+        energy_sum = current_energy[start:stop, np.newaxis] + candidate_energy[np.newaxis, :]
+
+        best = None
+        best_shift = np.zeros((stop - start, m), dtype=np.int8)
+        for shift, candidate_transpose in enumerate(candidate_transposes):
+            small_scale_comp = _small_scale_comp(current_block, candidate_transpose, energy_sum, weights_norm)
+            if best is None:
+                harmonic_compatibility[start:stop] = small_scale_comp
+                best = small_scale_comp
+            else:
+                improved = small_scale_comp < best
+                best = np.where(improved, small_scale_comp, best)
+                best_shift[improved] = shift
+
+        min_small_scale_comp[start:stop] = best
+        pitch_shift[start:stop] = np.where(best_shift > 5, best_shift - 12, best_shift)
+
+    harmonic_compatibility = scale(100 * (1 - harmonic_compatibility))
+    min_small_scale_comp = scale(100 * (1 - min_small_scale_comp))
+    return harmonic_compatibility, pitch_shift, min_small_scale_comp
+
+
+def compare_song_to_library(current_song_path, candidate_song_paths, transpose_candidate=0, mix_points=False):
+    """
+    Computes harmonic compatibility between a target song and a list of
+    candidate songs (paths), reading every annotation only once.
+
+    :param current_song_path: The path of the target track
+    :param candidate_song_paths: List with the paths of the candidate tracks
+    :param transpose_candidate: An interval (in positive or negative semitones) with which the
+            pitch transposition of the candidate tracks will be simulated. Default zero.
+    :param mix_points: If True, the outro of the target track is compared with the intro of each
+            candidate track (see segments.py). Default: whole tracks.
+    :return: Three arrays, one value per candidate, with the same meaning as the values returned by compare_songs.
+    """
+
+    with instrumentation.span('comparison', 'compare_song_to_library', path=current_song_path,
+                              tracks=len(candidate_song_paths)):
+        if mix_points:
+            current, analysis = load_region(current_song_path, 'outro')
+        else:
+            current, analysis = load_annotation(get_annotation_path(current_song_path))
+        candidates = []
+        for song_path in candidate_song_paths:
+            if mix_points:
+                candidate, candidate_analysis = load_region(song_path, 'intro')
+            else:
+                candidate, candidate_analysis = load_annotation(get_annotation_path(song_path))
+            if candidate_analysis != analysis:
+                raise ValueError("%s was analyzed with different analysis parameters" % song_path)
+            candidates.append(candidate)
+
+        harmonic_compatibility, pitch_shift, min_small_scale_comp = \
+            compatibility_matrices([current], candidates, transpose_candidate)
+        return harmonic_compatibility[0], pitch_shift[0], min_small_scale_comp[0]
@@ -0,0 +1,298 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module runs a local query server that keeps the TIVs of a music
+library in memory, so that rankings, keys and comparisons are answered
+without reading annotations or importing the analysis libraries again.
+
+The server listens on a Unix socket (or on a localhost TCP port) and
+speaks JSON lines: each request is a JSON object on one line, and each
+response is a JSON object on one line, in the same order. Clients can
+keep their connection open and send many requests (see daemon_client.py,
+which does not import the analysis libraries). Requests carry an "op"
+field, and an optional "id" that is copied to the response:
+
+    {"op": "ping"}
+    {"op": "rank", "target": <track id>, "k": 10, "max_shift": 0}
+    {"op": "key", "track": <track id>}
+    {"op": "compare", "current": <track id>, "candidate": <track id>, "transpose": 0}
+    {"op": "add", "tracks": [<track id>, ...]}
+
+Responses are {"id": ..., "ok": true, "result": ...} or
+{"id": ..., "ok": false, "error": <message>}. Track ids are the song
+paths, or the ids of the TIV library file the server was started with.
+"add" tells the server that tracks were analyzed (or analyzed again):
+their TIVs are read and the in-memory library is updated in place.
+
+For web frontends, the server can also answer HTTP on a localhost port
+(--http): a POST to any path with a JSON request as body, or a GET with
+the fields of the request as query parameters (e.g. /?op=rank&target=...
+&k=10, repeating "tracks" for "add"). The response body is the JSON
+response, with status 200, or 400 if the request failed. Each HTTP
+connection answers one request.
+
+    python daemon.py serve music/techno music/progressive_house --socket /tmp/harmonic_mix.sock --http 8765
+    python daemon_client.py '{"op": "key", "track": "music/techno/Weska - EQ64 (Original Mix) - 7A - 128.mp3"}'
+    curl 'http://127.0.0.1:8765/?op=ping'
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from harmonic_mix.tivlib import TIV, estimate_keys
+from camelot import CAMELOT_CODES
+from cli import load_tracks
+from compatibility import compatibility_matrices
+from main import get_annotation_path, load_annotation
+from search import CompatibilityIndex
+from daemon_client import DEFAULT_SOCKET, Client
+
+REQUEST_LIMIT = 2 ** 20  # longest request line, in bytes
+
+
+class QueryServer:
+    """
+    In-memory TIV library answering rank, key and compare queries
+    """
+
+    def __init__(self, track_ids, vectors, energies=None, analysis=None, library_path=None):
+        """
+        :param track_ids: List of track ids
+        :param vectors: TIV vectors of the tracks (Nx6)
+        :param energies: Energies of the TIVs (N)
+        :param analysis: Analysis parameters of the TIVs. Added tracks must come from the same analysis.
+        :param library_path: Path of the TIV library file of the tracks, if they were not read from annotations
+        """
+        self.index = CompatibilityIndex(track_ids, vectors, energies)
+        self.keys = np.atleast_1d(estimate_keys(self.index.vectors)).astype(np.uint8) if len(self.index) \
+            else np.zeros(0, dtype=np.uint8)
+        self.analysis = analysis
+        self.library_path = library_path
+
+    @classmethod
+    def from_tracks(cls, inputs, library_path=None):
+        """
+        Loads the TIVs of a music library (see cli.load_tracks)
+
+        :param inputs: List of music folders, .mp3 files or glob patterns
+        :param library_path: Path of a TIV library file, read instead of the annotations
+        :return: QueryServer object
+        """
+        track_ids, vectors, energies, _ = load_tracks(inputs, library_path)
+        analysis = None
+        if library_path is None and track_ids:
+            analysis = load_annotation(get_annotation_path(track_ids[0]))[1]
+        return cls(track_ids, vectors, energies, analysis, library_path)
+
+    def _position(self, track_id):
+        if track_id not in self.index.positions:
+            raise KeyError("Unknown track: " + str(track_id))
+        return self.index.positions[track_id]
+
+    def rank(self, target, k=10, max_shift=0):
+        self._position(target)
+        return [{'track': track_id, 'harmonic_compatibility': harmonic_compatibility, 'pitch_shift': pitch_shift}
+                for track_id, harmonic_compatibility, pitch_shift in self.index.top_k(target, int(k), int(max_shift))]
+
+    def key(self, track):
+        key = int(self.keys[self._position(track)])
+        return {'key': TIV.key_labels[key], 'mode': 'min' if key >= 12 else 'maj', 'camelot': CAMELOT_CODES[key]}
+
+    def compare(self, current, candidate, transpose=0):
+        vectors = self.index.vectors
+        current_position, candidate_position = self._position(current), self._position(candidate)
+        harmonic_compatibility, pitch_shift, min_small_scale_comp = compatibility_matrices(
+            vectors[current_position:current_position + 1], vectors[candidate_position:candidate_position + 1],
+            int(transpose))
+        return {'harmonic_compatibility': float(harmonic_compatibility[0, 0]), 'pitch_shift': int(pitch_shift[0, 0]),
+                'transposed_harmonic_compatibility': float(min_small_scale_comp[0, 0])}
+
+    def read_tracks(self, track_ids):
+        """
+        Reads the TIVs of tracks from their annotations (or from the library file)
+
+        :param track_ids: List of track ids
+        :return: List of TIV objects
+        """
+        if self.library_path is not None:
+            from library import TIVLibrary
+            library = TIVLibrary(self.library_path)
+            return [library[track_id] for track_id in track_ids]
+        tivs = []
+        for track_id in track_ids:
+            tiv, analysis = load_annotation(get_annotation_path(track_id))
+            if self.analysis is not None and analysis != self.analysis:
+                raise ValueError("%s was analyzed with different analysis parameters" % track_id)
+            self.analysis = analysis
+            tivs.append(tiv)
+        return tivs
+
+    def add(self, track_ids, tivs):
+        """
+        Adds or updates tracks of the in-memory library
+
+        :param track_ids: List of track ids
+        :param tivs: List of TIV objects, one per track id
+        :return: Dictionary with the number of 'added' and 'updated' tracks, and the number of 'tracks'
+        """
+        updated = sum(track_id in self.index.positions for track_id in set(track_ids))
+        if track_ids:
+            self.index.add(track_ids, [tiv.vector for tiv in tivs], [tiv.energy for tiv in tivs])
+            keys = np.zeros(len(self.index), dtype=np.uint8)
+            keys[:len(self.keys)] = self.keys
+            positions = [self.index.positions[track_id] for track_id in track_ids]
+            keys[positions] = np.atleast_1d(estimate_keys(self.index.vectors[positions]))
+            self.keys = keys
+        return {'added': len(set(track_ids)) - updated, 'updated': updated, 'tracks': len(self.index)}
+
+    async def handle(self, request):
+        """
+        Answers a request
+
+        :param request: Dictionary with the request (see the module documentation)
+        :return: The result of the request
+        """
+        op = request.get('op')
+        if op == 'ping':
+            return {'tracks': len(self.index)}
+        if op == 'rank':
+            return self.rank(request['target'], request.get('k', 10), request.get('max_shift', 0))
+        if op == 'key':
+            return self.key(request['track'])
+        if op == 'compare':
+            return self.compare(request['current'], request['candidate'], request.get('transpose', 0))
+        if op == 'add':
+            track_ids = list(request['tracks'])
+            # Annotations are read in a thread, so that other queries are answered meanwhile
+            tivs = await asyncio.get_running_loop().run_in_executor(None, self.read_tracks, track_ids)
+            return self.add(track_ids, tivs)
+        raise ValueError("Unknown operation: " + str(op))
+
+    async def respond(self, parse):
+        """
+        Answers a request, catching its errors
+
+        :param parse: Function without arguments returning the request dictionary
+        :return: Response dictionary (see the module documentation)
+        """
+        request = {}
+        try:
+            request = parse()
+            return {'id': request.get('id'), 'ok': True, 'result': await self.handle(request)}
+        except Exception as error:
+            message = error.args[0] if isinstance(error, KeyError) and error.args else str(error)
+            return {'id': request.get('id') if isinstance(request, dict) else None, 'ok': False, 'error': message}
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    break  # request longer than REQUEST_LIMIT
+                if not line:
+                    break
+                response = await self.respond(lambda: json.loads(line))
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _http_client(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > REQUEST_LIMIT:
+                raise ValueError("Request too long")
+            body = await reader.readexactly(length)
+
+            def parse():
+                if method == 'POST':
+                    return json.loads(body)
+                if method != 'GET':
+                    raise ValueError("Unsupported HTTP method: " + method)
+                return {name: values if name == 'tracks' else values[-1]
+                        for name, values in parse_qs(urlsplit(target).query).items()}
+
+            response = await self.respond(parse)
+            content = json.dumps(response).encode()
+            writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n' % ('200 OK' if response['ok'] else '400 Bad Request',
+                                                         len(content))).encode() + content)
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass  # malformed request: the connection is closed
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=DEFAULT_SOCKET, port=None, http_port=None):
+        """
+        Serves requests until the task is cancelled
+
+        :param socket_path: Path of the Unix socket
+        :param port: If given, listen on this localhost TCP port instead of the Unix socket
+        :param http_port: If given, also answer HTTP requests on this localhost TCP port
+        """
+        if port is not None:
+            server = await asyncio.start_server(self._client, '127.0.0.1', port, limit=REQUEST_LIMIT)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)  # left by a server that did not stop cleanly
+            server = await asyncio.start_unix_server(self._client, socket_path, limit=REQUEST_LIMIT)
+        servers = [server]
+        if http_port is not None:
+            servers.append(await asyncio.start_server(self._http_client, '127.0.0.1', http_port,
+                                                      limit=REQUEST_LIMIT))
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Local query server with the TIVs of a music library in memory")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve', help="load a music library and serve queries")
+    serve.add_argument('inputs', nargs='*', help="music folders, .mp3 files or glob patterns")
+    serve.add_argument('--library', default=None, help="TIV library file, read instead of the annotations")
+    serve.add_argument('--http', type=int, default=None, help="also answer HTTP requests on this localhost port")
+    query = subparsers.add_parser('query', help="send a request to a running server (see daemon_client.py, "
+                                                "which starts faster)")
+    query.add_argument('request', help='JSON request, e.g. \'{"op": "ping"}\'')
+    for subparser in (serve, query):
+        subparser.add_argument('--socket', default=DEFAULT_SOCKET, help="path of the Unix socket")
+        subparser.add_argument('--port', type=int, default=None, help="localhost TCP port, instead of the socket")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if not args.inputs and args.library is None:
+            parser.error("give the tracks (folders, files or patterns) or a --library file")
+        server = QueryServer.from_tracks(args.inputs, args.library)
+        print("Serving %d tracks on %s" % (len(server.index), args.port or args.socket), file=sys.stderr)
+        try:
+            asyncio.run(server.serve(args.socket, args.port, args.http))
+        except KeyboardInterrupt:
+            pass
+    else:
+        request = json.loads(args.request)
+        with Client(args.socket, args.port) as client:
+            print(json.dumps(client.request(request.pop('op'), **request)))
@@ -0,0 +1,75 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module is the client of the query server of daemon.py. It only
+imports the standard library, so that sending a query does not import
+the analysis libraries (librosa, essentia) that the server keeps loaded.
+
+    python daemon_client.py '{"op": "key", "track": "music/techno/Weska - EQ64 (Original Mix) - 7A - 128.mp3"}'
+"""
+
+import argparse
+import json
+import socket
+
+DEFAULT_SOCKET = '/tmp/harmonic_mix.sock'
+
+
+class Client:
+    """
+    Connection to a query server. The connection is kept open between requests.
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, port=None, timeout=10):
+        """
+        :param socket_path: Path of the Unix socket of the server
+        :param port: If given, connect to this localhost TCP port instead of the Unix socket
+        :param timeout: Timeout of the requests, in seconds
+        """
+        if port is not None:
+            self.socket = socket.create_connection(('127.0.0.1', port), timeout)
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(socket_path)
+        self.file = self.socket.makefile('rb')
+
+    def request(self, op, **params):
+        """
+        Sends a request and waits for its response
+
+        :param op: Operation ('ping', 'rank', 'key', 'compare' or 'add')
+        :param params: Fields of the request
+        :return: The result of the request
+        """
+        self.socket.sendall((json.dumps(dict(params, op=op)) + '\n').encode())
+        response = json.loads(self.file.readline())
+        if not response['ok']:
+            raise ValueError(response['error'])
+        return response['result']
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Send a request to a running query server (see daemon.py)")
+    parser.add_argument('request', help='JSON request, e.g. \'{"op": "ping"}\'')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help="path of the Unix socket")
+    parser.add_argument('--port', type=int, default=None, help="localhost TCP port, instead of the socket")
+    args = parser.parse_args()
+
+    request = json.loads(args.request)
+    with Client(args.socket, args.port) as client:
+        print(json.dumps(client.request(request.pop('op'), **request)))
@@ -0,0 +1,283 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module measures the accuracy and the speed of analysis
+configurations on labelled music folders, so that every change that
+makes the analysis faster can be judged on what it costs in accuracy.
+
+The label of a track is its Camelot code, taken from the "key" and
+"mode" fields of its annotation (as in the dataset annotations of this
+repository, e.g. "key": 11, "mode": "A"), or else from its file name
+(e.g. "... - 11A - 128.mp3" or "... (12A).mp3"). For each configuration
+the tracks are analyzed in parallel, without writing their annotations,
+and the report gives:
+    key accuracy       -- estimated Camelot code equal to the label
+    neighbour accuracy -- estimated code equal to the label or one of its
+                          neighbours on the Camelot wheel
+    ranking precision  -- share of the k most compatible candidates of each
+                          track (harmonic compatibility) whose label is a
+                          neighbour of the label of the track, next to the
+                          share expected from a random ranking
+    tracks/s           -- wall-clock throughput, worker start-up included
+    tracks/s/core      -- tracks analyzed per second of worker time
+
+    python evaluation.py music/techno music/progressive_house --configurations reference fast fast/spectral
+    python evaluation.py music/techno --sweep sweeps/techno"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from harmonic_mix.tivlib import estimate_keys
+from camelot import CAMELOT_CODES, camelot_neighbours
+from compatibility import compatibility_matrices
+from main import PRESETS, get_analysis, get_analysis_label, get_annotation_path, read_annotation
+from batch import _init_worker, list_songs, thread_limits
+
+CAMELOT_PATTERN = re.compile(r'(?<![0-9])(1[0-2]|[1-9])([AB])(?![A-Za-z0-9])')
+RANKING_DEPTH = 5  # candidates of each track checked by the ranking precision
+
+
+def track_label(song_path):
+    """
+    Returns the labelled Camelot code of a track
+
+    :param song_path: The path of the track
+    :return: Camelot code, from the annotation or else from the file name, or None if the track is not labelled
+    """
+
+    annotation = read_annotation(get_annotation_path(song_path))
+    if annotation.get('key') is not None and annotation.get('mode') in ('A', 'B'):
+        return '%d%s' % (annotation['key'], annotation['mode'])
+    matches = CAMELOT_PATTERN.findall(os.path.splitext(os.path.basename(song_path))[0])
+    return '%s%s' % matches[-1] if matches else None
+
+
+def labelled_songs(folders):
+    """
+    Lists the labelled tracks of music folders
+
+    :param folders: List of music folders
+    :return: List of song paths and list of their Camelot codes
+    """
+
+    song_paths, labels = [], []
+    for folder in folders:
+        for song_path in list_songs(folder):
+            label = track_label(song_path)
+            if label is not None:
+                song_paths.append(song_path)
+                labels.append(label)
+    return song_paths, labels
+
+
+def parse_configuration(label):
+    """
+    :param label: Name of an analysis, e.g. 'fast', 'fast/spectral' or 'fast/spectral/4w'
+            (see main.get_analysis_label)
+    :return: Dictionary with the analysis parameters
+    """
+
+    preset, *modes = label.split('/')
+    windows = None
+    if modes and re.fullmatch(r'[0-9]+w', modes[-1]):
+        windows = int(modes.pop()[:-1])
+    if modes not in ([], ['spectral']):
+        raise ValueError("Unknown analysis mode: " + '/'.join(modes))
+    return get_analysis(preset, modes == ['spectral'], windows)
+
+
+def _evaluate_worker(song_path, analysis):
+    from sweep import sweep_song
+    from sampling import sampled_tiv
+    start = time.process_time()
+    try:
+        if analysis.get('windows') is not None:
+            tiv = sampled_tiv(song_path, analysis)
+        else:
+            tiv = sweep_song(song_path, [analysis])[0]
+    except Exception as error:
+        return None, time.process_time() - start, repr(error)
+    return tiv.vector, time.process_time() - start, None
+
+
+def analyze_tracks(song_paths, analysis, workers=None, blas_threads=1):
+    """
+    Computes the TIVs of tracks in parallel, without reading or writing their annotations
+
+    :param song_paths: List with the paths of the tracks
+    :param analysis: Dictionary with the analysis parameters
+    :param workers: Number of worker processes. Default: number of CPUs
+    :param blas_threads: Number of BLAS/OpenMP threads of each worker
+    :return: TIV vectors (Nx6, NaN for the tracks that failed), dictionary with the error message of
+            every track that failed, wall-clock seconds and CPU seconds of the workers
+    """
+
+    workers = min(workers or os.cpu_count(), len(song_paths)) or 1
+    vectors = np.full((len(song_paths), 6), np.nan, dtype=np.complex128)
+    errors = {}
+    cpu = 0.0
+    start = time.perf_counter()
+    with thread_limits(blas_threads), \
+            ProcessPoolExecutor(max_workers=workers,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker,
+                                initargs=(blas_threads, 1)) as executor:
+        results = executor.map(_evaluate_worker, song_paths, [analysis] * len(song_paths))
+        for row, (song_path, (vector, seconds, error)) in enumerate(zip(song_paths, results)):
+            cpu += seconds
+            if error is not None:
+                errors[song_path] = error
+            else:
+                vectors[row] = vector
+    return vectors, errors, time.perf_counter() - start, cpu
+
+
+def score(vectors, labels, profiles='temperley', depth=RANKING_DEPTH):
+    """
+    Scores TIVs against the labelled Camelot codes of their tracks
+
+    :param vectors: TIV vectors (Nx6). Rows with NaN values (failed tracks) count as wrong.
+    :param labels: List with the Camelot code of each track
+    :param profiles: Key profiles ('temperley' or 'shaath')
+    :param depth: Number of candidates of each track checked by the ranking precision
+    :return: Dictionary with the key accuracy, the neighbour accuracy, the ranking precision
+            and the ranking precision of a random ranking
+    """
+
+    valid = ~np.isnan(vectors).any(axis=1)
+    codes = [None] * len(labels)
+    if valid.any():
+        for row, key in zip(np.flatnonzero(valid), np.atleast_1d(estimate_keys(vectors[valid], profiles))):
+            codes[row] = CAMELOT_CODES[key]
+    neighbours = [set(camelot_neighbours(label)) for label in labels]
+    results = {'tracks': len(labels), 'failed': int((~valid).sum()),
+               'key_accuracy': float(np.mean([code == label for code, label in zip(codes, labels)])),
+               'neighbour_accuracy': float(np.mean([code in near for code, near in zip(codes, neighbours)])),
+               'ranking_precision': None, 'ranking_chance': None}
+
+    rows = np.flatnonzero(valid)
+    depth = min(depth, len(rows) - 1)
+    if depth > 0:
+        harmonic_compatibility = compatibility_matrices(vectors[rows])[0]
+        np.fill_diagonal(harmonic_compatibility, -np.inf)
+        top = np.argsort(-harmonic_compatibility, axis=1, kind='stable')[:, :depth]
+        compatible = np.array([[labels[rows[column]] in neighbours[rows[row]] for column in range(len(rows))]
+                               for row in range(len(rows))])
+        np.fill_diagonal(compatible, False)
+        results['ranking_precision'] = float(np.mean(np.take_along_axis(compatible, top, axis=1)))
+        results['ranking_chance'] = float(compatible.sum() / (len(rows) * (len(rows) - 1)))
+    return results
+
+
+def evaluate(song_paths, labels, configurations, workers=None, blas_threads=1, profiles='temperley',
+             depth=RANKING_DEPTH):
+    """
+    Analyzes labelled tracks with each configuration, and scores the results
+
+    :param song_paths: List with the paths of the tracks
+    :param labels: List with the Camelot code of each track
+    :param configurations: List of dictionaries with the analysis parameters
+    :param workers, blas_threads: As in analyze_tracks
+    :param profiles, depth: As in score
+    :return: List with a dictionary of results per configuration
+    """
+
+    results = []
+    for analysis in configurations:
+        vectors, errors, wall, cpu = analyze_tracks(song_paths, analysis, workers, blas_threads)
+        result = score(vectors, labels, profiles, depth)
+        done = len(song_paths) - len(errors)
+        result.update({'configuration': get_analysis_label(analysis), 'analysis': analysis,
+                       'tracks_per_second': done / wall if wall > 0 else None,
+                       'tracks_per_second_per_core': done / cpu if cpu > 0 else None, 'errors': errors})
+        results.append(result)
+    return results
+
+
+def evaluate_sweep(output_folder, song_paths, labels, profiles='temperley', depth=RANKING_DEPTH):
+    """
+    Scores the TIV libraries of a parameter sweep (see sweep.py). Their speed is not measured.
+
+    :param output_folder: Output folder of the sweep
+    :param song_paths: List with the paths of the labelled tracks
+    :param labels: List with the Camelot code of each track
+    :param profiles, depth: As in score
+    :return: List with a dictionary of results per configuration
+    """
+
+    from sweep import load_sweep
+    results = []
+    for index, (analysis, library) in enumerate(load_sweep(output_folder)):
+        vectors = np.full((len(song_paths), 6), np.nan, dtype=np.complex128)
+        for row, song_path in enumerate(song_paths):
+            if song_path in library:
+                vectors[row] = library[song_path].vector
+        result = score(vectors, labels, profiles, depth)
+        swept = {name: value for name, value in analysis.items()
+                 if value != get_analysis(analysis['preset'], analysis['spectral'])[name]}
+        result.update({'configuration': '%d %s' % (index, json.dumps(swept)), 'analysis': analysis,
+                       'tracks_per_second': None, 'tracks_per_second_per_core': None, 'errors': {}})
+        results.append(result)
+    return results
+
+
+def print_results(results):
+    """
+    Prints the results of each configuration side by side
+
+    :param results: List returned by evaluate or evaluate_sweep
+    """
+
+    def percent(value):
+        return '%6.1f%%' % (100 * value) if value is not None else '      -'
+
+    def rate(value):
+        return '%8.2f' % value if value is not None else '       -'
+
+    width = max([len('configuration')] + [len(result['configuration']) for result in results])
+    print('%-*s  %6s  %7s  %7s  %7s  %7s  %8s  %8s' % (width, 'configuration', 'tracks', 'key', 'neighb.',
+                                                       'rank@k', 'chance', 'tracks/s', '/core'))
+    for result in results:
+        print('%-*s  %6d  %s  %s  %s  %s  %s  %s' % (
+            width, result['configuration'], result['tracks'] - result['failed'], percent(result['key_accuracy']),
+            percent(result['neighbour_accuracy']), percent(result['ranking_precision']),
+            percent(result['ranking_chance']), rate(result['tracks_per_second']),
+            rate(result['tracks_per_second_per_core'])))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Measure the accuracy and the speed of analysis configurations")
+    parser.add_argument('folders', nargs='+', help="labelled music folders")
+    parser.add_argument('--configurations', nargs='+', default=['reference'],
+                        help="analyses to evaluate, e.g. reference fast fast/spectral reference/4w (presets: %s)"
+                             % ', '.join(sorted(PRESETS)))
+    parser.add_argument('--sweep', default=None, help="score the TIV libraries of a sweep folder instead")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--blas-threads', type=int, default=1, help="BLAS threads per worker")
+    parser.add_argument('--profiles', default='temperley', choices=['temperley', 'shaath'], help="key profiles")
+    parser.add_argument('-k', type=int, default=RANKING_DEPTH, help="candidates checked by the ranking precision")
+    parser.add_argument('--save', help="save the results as JSON")
+    args = parser.parse_args()
+
+    song_paths, labels = labelled_songs(args.folders)
+    print("%d labelled tracks" % len(song_paths))
+    if args.sweep is not None:
+        results = evaluate_sweep(args.sweep, song_paths, labels, args.profiles, args.k)
+    else:
+        results = evaluate(song_paths, labels, [parse_configuration(label) for label in args.configurations],
+                           args.workers, args.blas_threads, args.profiles, args.k)
+    print_results(results)
+    for result in results:
+        for song_path, error in result['errors'].items():
+            print("%s: %s failed: %s" % (result['configuration'], song_path, error))
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -0,0 +1,248 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module keeps an optional on-disk cache of the decoded audio and of
+the harmonic part of the tracks, so that analyzing a music library again
+with other parameters does not decode and separate every track again:
+    audio    -- the whole decoded mono audio (float32), by sample rate
+    harmonic -- the harmonic audio (decompose_harmonic), or the harmonic
+                magnitude spectrogram with the spectral fast path, by the
+                parameters of the cut and of the separation
+Both are also found by the decoder (main.DECODER): MonoLoader and
+librosa do not decode a track to the same samples.
+
+With the harmonic part cached, changing the chroma parameters skips both
+the decoding and the separation; with the audio cached, changing the
+cut or the separation parameters skips the decoding.
+
+Entries are .npy files read as memory-mapped arrays, so only the pages
+that are used are read from disk. They are found by the content hash of
+the audio file (see cache.py), so they follow renamed and moved tracks.
+The size of the cache is capped: when an entry is added, the least
+recently used entries are removed until the cache fits.
+
+The cache is disabled until enable is called. Setting the
+HARMONIC_MIX_FEATURE_CACHE environment variable to a folder enables it
+on import, which also enables it in worker processes
+(HARMONIC_MIX_FEATURE_CACHE_SIZE sets the size cap, in megabytes).
+
+    python feature_cache.py /tmp/harmonic_mix_cache --max-size 2048"""
+
+import argparse
+import os
+import numpy as np
+
+CACHE_VARIABLE = 'HARMONIC_MIX_FEATURE_CACHE'
+CACHE_SIZE_VARIABLE = 'HARMONIC_MIX_FEATURE_CACHE_SIZE'
+DEFAULT_SIZE = 4096  # megabytes
+MEGABYTE = 2 ** 20
+
+# Analysis parameters each kind of entry depends on (see main.get_analysis)
+PARAMETERS = {
+    'audio': ['sample_rate'],
+    'harmonic': ['sample_rate', 'song_kept', 'spectral', 'n_fft', 'hop_length', 'kernel_size'],
+    'harmonic/spectral': ['sample_rate', 'song_kept', 'spectral', 'frame_size', 'hop_size', 'n_fft', 'hop_length',
+                          'kernel_size'],
+}
+
+_cache = None
+
+
+class FeatureCache:
+    """
+    Folder of memory-mapped arrays with a size cap and least-recently-used eviction
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_SIZE * MEGABYTE):
+        """
+        :param directory: Path of the cache folder (created if it does not exist)
+        :param max_bytes: Size cap of the cache, in bytes
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, song_path, kind, analysis):
+        """
+        :param song_path: The path of the track
+        :param kind: 'audio' or 'harmonic'
+        :param analysis: Dictionary with the analysis parameters
+        :return: Path of the entry of the track
+        """
+        from cache import analysis_fingerprint
+        if kind == 'harmonic' and analysis['spectral']:
+            kind = 'harmonic/spectral'
+        from main import DECODER
+        parameters = {name: analysis[name] for name in PARAMETERS[kind]}
+        parameters['decoder'] = DECODER
+        return os.path.join(self.directory, '%s.%s.%s.npy' % (
+            _track_hash(song_path), kind.replace('/', '-'), analysis_fingerprint(parameters)))
+
+    def get(self, song_path, kind, analysis):
+        """
+        :return: The memory-mapped array of the entry, or None if it is not cached
+        """
+        entry_path = self.entry_path(song_path, kind, analysis)
+        try:
+            array = np.load(entry_path, mmap_mode='r')
+            os.utime(entry_path)  # the modification time orders the entries by last use
+        except (IOError, ValueError):
+            return None
+        return array
+
+    def put(self, song_path, kind, analysis, array):
+        """
+        Adds an entry, and removes the least recently used entries if the cache is full
+
+        :param array: Array of the entry
+        :return: The memory-mapped array of the entry, or the given array if it is larger than the cache
+                (or was removed by another process before it was read)
+        """
+        array = np.ascontiguousarray(array)
+        if array.nbytes > self.max_bytes:
+            return array
+        entry_path = self.entry_path(song_path, kind, analysis)
+        temp_path = entry_path[:-len('.npy')] + '.%d.tmp' % os.getpid()
+        with open(temp_path, 'wb') as entry_file:
+            np.save(entry_file, array)
+        os.replace(temp_path, entry_path)
+        try:
+            # Mapped before the eviction: the array stays readable if another process removes the entry
+            cached_array = np.load(entry_path, mmap_mode='r')
+        except (IOError, ValueError):
+            cached_array = array  # already removed by another process
+        self.evict(keep=entry_path)
+        return cached_array
+
+    def entries(self):
+        """
+        :return: List of (modification time, size, path) of the entries, from the least recently used
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                entry_path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue  # removed by another process
+                entries.append((stat.st_mtime_ns, stat.st_size, entry_path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in its size cap
+
+        :param max_bytes: Size cap. Default: the size cap of the cache
+        :param keep: Path of an entry that is not removed
+        :return: Number of bytes removed
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, entry_path in entries:
+            if total - removed <= max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            removed += size
+        return removed
+
+    def clear(self):
+        return self.evict(0)
+
+
+def _track_hash(song_path):
+    """Content hash of a track, from its annotation when the file did not change since it was saved"""
+
+    from cache import _file_stat, content_hash
+    from main import get_annotation_path, read_annotation
+    try:
+        content = read_annotation(get_annotation_path(song_path)).get('content') or {}
+    except (IOError, ValueError):
+        content = {}
+    size, mtime_ns = _file_stat(song_path)
+    if content.get('hash') and content.get('size') == size and content.get('mtime_ns') == mtime_ns:
+        return content['hash']
+    return content_hash(song_path)
+
+
+def enable(directory, max_bytes=DEFAULT_SIZE * MEGABYTE):
+    """
+    Enables the cache
+
+    :param directory: Path of the cache folder
+    :param max_bytes: Size cap of the cache, in bytes
+    :return: FeatureCache object
+    """
+
+    global _cache
+    _cache = FeatureCache(directory, max_bytes)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def enabled():
+    return _cache is not None
+
+
+def contains(song_path, kind, analysis):
+    """
+    :return: True if the cache is enabled and has the entry
+    """
+
+    return _cache is not None and os.path.exists(_cache.entry_path(song_path, kind, analysis))
+
+
+def cached(song_path, kind, analysis, compute):
+    """
+    Returns an entry of the cache, computing and adding it if it is not cached
+
+    :param song_path: The path of the track
+    :param kind: 'audio' or 'harmonic'
+    :param analysis: Dictionary with the analysis parameters
+    :param compute: Function without arguments that computes the array of the entry
+    :return: The array (memory-mapped if it is cached). Computed at once if the cache is disabled.
+    """
+
+    if _cache is None:
+        return compute()
+    array = _cache.get(song_path, kind, analysis)
+    if array is None:
+        array = _cache.put(song_path, kind, analysis, compute())
+    return array
+
+
+if os.environ.get(CACHE_VARIABLE):
+    enable(os.environ[CACHE_VARIABLE], int(os.environ.get(CACHE_SIZE_VARIABLE, DEFAULT_SIZE)) * MEGABYTE)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Show or trim a feature cache folder")
+    parser.add_argument('directory', help="cache folder")
+    parser.add_argument('--max-size', type=int, default=None, help="remove entries until the cache fits, in MB")
+    parser.add_argument('--clear', action='store_true', help="remove every entry")
+    args = parser.parse_args()
+
+    feature_cache = FeatureCache(args.directory)
+    if args.clear:
+        feature_cache.clear()
+    elif args.max_size is not None:
+        feature_cache.evict(args.max_size * MEGABYTE)
+    entries = feature_cache.entries()
+    print("%d entries, %.1f MB" % (len(entries), sum(size for _, size, _ in entries) / MEGABYTE))
@@ -0,0 +1,278 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module emits structured events from the analysis and the
+comparison of tracks: analysis stages, annotation reads and writes,
+comparisons and annotation cache hits and misses, with their duration
+and byte count.
+
+Events are dictionaries with the fields 'time' (Unix time), 'kind'
+('stage', 'io', 'comparison' or 'cache'), 'name', 'duration' (seconds,
+None for instant events), 'bytes' (None if not applicable) and any
+extra field given by the caller (e.g. 'path').
+
+Instrumentation is disabled until a sink is added with add_sink. While
+it is disabled, span returns a shared do-nothing object and emit returns
+at once, so the hooks cost a function call. Setting the
+HARMONIC_MIX_EVENT_LOG environment variable to a file path adds a
+LogFileSink on import, which also instruments worker processes.
+
+Sinks are objects with a handle(event) method:
+    LogFileSink -- appends the events to a file, one JSON object per line
+    Aggregator  -- counts, durations and bytes by event, in memory, with a
+                   Prometheus-style text dump
+
+    python instrumentation.py events.jsonl
+prints the Prometheus text of the events of a log file."""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+EVENT_LOG_VARIABLE = 'HARMONIC_MIX_EVENT_LOG'
+
+_sinks = []
+
+
+def add_sink(sink):
+    """Adds a sink, enabling the instrumentation
+
+    :param sink: Object with a handle(event) method
+    :return: The sink
+    """
+
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """Removes a sink. Instrumentation is disabled when no sink is left
+
+    :param sink: A sink added with add_sink
+    """
+
+    _sinks.remove(sink)
+
+
+def enabled():
+    """True if at least one sink consumes the events"""
+    return bool(_sinks)
+
+
+def emit(kind, name, duration=None, nbytes=None, **fields):
+    """
+    Sends an event to the sinks
+
+    :param kind: 'stage', 'io', 'comparison' or 'cache'
+    :param name: Name of the event, e.g. 'decode' or 'load_annotation'
+    :param duration: Duration in seconds, None for instant events
+    :param nbytes: Number of bytes read, written or decoded, None if not applicable
+    :param fields: Extra fields of the event (e.g. path, result)
+    """
+
+    if not _sinks:
+        return
+    event = {'time': time.time(), 'kind': kind, 'name': name, 'duration': duration, 'bytes': nbytes}
+    event.update(fields)
+    for sink in list(_sinks):
+        sink.handle(event)
+
+
+class _Span:
+    """Times a block of code and emits its event on exit"""
+
+    def __init__(self, kind, name, fields):
+        self.kind = kind
+        self.name = name
+        self.fields = fields
+        self.nbytes = None
+
+    def add_bytes(self, nbytes):
+        self.nbytes = (self.nbytes or 0) + int(nbytes)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fields = self.fields
+        if exc_type is not None:
+            fields = dict(fields, error=exc_type.__name__)
+        emit(self.kind, self.name, time.perf_counter() - self._start, self.nbytes, **fields)
+        return False
+
+
+class _NullSpan:
+    """Span used while instrumentation is disabled"""
+
+    def add_bytes(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(kind, name, **fields):
+    """
+    Context manager that emits an event with the duration of a block of code.
+    The byte count is given inside the block with add_bytes.
+
+        with instrumentation.span('stage', 'decode', path=song_path) as event:
+            audio = MonoLoader(filename=song_path)()
+            event.add_bytes(audio.nbytes)
+
+    :param kind: 'stage', 'io', 'comparison' or 'cache'
+    :param name: Name of the event
+    :param fields: Extra fields of the event
+    :return: The span (a shared do-nothing span while instrumentation is disabled)
+    """
+
+    if not _sinks:
+        return _NULL_SPAN
+    return _Span(kind, name, fields)
+
+
+class LogFileSink:
+    """
+    Appends every event to a file, as one JSON object per line. Lines are written
+    with a single call, so several processes can share the same file.
+    """
+
+    def __init__(self, log_path):
+        """
+        :param log_path: Path of the log file (created if it does not exist)
+        """
+        self.log_path = log_path
+        self._file = open(log_path, 'a', buffering=1, encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Aggregator:
+    """
+    Aggregates the events in memory by kind, name and result: number of events,
+    total and maximum duration, and total bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    def handle(self, event):
+        key = (event['kind'], event['name'], event.get('result'))
+        with self._lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0}
+            metric['count'] += 1
+            if event.get('duration') is not None:
+                metric['seconds'] += event['duration']
+                metric['max_seconds'] = max(metric['max_seconds'], event['duration'])
+            if event.get('bytes') is not None:
+                metric['bytes'] += event['bytes']
+
+    def reset(self):
+        with self._lock:
+            self.metrics = {}
+
+    def summary(self):
+        """
+        :return: List of dictionaries (kind, name, result, count, seconds, max_seconds, mean_seconds, bytes),
+                sorted by total duration
+        """
+        with self._lock:
+            rows = [dict(metric, kind=kind, name=name, result=result,
+                         mean_seconds=metric['seconds'] / metric['count'])
+                    for (kind, name, result), metric in self.metrics.items()]
+        return sorted(rows, key=lambda row: -row['seconds'])
+
+    def prometheus(self, prefix='harmonic_mix'):
+        """
+        Dumps the aggregated metrics in the Prometheus text exposition format
+
+        :param prefix: Prefix of the metric names
+        :return: String with the metrics
+        """
+        metrics = [('events_total', 'counter', 'Number of events', 'count'),
+                   ('duration_seconds_total', 'counter', 'Total duration of the events', 'seconds'),
+                   ('duration_seconds_max', 'gauge', 'Longest event', 'max_seconds'),
+                   ('bytes_total', 'counter', 'Bytes read, written or decoded', 'bytes')]
+        rows = self.summary()
+        lines = []
+        for suffix, metric_type, description, field in metrics:
+            name = prefix + '_' + suffix
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for row in rows:
+                labels = 'kind="%s",name="%s"' % (row['kind'], row['name'])
+                if row['result'] is not None:
+                    labels += ',result="%s"' % row['result']
+                lines.append('%s{%s} %s' % (name, labels, repr(float(row[field]))))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='harmonic_mix'):
+        """
+        Writes the Prometheus text dump to a file, replacing it atomically
+        (e.g. for the textfile collector of the node exporter)
+
+        :param path: Path of the file
+        :param prefix: Prefix of the metric names
+        """
+        temp_path = path + '.%d.tmp' % os.getpid()
+        with open(temp_path, 'w') as dump_file:
+            dump_file.write(self.prometheus(prefix))
+        os.replace(temp_path, path)
+
+
+def read_log(log_path):
+    """
+    Reads the events of a log file written by LogFileSink
+
+    :param log_path: Path of the log file
+    :return: List of events
+    """
+
+    with open(log_path, 'r', encoding='utf-8') as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+if os.environ.get(EVENT_LOG_VARIABLE):
+    add_sink(LogFileSink(os.environ[EVENT_LOG_VARIABLE]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Aggregate the events of instrumentation log files")
+    parser.add_argument('logs', nargs='+', help="event log files (one JSON event per line)")
+    parser.add_argument('--table', action='store_true', help="print a table instead of the Prometheus text")
+    args = parser.parse_args()
+
+    aggregator = Aggregator()
+    for log_path in args.logs:
+        for event in read_log(log_path):
+            aggregator.handle(event)
+    if args.table:
+        for row in aggregator.summary():
+            print("%-10s %-24s %-5s %7d events %10.3f s (max %8.3f s) %12d bytes" % (
+                row['kind'], row['name'], row['result'] or '', row['count'], row['seconds'],
+                row['max_seconds'], row['bytes']))
+    else:
+        print(aggregator.prometheus(), end='')
@@ -0,0 +1,287 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module stores the TIVs of a whole music library in a single
+binary file, so that they can be memory-mapped instead of parsing one
+annotation .json file per track.
+
+File layout (little endian):
+    header   -- 64 bytes: magic, number of tracks, capacity, analysis name,
+                fingerprint of the analysis parameters (see cache.analysis_fingerprint)
+    energies -- capacity complex128 values
+    vectors  -- capacity x 6 complex128 values
+The track ids are stored one per line in a "<library>.ids" text file,
+and the index of the estimated key of each track (see tivlib.estimate_keys)
+as one byte per track in a "<library>.keys" file, both in the same order
+as the rows of the binary file.
+"""
+
+import os
+import numpy as np
+from harmonic_mix.tivlib import TIV, TIVCollection, estimate_keys
+from main import get_analysis, get_analysis_label, load_annotation
+from cache import analysis_fingerprint
+
+MAGIC = b'TIVLIB01'
+HEADER_SIZE = 64
+INITIAL_CAPACITY = 1024
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('count', '<u8'), ('capacity', '<u8'), ('analysis', 'S32'),
+                         ('fingerprint', '<u8')])
+
+
+class TIVLibrary:
+    """
+    Columnar store of the TIVs (energy and 6-bin vector) of a music library,
+    indexed by track id. All the TIVs of a library come from the same analysis.
+    """
+
+    def __init__(self, library_path, mode='r', analysis=None):
+        """
+        Opens a library file
+
+        :param library_path: Path of the binary library file
+        :param mode: 'r' to open an existing library read-only, 'a' to open it for appending
+                (it is created if it does not exist)
+        :param analysis: Dictionary with the analysis parameters of the TIVs (see main.get_analysis).
+                Default: reference analysis for new libraries, any analysis for existing ones.
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError("Library mode must be 'r' or 'a'")
+        self.library_path = library_path
+        self.ids_path = library_path + '.ids'
+        self.keys_path = library_path + '.keys'
+        self.mode = mode
+
+        if not os.path.isfile(library_path):
+            if mode == 'r':
+                raise FileNotFoundError(library_path)
+            analysis_parameters = analysis if analysis is not None else get_analysis()
+            self._analysis_label = get_analysis_label(analysis_parameters)
+            self._fingerprint = analysis_fingerprint(analysis_parameters)
+            self._write_empty(library_path, INITIAL_CAPACITY)
+            open(self.ids_path, 'w').close()
+
+        self._open()
+        if analysis is not None and not self.matches(analysis):
+            raise ValueError("%s holds TIVs of another analysis (%s)" % (library_path, self._describe()))
+
+    def _open(self):
+        header = np.fromfile(self.library_path, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError("%s is not a TIV library file" % self.library_path)
+        self._count = int(header['count'])
+        self._capacity = int(header['capacity'])
+        # Libraries written before the analysis was recorded hold reference TIVs
+        self._analysis_label = header['analysis'].decode() or get_analysis_label(get_analysis())
+        # Libraries written before the fingerprint was recorded are only checked by their analysis name
+        self._fingerprint = '%016x' % header['fingerprint'] if header['fingerprint'] else None
+
+        memmap_mode = 'r' if self.mode == 'r' else 'r+'
+        self._energies = np.memmap(self.library_path, dtype='<c16', mode=memmap_mode,
+                                   offset=HEADER_SIZE, shape=(self._capacity,))
+        self._vectors = np.memmap(self.library_path, dtype='<c16', mode=memmap_mode,
+                                  offset=HEADER_SIZE + 16 * self._capacity, shape=(self._capacity, 6))
+
+        with open(self.ids_path, 'r', encoding='utf-8') as ids_file:
+            # Ids written after the last committed header are leftovers of an interrupted append
+            self.track_ids = ids_file.read().splitlines()[:self._count]
+        self.index = {track_id: row for row, track_id in enumerate(self.track_ids)}
+
+        keys = np.fromfile(self.keys_path, dtype=np.uint8) if os.path.isfile(self.keys_path) \
+            else np.zeros(0, dtype=np.uint8)
+        if len(keys) < self._count:
+            # Libraries written before the keys were stored
+            keys = estimate_keys(self.vectors).astype(np.uint8)
+            if self.mode == 'a':
+                self._write_keys(keys)
+        self._keys = keys[:self._count]
+
+    def _write_keys(self, keys):
+        temp_path = self.keys_path + '.tmp'
+        keys.tofile(temp_path)
+        os.replace(temp_path, self.keys_path)
+
+    def _header(self, count, capacity):
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['count'] = count
+        header['capacity'] = capacity
+        header['analysis'] = self._analysis_label.encode()
+        header['fingerprint'] = int(self._fingerprint, 16) if self._fingerprint is not None else 0
+        return header
+
+    def _write_empty(self, library_path, capacity):
+        header = self._header(0, capacity)
+        with open(library_path, 'wb') as library_file:
+            library_file.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+            library_file.truncate(HEADER_SIZE + 16 * 7 * capacity)
+
+    def _write_count(self, count):
+        header = self._header(count, self._capacity)
+        with open(self.library_path, 'r+b') as library_file:
+            library_file.write(header.tobytes())
+            library_file.flush()
+            os.fsync(library_file.fileno())
+        self._count = count
+
+    def _grow(self, capacity):
+        """Rewrites the library with a bigger capacity, replacing the old file atomically"""
+        temp_path = self.library_path + '.tmp'
+        self._write_empty(temp_path, capacity)
+        energies = np.memmap(temp_path, dtype='<c16', mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+        vectors = np.memmap(temp_path, dtype='<c16', mode='r+', offset=HEADER_SIZE + 16 * capacity,
+                            shape=(capacity, 6))
+        energies[:self._count] = self._energies[:self._count]
+        vectors[:self._count] = self._vectors[:self._count]
+        energies.flush()
+        vectors.flush()
+        del energies, vectors
+
+        header = self._header(self._count, capacity)
+        with open(temp_path, 'r+b') as library_file:
+            library_file.write(header.tobytes())
+        os.replace(temp_path, self.library_path)
+        self._open()
+
+    @property
+    def analysis_label(self):
+        """Name of the analysis that computed the TIVs of the library (see main.get_analysis_label)"""
+        return self._analysis_label
+
+    @property
+    def analysis_fingerprint(self):
+        """Fingerprint of the analysis parameters of the TIVs (see cache.analysis_fingerprint),
+        or None for libraries written before it was recorded"""
+        return self._fingerprint
+
+    def matches(self, analysis):
+        """
+        :param analysis: Dictionary with the analysis parameters
+        :return: True if the TIVs of the library come from this analysis. Libraries without
+                fingerprint only compare the analysis name (see main.get_analysis_label).
+        """
+        if self._fingerprint is not None:
+            return analysis_fingerprint(analysis) == self._fingerprint
+        return get_analysis_label(analysis) == self._analysis_label
+
+    def _describe(self):
+        if self._fingerprint is None:
+            return self._analysis_label
+        return '%s, parameters %s' % (self._analysis_label, self._fingerprint)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, track_id):
+        return track_id in self.index
+
+    def __getitem__(self, track_id):
+        row = self.index[track_id]
+        return TIV(complex(self._energies[row]), np.array(self._vectors[row]))
+
+    @property
+    def energies(self):
+        """Energies of the TIVs of the library (memory-mapped, N)"""
+        return self._energies[:self._count]
+
+    @property
+    def vectors(self):
+        """Vectors of the TIVs of the library (memory-mapped, Nx6)"""
+        return self._vectors[:self._count]
+
+    @property
+    def keys(self):
+        """Index of the estimated key of each track, in TIV.key_labels order (N)"""
+        return self._keys
+
+    def to_collection(self):
+        """
+        Loads the library into a TIVCollection without copying the arrays
+
+        :return: TIVCollection with a single sequence holding one TIV per track, in library order
+        """
+        return TIVCollection.from_arrays(self.energies, self.vectors)
+
+    def append(self, track_ids, tivs):
+        """
+        Appends TIVs to the library. Tracks already in the library are updated in place.
+
+        :param track_ids: List of track ids
+        :param tivs: List of TIV objects, one per track id
+        """
+        if self.mode != 'a':
+            raise IOError("Library opened read-only")
+        if len(track_ids) != len(tivs):
+            raise ValueError("There must be one TIV per track id")
+
+        new_ids = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in self.index]
+        if self._count + len(new_ids) > self._capacity:
+            capacity = self._capacity
+            while capacity < self._count + len(new_ids):
+                capacity = 2 * capacity
+            self._grow(capacity)
+
+        for row, track_id in enumerate(new_ids, start=self._count):
+            self.index[track_id] = row
+        for track_id, tiv in zip(track_ids, tivs):
+            row = self.index[track_id]
+            self._energies[row] = tiv.energy
+            self._vectors[row] = tiv.vector
+        self._energies.flush()
+        self._vectors.flush()
+
+        rows = np.array([self.index[track_id] for track_id in track_ids], dtype=int)
+        keys = np.zeros(self._count + len(new_ids), dtype=np.uint8)
+        keys[:self._count] = self._keys
+        keys[rows] = estimate_keys(self._vectors[rows].reshape(-1, 6))
+        self._write_keys(keys)
+        self._keys = keys
+
+        if new_ids:
+            # Ids and keys first, then the track count: an interrupted append leaves the library unchanged
+            with open(self.ids_path, 'r+b') as ids_file:
+                ids_file.truncate(sum(len(track_id.encode('utf-8')) + 1 for track_id in self.track_ids))
+                ids_file.seek(0, os.SEEK_END)
+                ids_file.write(''.join(track_id + '\n' for track_id in new_ids).encode('utf-8'))
+                ids_file.flush()
+                os.fsync(ids_file.fileno())
+            self.track_ids.extend(new_ids)
+            self._write_count(self._count + len(new_ids))
+
+    def add(self, track_id, tiv):
+        """
+        Appends (or updates) the TIV of a single track
+
+        :param track_id: Track id
+        :param tiv: TIV instance with the values corresponding to the track analysis.
+        """
+        self.append([track_id], [tiv])
+
+    def import_annotations(self, annotations_folder):
+        """
+        Imports the .json annotations written by analyze_song. The track id is the
+        annotation file name without extension. Files without TIV values are skipped.
+        All the annotations must come from the analysis of the library.
+
+        :param annotations_folder: Path of an annotations folder
+        :return: Number of imported tracks
+        """
+        track_ids = []
+        tivs = []
+        for file in sorted(os.listdir(annotations_folder)):
+            if not file.endswith('.json'):
+                continue
+            try:
+                tiv, analysis = load_annotation(os.path.join(annotations_folder, file))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if not self.matches(analysis):
+                raise ValueError("%s comes from the %s analysis (parameters %s), the library holds TIVs of "
+                                 "another analysis (%s)" % (file, get_analysis_label(analysis),
+                                                            analysis_fingerprint(analysis), self._describe()))
+            track_ids.append(file[:-len('.json')])
+            tivs.append(tiv)
+        self.append(track_ids, tivs)
+        return len(track_ids)
@@ -14,44 +14,107 @@ from json import JSONEncoder
 import json
 import librosa
 import numpy as np
-from essentia.standard import LogSpectrum, MonoLoader, Windowing, \
-  Spectrum, FrameGenerator, NNLSChroma
+try:
+    from essentia.standard import LogSpectrum, MonoLoader, Windowing, \
+      Spectrum, FrameGenerator, NNLSChroma
+except ImportError:
+    # Without essentia, songs are decoded with librosa and the chroma is computed with NumPy (see chroma.py)
+    MonoLoader = None
 from harmonic_mix.tivlib import TIV
+from camelot import tiv_camelot_code
+import instrumentation
 
 SONG_KEPT = 0.3  # percentage of the song to compare
 SR = 44100  # Sample rate
-
-
-def decompose_harmonic(audio):
+KERNEL_SIZE = (13, 31)  # HPSS median filter sizes (harmonic, percussive)
+N_FFT = 2048  # HPSS STFT size
+HOP_LENGTH = 512  # HPSS STFT hop
+FRAME_SIZE = 16384  # NNLS chroma frame size
+HOP_SIZE = 2048  # NNLS chroma hop
+# NNLS chroma frontend: 'essentia' (LogSpectrum and NNLSChroma) or 'numpy' (see chroma.py)
+CHROMA_FRONTEND = os.environ.get('HARMONIC_MIX_CHROMA_FRONTEND') or ('essentia' if MonoLoader is not None else 'numpy')
+# Decoder of the whole songs: 'essentia' (MonoLoader) or 'librosa' (see decode_file)
+DECODER = 'essentia' if MonoLoader is not None else 'librosa'
+
+# Analysis presets. The STFT and frame sizes scale with the sample rate, so that all presets keep the
+# frequency resolution of the reference analysis. 'balanced' also keeps its time resolution; the hops of
+# 'fast' last twice as long as the reference hops.
+PRESETS = {
+    'reference': {'sample_rate': SR, 'song_kept': SONG_KEPT, 'n_fft': N_FFT, 'hop_length': HOP_LENGTH,
+                  'kernel_size': KERNEL_SIZE, 'frame_size': FRAME_SIZE, 'hop_size': HOP_SIZE},
+    'balanced': {'sample_rate': 22050, 'song_kept': 0.3, 'n_fft': 1024, 'hop_length': 256,
+                 'kernel_size': (13, 31), 'frame_size': 8192, 'hop_size': 1024},
+    'fast': {'sample_rate': 11025, 'song_kept': 0.2, 'n_fft': 512, 'hop_length': 256,
+             'kernel_size': (7, 17), 'frame_size': 4096, 'hop_size': 1024},
+}
+
+
+def decompose_harmonic(audio, n_fft=N_FFT, hop_length=HOP_LENGTH, kernel_size=KERNEL_SIZE):
     """Given the audio of a loop, applies source separation
     from librosa to extract only the harmonic part
 
     :param audio: Audio sample arrangement (1xn)
+    :param n_fft: STFT size
+    :param hop_length: STFT hop
+    :param kernel_size: HPSS median filter sizes (harmonic, percussive)
+    :return: Arrangement of the harmonic part of the audio samples (1xn)
+    """
+
+    decomposed = librosa.stft(audio, n_fft=n_fft, hop_length=hop_length)
+    return stft_to_harmonic(decomposed, n_fft, hop_length, kernel_size)
+
+
+def stft_to_harmonic(decomposed, n_fft=N_FFT, hop_length=HOP_LENGTH, kernel_size=KERNEL_SIZE):
+    """Second half of decompose_harmonic: applies source separation to the STFT of the audio,
+    and returns the harmonic part of the audio samples
+
+    :param decomposed: STFT of the audio (librosa.stft)
+    :param n_fft: STFT size
+    :param hop_length: STFT hop
+    :param kernel_size: HPSS median filter sizes (harmonic, percussive)
     :return: Arrangement of the harmonic part of the audio samples (1xn)
     """
 
-    decomposed = librosa.stft(audio)
     decomposed_harmonic, decomposed_percussive = \
-        librosa.decompose.hpss(decomposed,kernel_size=(13,31))
-    harmonic_part = librosa.istft(decomposed_harmonic)
+        librosa.decompose.hpss(decomposed,kernel_size=kernel_size)
+    harmonic_part = librosa.istft(decomposed_harmonic, hop_length=hop_length, n_fft=n_fft)
 
     return harmonic_part
 
-def audio_to_nnls(audio):
-    """Computes the NNNLS chroma from the audio
+def audio_to_chromagram(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+    """Computes the NNLS chroma of each frame of the audio, with the frontend
+    selected by CHROMA_FRONTEND
 
     :param audio: Audio sample arrangement
-    :return: A 12-dimensional chromagram (1x12), the result of averaging the chroma of each frame.
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames (frame i starts at sample i*hop_size)
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
     """
-    frame_size = 8192 + 1
+
+    if CHROMA_FRONTEND == 'numpy':
+        import chroma
+        return chroma.audio_to_chromagram(audio, sample_rate, frame_size, hop_size)
+    return essentia_chromagram(audio, sample_rate, frame_size, hop_size)
+
+def essentia_chromagram(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+    """Computes the NNLS chroma of each frame of the audio with essentia
+
+    :param audio: Audio sample arrangement
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames (frame i starts at sample i*hop_size)
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
+    """
+    spectrum_size = frame_size // 2 + 1
 
     window = Windowing(type='hann', normalized=False)
     spectrum = Spectrum()
-    logspectrum = LogSpectrum(frameSize=frame_size)
-    nnls = NNLSChroma(frameSize=frame_size, useNNLS=False)
+    logspectrum = LogSpectrum(frameSize=spectrum_size, sampleRate=sample_rate)
+    nnls = NNLSChroma(frameSize=spectrum_size, sampleRate=sample_rate, useNNLS=False)
 
     logfreqspectrogram = []
-    for frame in FrameGenerator(audio, frameSize=16384, hopSize=2048,
+    for frame in FrameGenerator(audio, frameSize=frame_size, hopSize=hop_size,
                                 startFromZero=True):
         logfreqspectrum, meanTuning, _ = logspectrum(spectrum(window(frame)))
         logfreqspectrogram.append(logfreqspectrum)
@@ -60,17 +123,93 @@ def audio_to_nnls(audio):
     tunedLogfreqSpectrum, semitoneSpectrum, bassChroma, chroma =\
     nnls(logfreqspectrogram, meanTuning,  np.array([]))
 
-    mean_chroma = np.mean(np.array(chroma).T, axis = 1)
     #Rotate the chroma so that it starts in C
-    mean_chroma = np.roll(mean_chroma,-3)
+    return np.roll(np.array(chroma), -3, axis=1)
+
+def audio_to_nnls(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+    """Computes the NNNLS chroma from the audio
+
+    :param audio: Audio sample arrangement
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames
+    :return: A 12-dimensional chromagram (1x12), the result of averaging the chroma of each frame.
+    """
 
-    return mean_chroma
+    return np.mean(audio_to_chromagram(audio, sample_rate, frame_size, hop_size), axis=0)
 
-def save_tiv (annotation_path,TIV):
-    """Saves the vector and energy values of the TIV in a .json file
+def get_analysis(preset='reference', spectral=False, windows=None, streaming=False):
+    """Returns the parameters of an analysis, as they are saved with the TIV
 
-    :param annotation_path: Path where the annotation .json file is saved
-    :param TIV: TIV instance with the values corresponding to the track analysis.
+    :param preset: Name of the analysis preset ('reference', 'balanced' or 'fast')
+    :param spectral: True if the chroma is computed with the spectral fast path
+    :param windows: Number of windows decoded and analyzed across the song (see sampling.py),
+            or None to analyze the decoded central part of the song
+    :param streaming: True if the song is decoded and analyzed block by block (see streaming.py).
+            Its TIVs are close to, but not the same as, the ones of the default analysis.
+    :return: Dictionary with the analysis parameters
+    """
+
+    if preset not in PRESETS:
+        raise ValueError("Unknown analysis preset: " + str(preset))
+    if streaming and (spectral or windows is not None):
+        raise ValueError("The streaming mode can not be combined with the spectral or sampled modes")
+    analysis = dict(PRESETS[preset], preset=preset, spectral=spectral)
+    analysis['kernel_size'] = list(analysis['kernel_size'])
+    if windows is not None:
+        if int(windows) < 1:
+            raise ValueError("The number of windows must be positive")
+        analysis['windows'] = int(windows)
+    if streaming:
+        analysis['streaming'] = True
+    return analysis
+
+def get_analysis_label(analysis):
+    """Returns a short name of an analysis, e.g. 'fast/spectral', 'reference/4w' or 'reference/streaming'
+
+    :param analysis: Dictionary with the analysis parameters
+    :return: The name of the preset, followed by '/spectral' for the spectral fast path,
+            by the number of windows of the sampled analysis and by '/streaming' for the streaming mode
+    """
+
+    return analysis['preset'] + ('/spectral' if analysis['spectral'] else '') + \
+        ('/%dw' % analysis['windows'] if analysis.get('windows') is not None else '') + \
+        ('/streaming' if analysis.get('streaming') else '')
+
+def get_annotation_path(song_path):
+    """Returns the path of the .json annotation of a song, inside the
+    "annotations" folder next to it
+
+    :param song_path: The path of the track
+    :return: The path of the annotation .json file
+    """
+
+    folder_path, song_name = ntpath.split(song_path)
+    return folder_path + '/annotations/' + song_name.replace(".mp3", ".json")
+
+def read_annotation (annotation_path):
+    """Reads all the fields of an annotation .json file
+
+    :param annotation_path: Path of the annotation .json file
+    :return: Dictionary with the content of the file (empty if the file does not exist or can not be read)
+    """
+
+    try:
+        with instrumentation.span('io', 'read_annotation', path=annotation_path) as event:
+            with open(annotation_path, 'r') as open_file:
+                text = open_file.read()
+            event.add_bytes(len(text))
+        content = json.loads(text)
+    except (IOError, ValueError):
+        return {}
+    return content if isinstance(content, dict) else {}
+
+def write_annotation (annotation_path, fields):
+    """Updates the given fields of an annotation .json file, keeping the other ones
+    (e.g. the intro and outro times of the dataset annotations)
+
+    :param annotation_path: Path of the annotation .json file
+    :param fields: Dictionary with the fields to write
     """
 
     class NumpyArrayEncoder(JSONEncoder):
@@ -78,18 +217,83 @@ def save_tiv (annotation_path,TIV):
         def default(self, obj):
             if isinstance(obj, np.ndarray):
                 return obj.tolist()
+            if isinstance(obj, np.generic):
+                return obj.item()
             return JSONEncoder.default(self, obj)
 
-    TIV_string = {"TIV.energy.real": TIV.energy.real, "TIV.energy.imag": TIV.energy.imag,
-                  "TIV.vector[0].real": TIV.vector[0].real, "TIV.vector[0].imag": TIV.vector[0].imag,
-                  "TIV.vector[1].real": TIV.vector[1].real, "TIV.vector[1].imag": TIV.vector[1].imag,
-                  "TIV.vector[2].real": TIV.vector[2].real, "TIV.vector[2].imag": TIV.vector[2].imag,
-                  "TIV.vector[3].real": TIV.vector[3].real, "TIV.vector[3].imag": TIV.vector[3].imag,
-                  "TIV.vector[4].real": TIV.vector[4].real, "TIV.vector[4].imag": TIV.vector[4].imag,
-                  "TIV.vector[5].real": TIV.vector[5].real, "TIV.vector[5].imag": TIV.vector[5].imag}
+    content = read_annotation(annotation_path)
+    content.update(fields)
+
+    # Write to a temporary file and rename it, so that an interrupted
+    # analysis never leaves a half-written annotation behind
+    temp_path = annotation_path + '.%d.tmp' % os.getpid()
+    with instrumentation.span('io', 'write_annotation', path=annotation_path) as event:
+        with open(temp_path, "w") as write_file:
+            json.dump(content, write_file, cls=NumpyArrayEncoder)
+            write_file.flush()
+            os.fsync(write_file.fileno())
+            event.add_bytes(write_file.tell())
+        os.replace(temp_path, annotation_path)
+
+def tiv_fields (TIV, analysis=None):
+    """Returns the annotation fields of a TIV: its vector and energy values, the Camelot
+    code of its estimated key and the parameters of the analysis that computed it
 
-    with open(annotation_path, "w") as write_file:
-        json.dump(TIV_string, write_file, cls=NumpyArrayEncoder)
+    :param TIV: TIV instance with the values corresponding to the track analysis.
+    :param analysis: Parameters of the analysis that computed the TIV. Default: reference analysis.
+    :return: Dictionary with the fields (see write_annotation)
+    """
+
+    return {"TIV.energy.real": TIV.energy.real, "TIV.energy.imag": TIV.energy.imag,
+            "TIV.vector[0].real": TIV.vector[0].real, "TIV.vector[0].imag": TIV.vector[0].imag,
+            "TIV.vector[1].real": TIV.vector[1].real, "TIV.vector[1].imag": TIV.vector[1].imag,
+            "TIV.vector[2].real": TIV.vector[2].real, "TIV.vector[2].imag": TIV.vector[2].imag,
+            "TIV.vector[3].real": TIV.vector[3].real, "TIV.vector[3].imag": TIV.vector[3].imag,
+            "TIV.vector[4].real": TIV.vector[4].real, "TIV.vector[4].imag": TIV.vector[4].imag,
+            "TIV.vector[5].real": TIV.vector[5].real, "TIV.vector[5].imag": TIV.vector[5].imag,
+            "camelot": tiv_camelot_code(TIV),
+            "analysis": analysis if analysis is not None else get_analysis()}
+
+def save_tiv (annotation_path,TIV,analysis=None):
+    """Saves the vector and energy values of the TIV in a .json file, together with
+    the Camelot code of its estimated key
+
+    :param annotation_path: Path where the annotation .json file is saved
+    :param TIV: TIV instance with the values corresponding to the track analysis.
+    :param analysis: Parameters of the analysis that computed the TIV. Default: reference analysis.
+    """
+
+    write_annotation(annotation_path, tiv_fields(TIV, analysis))
+
+def annotation_analysis (annotation):
+    """Returns the parameters of the analysis that computed the TIV of an annotation
+
+    :param annotation: Dictionary with the content of an annotation .json file
+    :return: Dictionary with the analysis parameters (annotations saved before the analysis
+            presets existed come from the reference analysis)
+    """
+
+    return annotation.get('analysis', get_analysis())
+
+def load_annotation (annotation_path):
+    """Loads the TIV and the analysis parameters from a given .json file
+
+    :param annotation_path: Annotation path to automatically generated .json file.
+    :return: TIV instance (defined in tivlib.py) with the value of the track-specific vectors and energy,
+            and the parameters of the analysis that computed it (annotations saved before the analysis
+            presets existed come from the reference analysis).
+    """
+
+    with instrumentation.span('io', 'load_annotation', path=annotation_path) as event:
+        with open(annotation_path, 'r') as open_file:
+            text = open_file.read()
+        event.add_bytes(len(text))
+    TIV_dict = json.loads(text)
+    energy = complex(float(TIV_dict['TIV.energy.real']), float(TIV_dict['TIV.energy.imag']))
+    vector = np.array([complex(float(TIV_dict['TIV.vector[%d].real' % i]), float(TIV_dict['TIV.vector[%d].imag' % i]))
+                       for i in range(6)])
+    tiv = TIV(energy, vector)
+    return tiv, annotation_analysis(TIV_dict)
 
 def load_tiv (annotation_path):
     """Loads the vector and energy values of the TIV from a given .json file
@@ -98,62 +302,190 @@ def load_tiv (annotation_path):
     :return: TIV instance (defined in tivlib.py) with the value of the track-specific vectors and energy.
     """
 
-    chroma_ref = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-    tiv = TIV.from_pcp(chroma_ref)
-    open_file=open(annotation_path, 'r')
-    TIV_dict= json.load(open_file)
-    open_file.close()
-    tiv.energy = complex(float(TIV_dict['TIV.energy.real']), float(TIV_dict['TIV.energy.imag']))
-    temp = [np.complex(float(TIV_dict['TIV.vector[0].real']), float(TIV_dict['TIV.vector[0].imag'])),
-                  np.complex(float(TIV_dict['TIV.vector[1].real']), float(TIV_dict['TIV.vector[1].imag'])),
-                  np.complex(float(TIV_dict['TIV.vector[2].real']), float(TIV_dict['TIV.vector[2].imag'])),
-                  np.complex(float(TIV_dict['TIV.vector[3].real']), float(TIV_dict['TIV.vector[3].imag'])),
-                  np.complex(float(TIV_dict['TIV.vector[4].real']), float(TIV_dict['TIV.vector[4].imag'])),
-                  np.complex(float(TIV_dict['TIV.vector[5].real']), float(TIV_dict['TIV.vector[5].imag']))]
-    tiv.vector = np.asarray(temp)
-    return tiv
+    return load_annotation(annotation_path)[0]
+
+def is_analyzed (song_path, analysis):
+    """Checks if a song already has an annotation computed with the given analysis,
+    from the current content of the audio file (see cache.py)
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters
+    :return: True if the annotation exists and was computed with the same parameters and audio
+    """
+
+    from cache import content_matches
+    annotation_path = get_annotation_path(song_path)
+    try:
+        analyzed = load_annotation(annotation_path)[1] == analysis
+    except (IOError, KeyError, TypeError, ValueError):
+        analyzed = False
+    if analyzed:
+        analyzed = content_matches(song_path, read_annotation(annotation_path))
+    instrumentation.emit('cache', 'annotation', result='hit' if analyzed else 'miss', path=song_path)
+    return analyzed
+
+
+def decode_file (song_path, sample_rate=SR):
+    """Loads a whole song with MonoLoader (essentia), or with librosa if essentia is not installed,
+    without the feature cache
+
+    :param song_path: The path of the track
+    :param sample_rate: Sample rate of the decoded audio
+    :return: Audio samples of the song
+    """
+
+    with instrumentation.span('stage', 'decode', path=song_path) as event:
+        if DECODER == 'essentia':
+            song_audio = MonoLoader(filename=song_path, sampleRate=sample_rate)()
+        else:
+            song_audio, _ = librosa.load(song_path, sr=sample_rate, mono=True)
+        event.add_bytes(song_audio.nbytes)
+    return song_audio
+
 
+def decode_audio (song_path, analysis):
+    """Loads a whole song (see decode_file). The decoded audio is read from the feature
+    cache when it is enabled (see feature_cache.py).
 
-def analyze_song (song_path):
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters (see get_analysis)
+    :return: Audio samples of the song
+    """
+
+    from feature_cache import cached
+    return cached(song_path, 'audio', analysis, lambda: decode_file(song_path, analysis['sample_rate']))
+
+
+def cut_song (song_audio, song_kept=SONG_KEPT):
+    """Cuts a song, keeping its central part
+
+    :param song_audio: Audio samples of the song
+    :param song_kept: Part of the song that is kept (0-1)
+    :return: Audio samples of the kept part of the song
+    """
+
+    kept = song_kept / 2
+    return song_audio[int(song_audio.size / 2 - song_audio.size * kept):int(
+        song_audio.size / 2 + song_audio.size * kept)]
+
+
+def decode_song (song_path, analysis):
+    """Loads a song with MonoLoader (essentia) and cuts it, keeping the central part
+    (see decode_audio and cut_song)
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters (see get_analysis)
+    :return: Audio samples of the kept part of the song
+    """
+
+    return cut_song(decode_audio(song_path, analysis), analysis['song_kept'])
+
+
+def harmonic_part (song_path, analysis, song_audio=None):
+    """Computes the harmonic part of a song: the harmonic audio (decompose_harmonic), or the harmonic
+    magnitude spectrogram with the spectral fast path (see spectral.py). It is read from the feature
+    cache when it is enabled, without decoding the song (see feature_cache.py).
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters (see get_analysis)
+    :param song_audio: Audio of the song, as returned by decode_song. Decoded if needed when not given.
+    :return: Harmonic audio (1xn), or harmonic magnitude spectrogram (number of frames x frame_size/2+1)
+    """
+
+    def separate():
+        audio = decode_song(song_path, analysis) if song_audio is None else song_audio
+        if analysis['spectral']:
+            from spectral import harmonic_spectrogram, spectral_kernel_size
+            with instrumentation.span('stage', 'harmonic_spectrogram', path=song_path):
+                return harmonic_spectrogram(audio, analysis['sample_rate'], analysis['frame_size'],
+                                            analysis['hop_size'], spectral_kernel_size(analysis))
+        with instrumentation.span('stage', 'decompose_harmonic', path=song_path):
+            return decompose_harmonic(audio, analysis['n_fft'], analysis['hop_length'], analysis['kernel_size'])
+
+    from feature_cache import cached
+    return cached(song_path, 'harmonic', analysis, separate)
+
+
+def save_analysis (song_path, tiv, analysis):
+    """Saves the TIV of an analyzed song in its annotation, together with the
+    content hash of the audio file (see cache.py)
+
+    :param song_path: The path of the track
+    :param tiv: TIV instance with the values corresponding to the track analysis.
+    :param analysis: Dictionary with the analysis parameters
+    """
+
+    annotation_path = get_annotation_path(song_path)
+    os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+    from cache import content_fields
+    fields = tiv_fields(tiv, analysis)
+    # The segments of the previous analysis come from other parameters or audio
+    fields["segments"] = None
+    fields.update(content_fields(song_path))
+    write_annotation(annotation_path, fields)
+
+
+def analyze_song (song_path, streaming=False, spectral=False, preset='reference', windows=None):
     """
     Computes the TIV from a given song (path)
         0) Checks if the file exists
         1) Loads the song with MonoLoader (essentia)
         2) Cuts the song
         3) Retrives percusive part applying source separation (librosa)
-        4) Computes NNLS chroma (essentia)
+        4) Computes NNLS chroma (essentia, or NumPy: see CHROMA_FRONTEND)
         5) Computes TIV (tivlib)
         6) Saves results
+    Steps 1) to 3) are skipped when the feature cache has the harmonic part of the song (see feature_cache.py).
 
     :param song_path: The path of the track you want to analyze
+    :param streaming: If True, steps 1) to 4) are computed block by block (see streaming.py),
+            with a memory use that does not depend on the length of the track.
+            The streaming mode is saved with the TIV (see get_analysis).
+    :param spectral: If True, steps 3) and 4) are computed from the harmonic spectrogram,
+            without inverse STFT (see spectral.py).
+    :param preset: Name of the analysis preset (see PRESETS). The preset is saved with the TIV, and
+            songs analyzed with another preset are analyzed again.
+    :param windows: If given, steps 1) to 5) are computed on this number of windows spread across the
+            song, decoded by seeking, and their TIVs are combined (see sampling.py).
     """
 
     folder_path, song_name = ntpath.split(song_path)
 
-    annotation_path = folder_path + '/annotations/' + song_name.replace(".mp3", ".json")
+    analysis = get_analysis(preset, spectral, windows, streaming)
 
-    if os.path.isfile(annotation_path):
+    if is_analyzed(song_path, analysis):
         # File exist
         print(song_name.replace(".mp3", "") + ' already analyzed')
     else:
-        # File doesn't exist
+        # File doesn't exist (or was analyzed with other parameters, or the audio changed)
         print('Analyzing ' + song_name.replace(".mp3", ""))
-        song_audio = MonoLoader(filename=song_path, sampleRate=SR)()
-
-        kept = SONG_KEPT / 2
-        song_audio = song_audio[int(song_audio.size / 2 - song_audio.size * kept):int(
-            song_audio.size / 2 + song_audio.size * kept)]
-
-        harmonic = decompose_harmonic(song_audio)
-
-        chroma = audio_to_nnls(harmonic)
-        tiv = TIV.from_pcp(chroma)
-
-        os.makedirs(folder_path + '/annotations/', exist_ok=True)
-        save_tiv(annotation_path, tiv)
-
-
-def compare_songs(current_song_path, candidate_song_path, transpose_candidate=0):
+        tiv = None
+        if streaming:
+            from streaming import streaming_chroma
+            with instrumentation.span('stage', 'streaming_chroma', path=song_path):
+                chroma = streaming_chroma(song_path, analysis)
+        elif windows is not None:
+            from sampling import sampled_tiv
+            tiv = sampled_tiv(song_path, analysis)
+        else:
+            harmonic = harmonic_part(song_path, analysis)
+
+            if spectral:
+                from spectral import spectrogram_to_chromagram
+                with instrumentation.span('stage', 'spectral_chroma', path=song_path):
+                    chroma = np.mean(spectrogram_to_chromagram(harmonic, analysis['sample_rate']), axis=0)
+            else:
+                with instrumentation.span('stage', 'audio_to_nnls', path=song_path):
+                    chroma = audio_to_nnls(harmonic, analysis['sample_rate'], analysis['frame_size'],
+                                           analysis['hop_size'])
+        if tiv is None:
+            with instrumentation.span('stage', 'from_pcp', path=song_path):
+                tiv = TIV.from_pcp(chroma)
+
+        save_analysis(song_path, tiv, analysis)
+
+
+def compare_songs(current_song_path, candidate_song_path, transpose_candidate=0, mix_points=False):
     """
     Computes harmonic compatibility between two given songs (paths).
     Also suggests the amount of pitch shift transpisition to maximize
@@ -163,30 +495,32 @@ def compare_songs(current_song_path, candidate_song_path, transpose_candidate=0)
     :param candidate_song_path: The path of the candidate track
     :param transpose_candidate: An interval (in positive or negative semitones) with which the
             pitch transposition of the candidate track will be simulated. Default zero.
+    :param mix_points: If True, the outro of the target track is compared with the intro of the
+            candidate track, where both tracks overlap in a mix (see segments.py). Default: whole tracks.
     :return: The harmonic compatibility between the target track and each of the other tracks in the folder, all in their original versions.
             The suggested pitch transposition interval (in semitones) that would maximize harmonic compatibility.
             The resulting harmonic compatibility if the suggested pitch transposition were applied.
     """
 
-    current_folder_path, current_song_name = ntpath.split(current_song_path)
-    candidate_folder_path, candidate_song_name = ntpath.split(candidate_song_path)
-
-    current_annotation_path = current_folder_path + '/annotations/' \
-                              + current_song_name.replace(".mp3", ".json")
-    candidate_annotation_path = candidate_folder_path + '/annotations/' \
-                                + candidate_song_name.replace(".mp3", ".json")
-
-    TIV_current = load_tiv(current_annotation_path)
-    TIV_candidate = load_tiv(candidate_annotation_path)
-    TIV_candidate.transpose(transpose_candidate, inplace=True)
-
-    harmonic_compatibility = TIV_candidate.small_scale_compatibility(TIV_current)
-    harmonic_compatibility = 100 * (1 - np.mean(harmonic_compatibility))
-
-    pitch_shift, min_small_scale_comp = TIV_current.get_max_compatibility(TIV_candidate)
-    min_small_scale_comp = 100 * (1 - np.mean(min_small_scale_comp))
-
-    return scale(harmonic_compatibility), pitch_shift, scale(min_small_scale_comp)
+    with instrumentation.span('comparison', 'compare_songs', path=candidate_song_path):
+        if mix_points:
+            from segments import load_region
+            TIV_current, current_analysis = load_region(current_song_path, 'outro')
+            TIV_candidate, candidate_analysis = load_region(candidate_song_path, 'intro')
+        else:
+            TIV_current, current_analysis = load_annotation(get_annotation_path(current_song_path))
+            TIV_candidate, candidate_analysis = load_annotation(get_annotation_path(candidate_song_path))
+        if current_analysis != candidate_analysis:
+            raise ValueError("The songs were analyzed with different analysis parameters")
+        TIV_candidate.transpose(transpose_candidate, inplace=True)
+
+        harmonic_compatibility = TIV_candidate.small_scale_compatibility(TIV_current)
+        harmonic_compatibility = 100 * (1 - np.mean(harmonic_compatibility))
+
+        pitch_shift, min_small_scale_comp = TIV_current.get_max_compatibility(TIV_candidate)
+        min_small_scale_comp = 100 * (1 - np.mean(min_small_scale_comp))
+
+        return scale(harmonic_compatibility), pitch_shift, scale(min_small_scale_comp)
 
 def scale(not_scaled_number):
     """Harmonic compatibility values range from 70% to 100%
@@ -0,0 +1,172 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module analyzes a list of tracks as a pipeline of three stages,
+so that the decoding of the next tracks overlaps with the separation and
+the chroma of the previous ones:
+    decode     -- MonoLoader and cut of the song (I/O and codec work)
+    separation -- harmonic part of the audio (decompose_harmonic), or
+                  harmonic spectrogram with the spectral fast path
+    chroma     -- NNLS chroma, TIV and annotation
+
+Each stage has its own pool of threads, and the stages are connected
+by bounded queues. A stage waits when the queue of the next one is
+full (backpressure), so the number of decoded songs held in memory is
+bounded whatever the speed of each stage. The NumPy, librosa and
+essentia calls of the stages release the GIL for most of their work.
+Tracks whose harmonic part is in the feature cache (see
+feature_cache.py) skip the decode and separation work.
+
+The pipeline is an alternative to the process pool of batch.py when
+decoding is slow compared to the analysis, e.g. with tracks stored on
+network-mounted storage."""
+
+import argparse
+import os
+import queue
+import threading
+from harmonic_mix.tivlib import TIV
+from main import PRESETS, get_analysis, decode_song, harmonic_part, audio_to_nnls, save_analysis
+import feature_cache
+from batch import list_songs, pending_songs
+
+STAGES = ['decode', 'separation', 'chroma']
+QUEUE_SIZE = 2  # songs waiting between two stages, per worker of the next stage
+_DONE = object()  # end of the songs of a queue
+
+
+def _chroma(harmonic, analysis):
+    if analysis['spectral']:
+        from spectral import spectrogram_to_chromagram
+        return spectrogram_to_chromagram(harmonic, analysis['sample_rate']).mean(axis=0)
+    return audio_to_nnls(harmonic, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+
+
+class AnalysisPipeline:
+    """
+    Analyzes tracks with a pipeline of decode, separation and chroma stages
+    """
+
+    def __init__(self, preset='reference', spectral=False, workers=None, queue_size=QUEUE_SIZE):
+        """
+        :param preset: Name of the analysis preset (see main.PRESETS)
+        :param spectral: If True, the chroma is computed with the spectral fast path
+        :param workers: Dictionary with the number of threads of each stage (see STAGES).
+                Default: 2 decode threads, and the rest of the CPUs split between the other stages.
+        :param queue_size: Songs waiting between two stages, per thread of the next stage
+        """
+        self.analysis = get_analysis(preset, spectral)
+        cpus = os.cpu_count() or 1
+        self.workers = {'decode': 2, 'separation': max(1, (cpus - 1) // 2), 'chroma': max(1, cpus // 2)}
+        self.workers.update(workers or {})
+        self.queue_size = queue_size
+
+    def run(self, song_paths, progress=None, cancel=None):
+        """
+        Analyzes tracks that have not been analyzed yet
+
+        :param song_paths: List with the paths of the tracks
+        :param progress: Optional function called as progress(done, total, song_path, error)
+                every time a track is finished (see batch.analyze_songs)
+        :param cancel: Optional threading.Event. Once it is set, no more tracks are decoded,
+                and the tracks already decoded are finished.
+        :return: Dictionary with the error message of every track whose analysis failed
+        """
+
+        songs = pending_songs(song_paths, self.analysis)
+        queues = [queue.Queue(maxsize=self.queue_size * self.workers[stage]) for stage in STAGES]
+        errors = {}
+        done = [0]
+        lock = threading.Lock()
+
+        def finish(song_path, error):
+            with lock:
+                done[0] += 1
+                if error is not None:
+                    errors[song_path] = error
+                if progress is not None:
+                    progress(done[0], len(songs), song_path, error)
+
+        # Songs whose harmonic part is in the feature cache are not decoded
+        functions = [lambda song_path, _: None if feature_cache.contains(song_path, 'harmonic', self.analysis)
+                     else decode_song(song_path, self.analysis),
+                     lambda song_path, audio: harmonic_part(song_path, self.analysis, audio),
+                     lambda song_path, harmonic: save_analysis(song_path, TIV.from_pcp(
+                         _chroma(harmonic, self.analysis)), self.analysis)]
+
+        def worker(stage):
+            inputs = queues[stage]
+            outputs = queues[stage + 1] if stage + 1 < len(STAGES) else None
+            while True:
+                item = inputs.get()
+                if item is _DONE:
+                    return
+                song_path, data = item
+                try:
+                    result = functions[stage](song_path, data)
+                except Exception as error:
+                    finish(song_path, repr(error))
+                    continue
+                del item, data  # the input of the stage is released before waiting for the next one
+                if outputs is None:
+                    finish(song_path, None)
+                else:
+                    outputs.put((song_path, result))
+
+        threads = [[threading.Thread(target=worker, args=(stage,), daemon=True)
+                    for _ in range(self.workers[name])] for stage, name in enumerate(STAGES)]
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        # The songs are fed from this thread: it waits while the decode queue is full
+        for song_path in songs:
+            if cancel is not None and cancel.is_set():
+                break
+            queues[0].put((song_path, None))
+
+        # Each stage is closed once the previous one has finished
+        for stage, stage_threads in enumerate(threads):
+            for _ in stage_threads:
+                queues[stage].put(_DONE)
+            for thread in stage_threads:
+                thread.join()
+        return errors
+
+
+def analyze_pipelined(song_paths, preset='reference', spectral=False, workers=None, progress=None, cancel=None):
+    """
+    Analyzes tracks with a pipeline of decode, separation and chroma stages
+
+    :param song_paths: List with the paths of the tracks
+    :param preset, spectral, workers: As in AnalysisPipeline
+    :param progress, cancel: As in AnalysisPipeline.run
+    :return: Dictionary with the error message of every track whose analysis failed
+    """
+
+    return AnalysisPipeline(preset, spectral, workers).run(song_paths, progress, cancel)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Analyze the tracks of music folders with a pipeline of stages")
+    parser.add_argument('folders', nargs='+', help="music folders")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    parser.add_argument('--spectral', action='store_true', help="use the spectral fast path")
+    parser.add_argument('--decode-workers', type=int, default=None, help="threads of the decode stage")
+    parser.add_argument('--separation-workers', type=int, default=None, help="threads of the separation stage")
+    parser.add_argument('--chroma-workers', type=int, default=None, help="threads of the chroma stage")
+    args = parser.parse_args()
+
+    workers = {stage: getattr(args, stage + '_workers') for stage in STAGES
+               if getattr(args, stage + '_workers') is not None}
+
+    def print_progress(done, total, song_path, error):
+        status = 'failed: ' + error if error is not None else 'done'
+        print(round(done * 100 / total, 1), '% progress completed -', os.path.basename(song_path), status)
+
+    song_paths = [song_path for folder in args.folders for song_path in list_songs(folder)]
+    errors = analyze_pipelined(song_paths, args.preset, args.spectral, workers, print_progress)
+    print("Analysis completed" if not errors else "Analysis completed, %d tracks failed" % len(errors))
@@ -0,0 +1,199 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module keeps the TIVs of a music folder in memory and caches the
+rankings of the recently selected target tracks. The graphical
+interfaces can then switch between targets and sort a ranking by any
+column without reading the annotations or comparing the tracks again.
+
+A ranking holds the HC, T and THC values (see main.compare_songs) of
+every track of the folder with respect to a target track. The rankings
+are computed with a single compatibility.compatibility_matrices call
+over the in-memory TIVs. The most recently used rankings are kept, and
+the least recently used one is evicted when the cache is full.
+
+Tracks can be read again while the rankings are cached, e.g. as soon as
+they are analyzed. Only the rows of those tracks are computed again in
+the cached rankings, and the rankings of targets that were read again
+are discarded."""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from compatibility import compatibility_matrices
+from main import get_annotation_path, load_annotation
+
+COLUMNS = ['HC', 'T', 'THC']
+RANKING_CACHE_SIZE = 16  # rankings kept in memory
+
+
+class Ranking:
+    """
+    Harmonic compatibility of every track of a folder with respect to a target track.
+    Tracks that are not analyzed (or were analyzed with other parameters than the
+    target) have NaN values.
+    """
+
+    def __init__(self, current_song_path, song_paths, harmonic_compatibility, pitch_shift, min_small_scale_comp):
+        self.current_song_path = current_song_path
+        self.song_paths = song_paths
+        self.values = {'HC': harmonic_compatibility, 'T': pitch_shift, 'THC': min_small_scale_comp}
+        self._orders = {}
+
+    def __len__(self):
+        return len(self.song_paths)
+
+    def order(self, column=None, descending=True):
+        """
+        Sorts the tracks by one of the columns. Sorted orders are computed once per ranking.
+
+        :param column: 'HC', 'T', 'THC', or None for the folder order
+        :param descending: If True, the highest values come first
+        :return: Array with the index of the tracks, in display order. Tracks without values come last.
+        """
+        if column is None:
+            return np.arange(len(self.song_paths))
+        if column not in self.values:
+            raise ValueError("Unknown ranking column: " + str(column))
+        key = (column, descending)
+        if key not in self._orders:
+            values = self.values[column]
+            # NaN values are sorted last in both directions; ties keep the folder order
+            self._orders[key] = np.argsort(-values if descending else values, kind='stable')
+        return self._orders[key]
+
+    def row(self, index):
+        """
+        :param index: Index of a track
+        :return: (song path, HC, T, THC) tuple, with None values if the track has no values
+        """
+        harmonic_compatibility = self.values['HC'][index]
+        if np.isnan(harmonic_compatibility):
+            return self.song_paths[index], None, None, None
+        return (self.song_paths[index], float(harmonic_compatibility), int(self.values['T'][index]),
+                float(self.values['THC'][index]))
+
+
+class LibraryCache:
+    """
+    In-memory TIVs of the tracks of a music folder, with a least recently
+    used cache of rankings. It can be used from several threads.
+    """
+
+    def __init__(self, song_paths, capacity=RANKING_CACHE_SIZE):
+        """
+        :param song_paths: List with the paths of the tracks, in folder order
+        :param capacity: Number of rankings kept in memory
+        """
+        self.song_paths = list(song_paths)
+        self.positions = {song_path: position for position, song_path in enumerate(self.song_paths)}
+        self.capacity = capacity
+        self.vectors = np.zeros((len(self.song_paths), 6), dtype=np.complex128)
+        self.analyzed = np.zeros(len(self.song_paths), dtype=bool)
+        self.analyses = [None] * len(self.song_paths)
+        self._rankings = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()  # loads run one at a time, so a later read is never overwritten
+
+    def load(self, song_paths=None):
+        """
+        Reads the TIVs of tracks from their annotations, e.g. after they were analyzed.
+        The rows of those tracks are computed again in the cached rankings, and the
+        rankings whose target track is read are discarded.
+
+        :param song_paths: List with the paths of the tracks to read. Default: all the tracks.
+        :return: Number of analyzed tracks read
+        """
+        song_paths = self.song_paths if song_paths is None else song_paths
+        with self._loading:
+            loaded = []
+            for song_path in song_paths:
+                if song_path not in self.positions:
+                    continue
+                try:
+                    tiv, analysis = load_annotation(get_annotation_path(song_path))
+                except (IOError, KeyError, TypeError, ValueError):
+                    tiv, analysis = None, None
+                loaded.append((self.positions[song_path], tiv, analysis))
+
+            with self._lock:
+                for position, tiv, analysis in loaded:
+                    self.analyzed[position] = tiv is not None
+                    self.analyses[position] = analysis
+                    if tiv is not None:
+                        self.vectors[position] = tiv.vector
+                self._update_rankings(np.unique([position for position, _, _ in loaded]).astype(int))
+        return sum(tiv is not None for _, tiv, _ in loaded)
+
+    def _compare(self, position, positions):
+        """
+        HC, T and THC values of tracks with respect to a target track. Called with the lock held.
+
+        :param position: Index of the target track
+        :param positions: Array with the index of the candidate tracks
+        :return: List with the values of each column, NaN for the tracks that are not analyzed
+                (or were analyzed with other parameters than the target)
+        """
+        analysis = self.analyses[position]
+        comparable = np.array([self.analyzed[candidate] and self.analyses[candidate] == analysis
+                               for candidate in positions], dtype=bool)
+        values = [np.full(len(positions), np.nan) for _ in COLUMNS]
+        if comparable.any():
+            matrices = compatibility_matrices(self.vectors[position:position + 1], self.vectors[positions[comparable]])
+            for column, value in zip(values, matrices):
+                column[comparable] = value[0]
+        return values
+
+    def _update_rankings(self, positions):
+        """Computes again the rows of tracks in the cached rankings. Called with the lock held."""
+        if not len(positions):
+            return
+        for current_song_path, ranking in list(self._rankings.items()):
+            position = self.positions[current_song_path]
+            if np.any(positions == position):
+                del self._rankings[current_song_path]
+                continue
+            values = [ranking.values[column].copy() for column in COLUMNS]
+            for column, value in zip(values, self._compare(position, positions)):
+                column[positions] = value
+            # A new Ranking, as the interfaces may be displaying the previous one
+            self._rankings[current_song_path] = Ranking(current_song_path, self.song_paths, *values)
+
+    def is_analyzed(self, song_path):
+        return bool(self.analyzed[self.positions[song_path]])
+
+    def cached(self, current_song_path):
+        """
+        :param current_song_path: The path of the target track
+        :return: The cached ranking of the target track, or None if it is not cached
+        """
+        with self._lock:
+            ranking = self._rankings.get(current_song_path)
+            if ranking is not None:
+                self._rankings.move_to_end(current_song_path)
+            return ranking
+
+    def ranking(self, current_song_path):
+        """
+        Ranks the tracks of the folder with respect to a target track, or takes the ranking from the cache
+
+        :param current_song_path: The path of the target track (an analyzed track of the folder)
+        :return: Ranking object
+        """
+        ranking = self.cached(current_song_path)
+        if ranking is not None:
+            return ranking
+
+        with self._lock:
+            position = self.positions[current_song_path]
+            if not self.analyzed[position]:
+                raise ValueError("%s is not analyzed" % current_song_path)
+            values = self._compare(position, np.arange(len(self.song_paths)))
+            ranking = Ranking(current_song_path, self.song_paths, *values)
+
+            self._rankings[current_song_path] = ranking
+            while len(self._rankings) > self.capacity:
+                self._rankings.popitem(last=False)
+            return ranking
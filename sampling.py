@@ -0,0 +1,100 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module analyzes a song from a few windows spread across it,
+decoding only those windows: the audio file is read from the start of
+each window (seek) instead of being decoded whole and cut afterwards.
+
+The song is divided in as many equal sections as windows, and each
+window is centred in its section. The windows add up to the same
+fraction of the song as the cut of the default analysis (song_kept),
+so with one window the central part of the song is analyzed, and with
+more windows the same amount of audio covers the whole track.
+
+Each window is source separated and its NNLS chroma computed as in
+analyze_song. The TIVs of the windows are merged with TIV.combine, which
+weights each window by its energy. The decoding and the separation cost
+scale with the audio that is analyzed, not with the length of the
+track."""
+
+import numpy as np
+import soundfile
+from harmonic_mix.tivlib import TIV
+import instrumentation
+from main import decompose_harmonic, audio_to_nnls
+
+
+def window_ranges(frames, song_kept, windows):
+    """Returns the windows analyzed in a song
+
+    :param frames: Length of the song, in samples
+    :param song_kept: Fraction of the song covered by all the windows
+    :param windows: Number of windows
+    :return: List of (start, stop) samples of each window
+    """
+
+    length = frames * song_kept / windows
+    centres = (np.arange(windows) + 0.5) * frames / windows
+    return [(int(centre - length / 2), int(centre + length / 2)) for centre in centres]
+
+
+def decode_range(song_path, start, stop, sample_rate):
+    """Decodes a part of a song, seeking to its start
+
+    :param song_path: The path of the track
+    :param start: First sample of the part, at the sample rate of the file
+    :param stop: Sample after the part, at the sample rate of the file
+    :param sample_rate: Sample rate of the decoded audio
+    :return: Mono float32 audio samples
+    """
+
+    with instrumentation.span('stage', 'decode', path=song_path) as event:
+        audio, file_sample_rate = soundfile.read(song_path, start=start, stop=stop, dtype='float32', always_2d=True)
+        audio = audio.mean(axis=1)
+        if file_sample_rate != sample_rate:
+            import soxr
+            audio = soxr.resample(audio, file_sample_rate, sample_rate)
+        event.add_bytes(audio.nbytes)
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+
+def window_tiv(song_path, audio, analysis):
+    """Computes the TIV of a window of a song, as analyze_song does for the cut song
+
+    :param song_path: The path of the track
+    :param audio: Audio samples of the window
+    :param analysis: Dictionary with the analysis parameters (see main.get_analysis)
+    :return: TIV instance
+    """
+
+    if analysis['spectral']:
+        from spectral import spectral_chroma, spectral_kernel_size
+        with instrumentation.span('stage', 'spectral_chroma', path=song_path):
+            chroma = spectral_chroma(audio, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'],
+                                     spectral_kernel_size(analysis))
+    else:
+        with instrumentation.span('stage', 'decompose_harmonic', path=song_path):
+            harmonic = decompose_harmonic(audio, analysis['n_fft'], analysis['hop_length'], analysis['kernel_size'])
+        with instrumentation.span('stage', 'audio_to_nnls', path=song_path):
+            chroma = audio_to_nnls(harmonic, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+    return TIV.from_pcp(chroma)
+
+
+def sampled_tiv(song_path, analysis):
+    """Computes the TIV of a song from the windows given by the analysis parameters
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters, with the number of 'windows'
+            (see main.get_analysis)
+    :return: TIV instance. Its energy is the mean energy of the windows, as the energy of
+            the TIV of the mean chroma of the cut song.
+    """
+
+    info = soundfile.info(song_path)
+    tiv = None
+    for start, stop in window_ranges(info.frames, analysis['song_kept'], analysis['windows']):
+        window = window_tiv(song_path, decode_range(song_path, start, stop, analysis['sample_rate']), analysis)
+        tiv = window if tiv is None else tiv.combine(window)
+    return TIV(tiv.energy / analysis['windows'], tiv.vector)
@@ -0,0 +1,142 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module finds the k tracks of a library that are most
+harmonically compatible with a target track, optionally allowing pitch
+transpositions of the candidates.
+
+The index holds the 12 transpositions of every TIV in their real form
+(12 real values per transposition). For a given candidate, the small
+scale compatibility only decreases when the inner product between the
+target and the transposed candidate grows, so a single product with the
+index gives the best transposition of every track. The tracks whose
+score is close to the k-th best are then re-ranked with the exact small
+scale compatibility, so the ranking is the same as the one of the
+brute-force comparison."""
+
+import numpy as np
+from harmonic_mix.tivlib import TIV, max_compatibilities, transpose_vectors
+from compatibility import library_vectors
+from main import scale
+
+SHORTLIST_TOLERANCE = 1e-4  # margin on the float32 scores of the shortlisted candidates
+
+
+class CompatibilityIndex:
+    """
+    Top-k harmonic compatibility search over the TIVs of a music library
+    """
+
+    def __init__(self, track_ids, vectors, energies=None):
+        """
+        Builds the index
+
+        :param track_ids: List of track ids
+        :param vectors: TIV vectors of the tracks (Nx6), or anything accepted by compatibility.library_vectors
+        :param energies: Energies of the TIVs (N). Default: ones
+        """
+        self.track_ids = list(track_ids)
+        self.positions = {track_id: position for position, track_id in enumerate(self.track_ids)}
+        self.vectors = np.array(library_vectors(vectors))  # copied, as add updates them in place
+        self.energies = np.ones(len(self.vectors)) if energies is None else np.array(energies)
+        if len(self.track_ids) != len(self.vectors):
+            raise ValueError("There must be one TIV per track id")
+
+        rotated = transpose_vectors(self.vectors)
+        self.index = np.concatenate((rotated.real, rotated.imag), axis=2).astype(np.float32)  # N x 12 x 12
+        self.norms = np.sum(np.abs(self.vectors) ** 2, axis=1).astype(np.float32)
+        self.weights_norm = np.linalg.norm(TIV.weights)
+
+    @classmethod
+    def from_library(cls, library):
+        """
+        Builds the index of a TIVLibrary
+
+        :param library: library.TIVLibrary instance
+        :return: CompatibilityIndex object
+        """
+        return cls(library.track_ids, np.array(library.vectors), np.array(library.energies))
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def add(self, track_ids, vectors, energies=None):
+        """
+        Adds tracks to the index. Tracks already in the index are updated in place.
+
+        :param track_ids: List of track ids
+        :param vectors: TIV vectors of the tracks (Nx6), or anything accepted by compatibility.library_vectors
+        :param energies: Energies of the TIVs (N). Default: ones
+        """
+        vectors = library_vectors(vectors)
+        energies = np.ones(len(vectors)) if energies is None else np.asarray(energies)
+        if len(track_ids) != len(vectors):
+            raise ValueError("There must be one TIV per track id")
+
+        new_ids = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in self.positions]
+        if new_ids:
+            n = len(self.track_ids)
+            self.track_ids.extend(new_ids)
+            self.positions.update((track_id, position) for position, track_id in enumerate(new_ids, start=n))
+            self.vectors = np.concatenate((self.vectors, np.zeros((len(new_ids), 6), dtype=self.vectors.dtype)))
+            self.energies = np.concatenate((self.energies, np.ones(len(new_ids), dtype=self.energies.dtype)))
+            self.index = np.concatenate((self.index, np.zeros((len(new_ids), 12, 12), dtype=np.float32)))
+            self.norms = np.concatenate((self.norms, np.zeros(len(new_ids), dtype=np.float32)))
+
+        positions = np.array([self.positions[track_id] for track_id in track_ids], dtype=int)
+        self.energies = self.energies.astype(np.result_type(self.energies, energies), copy=False)
+        rotated = transpose_vectors(vectors)
+        self.vectors[positions] = vectors
+        self.energies[positions] = energies
+        self.index[positions] = np.concatenate((rotated.real, rotated.imag), axis=2)
+        self.norms[positions] = np.sum(np.abs(vectors) ** 2, axis=1)
+
+    def _tiv(self, position):
+        return TIV(self.energies[position], self.vectors[position])
+
+    def top_k(self, query, k=10, max_shift=0, exclude_query=True):
+        """
+        Finds the k candidates most compatible with a target track
+
+        :param query: Track id of the target track, or its TIV
+        :param k: Number of candidates
+        :param max_shift: Candidates may be transposed up to this number of semitones (up or down).
+                Default zero: original versions only.
+        :param exclude_query: If the query is a track id, leave that track out of the results
+        :return: List of (track id, harmonic compatibility, pitch shift) tuples, best first. The harmonic
+                compatibility is the one of the candidate transposed by the pitch shift.
+        """
+        if isinstance(query, TIV):
+            query_tiv = query
+            excluded = None
+        else:
+            excluded = self.positions[query] if exclude_query else None
+            query_tiv = self._tiv(self.positions[query])
+
+        max_shift = min(abs(int(max_shift)), 6)
+        shifts = np.unique(np.arange(-max_shift, max_shift + 1) % 12)
+
+        # Best transposition of every track, from the inner products with the index
+        query_real = np.concatenate((query_tiv.vector.real, query_tiv.vector.imag)).astype(np.float32)
+        inner = (self.index.reshape(-1, 12) @ query_real).reshape(-1, 12)[:, shifts]
+        energy_sum = self.norms + np.float32(np.sum(np.abs(query_tiv.vector) ** 2))
+        cross = 2 * np.max(inner, axis=1)
+        scores = (1 - np.sqrt(np.maximum(energy_sum + cross, 0)) / (2 * self.weights_norm)) * \
+                 np.sqrt(np.maximum(energy_sum - cross, 0)) / (2 * self.weights_norm)
+        if excluded is not None:
+            scores[excluded] = np.inf
+
+        k = min(k, len(scores) - (excluded is not None))
+        if k <= 0:
+            return []
+        kth_score = np.partition(scores, k - 1)[k - 1]
+        shortlist = np.flatnonzero(scores <= kth_score + SHORTLIST_TOLERANCE)
+
+        # Exact re-ranking with the brute-force compatibility
+        pitch_shifts, compatibilities = max_compatibilities(query_tiv.vector, self.vectors[shortlist], shifts)
+        ranking = sorted(zip(compatibilities, shortlist, pitch_shifts))
+
+        return [(self.track_ids[position], float(scale(100 * (1 - compatibility))), int(pitch_shift))
+                for compatibility, position, pitch_shift in ranking[:k]]
@@ -0,0 +1,205 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module analyzes the whole length of a song and keeps a compact
+frame-level TIV sequence (one TIV per block of BLOCK_DURATION seconds),
+so that the regions where two tracks actually overlap in a mix can be
+compared: the outro of the target track and the intro of the candidate.
+
+The intro ends at "time_intro" and the outro starts at "time_outro",
+read from the annotation of the song (the dataset annotations already
+carry them). Songs without them use the first and last DEFAULT_REGION
+seconds. The TIVs of both regions are computed once, at analysis time,
+and saved in the annotation, so comparing regions is as fast as
+comparing whole tracks."""
+
+import argparse
+import ntpath
+import os
+import numpy as np
+from harmonic_mix.tivlib import TIV, TIVCollection
+from main import PRESETS, get_analysis, get_annotation_path, read_annotation, write_annotation, is_analyzed, \
+    save_analysis, decode_audio, cut_song, decompose_harmonic, audio_to_chromagram, audio_to_nnls
+
+BLOCK_DURATION = 1.0  # seconds of audio summarized by each TIV of the sequence
+DEFAULT_REGION = 60.0  # seconds of intro/outro of the songs without annotated mix points
+
+
+def block_tivs(chromagram, frame_duration, block_duration=BLOCK_DURATION):
+    """Summarizes a chromagram into one TIV per block of frames
+
+    :param chromagram: Chromagram (number of frames x 12)
+    :param frame_duration: Time between the start of consecutive frames, in seconds
+    :param block_duration: Duration of each block, in seconds
+    :return: TIVCollection with one sequence of one TIV per block. Its energy is the
+            number of frames of the block times the energy of their mean chroma, so
+            that combining TIVs is the same as averaging the chroma of their frames.
+    """
+
+    blocks = (np.arange(len(chromagram)) * frame_duration // block_duration).astype(int)
+    n_blocks = blocks[-1] + 1 if len(blocks) else 0
+    chroma_sum = np.zeros((n_blocks, 12))
+    np.add.at(chroma_sum, blocks, chromagram)
+    return TIVCollection.from_pcp(chroma_sum.T)
+
+
+def region_tiv(tivs, start, stop, block_duration=BLOCK_DURATION):
+    """Combines the TIVs of the blocks that overlap a region of the song
+
+    :param tivs: TIVCollection returned by block_tivs
+    :param start: Start of the region, in seconds
+    :param stop: End of the region, in seconds
+    :param block_duration: Duration of each block, in seconds
+    :return: TIV of the region
+    """
+
+    n_blocks = tivs.shape[1]
+    first = min(max(int(start // block_duration), 0), n_blocks - 1)
+    last = max(min(int(np.ceil(stop / block_duration)), n_blocks), first + 1)
+    energies = tivs.energies[0, first:last]
+    vector = np.sum(energies[:, np.newaxis] * tivs.vectors[0, first:last], axis=0) / np.sum(energies)
+    return TIV(np.sum(energies), vector)
+
+
+def get_mix_points(annotation, duration):
+    """Returns the end of the intro and the start of the outro of a song
+
+    :param annotation: Dictionary with the content of the annotation of the song
+    :param duration: Duration of the song, in seconds
+    :return: time_intro, time_outro (seconds)
+    """
+
+    time_intro = annotation.get('time_intro')
+    time_outro = annotation.get('time_outro')
+    time_intro = float(time_intro) if time_intro is not None else min(DEFAULT_REGION, duration)
+    time_outro = float(time_outro) if time_outro is not None else max(duration - DEFAULT_REGION, 0)
+    return time_intro, time_outro
+
+
+def _tiv_to_list(tiv):
+    return [float(np.real(tiv.energy))] + list(np.real(tiv.vector)) + list(np.imag(tiv.vector))
+
+
+def _list_to_tiv(values):
+    return TIV(values[0], np.array(values[1:7]) + 1j * np.array(values[7:13]))
+
+
+def analyze_segments(song_path, spectral=False, preset='reference'):
+    """
+    Computes the frame-level TIV sequence of a whole song and the TIVs of its
+    intro and outro, and saves them in the annotation of the song, next to the
+    TIV of analyze_song. The song is decoded and separated once: if its TIV is
+    missing, it is computed from the central part of the separated song.
+
+    :param song_path: The path of the track
+    :param spectral: If True, the chroma is computed with the spectral fast path
+    :param preset: Name of the analysis preset (see main.PRESETS)
+    """
+
+    analysis = get_analysis(preset, spectral)
+    annotation_path = get_annotation_path(song_path)
+    analyzed = is_analyzed(song_path, analysis)
+    if analyzed and has_segments(song_path, analysis):
+        return
+
+    print('Analyzing segments of ' + ntpath.basename(song_path).replace(".mp3", ""))
+    sample_rate = analysis['sample_rate']
+    song_audio = decode_audio(song_path, analysis)
+    if spectral:
+        from spectral import frame_audio, harmonic_spectrogram, spectral_kernel_size, spectrogram_to_chromagram
+        spectrogram = harmonic_spectrogram(song_audio, sample_rate, analysis['frame_size'], analysis['hop_size'],
+                                           spectral_kernel_size(analysis))
+        chromagram = spectrogram_to_chromagram(spectrogram, sample_rate)
+        if not analyzed:
+            # Frames of the spectrogram that start in the part of the song kept by cut_song
+            kept = analysis['song_kept'] / 2
+            start = int(np.ceil(int(song_audio.size / 2 - song_audio.size * kept) / analysis['hop_size']))
+            n_frames = len(frame_audio(cut_song(song_audio, analysis['song_kept']), analysis['frame_size'],
+                                       analysis['hop_size']))
+            chroma = np.mean(spectrogram_to_chromagram(spectrogram[start:start + n_frames], sample_rate), axis=0)
+        del spectrogram
+    else:
+        harmonic = decompose_harmonic(song_audio, analysis['n_fft'], analysis['hop_length'],
+                                      analysis['kernel_size'])
+        chromagram = audio_to_chromagram(harmonic, sample_rate, analysis['frame_size'], analysis['hop_size'])
+        if not analyzed:
+            chroma = audio_to_nnls(cut_song(harmonic, analysis['song_kept']), sample_rate, analysis['frame_size'],
+                                   analysis['hop_size'])
+    if not analyzed:
+        save_analysis(song_path, TIV.from_pcp(chroma), analysis)
+    annotation = read_annotation(annotation_path)
+
+    tivs = block_tivs(chromagram, analysis['hop_size'] / sample_rate)
+    duration = song_audio.size / sample_rate
+    time_intro, time_outro = get_mix_points(annotation, duration)
+
+    segments = {"analysis": analysis, "block_duration": BLOCK_DURATION,
+                "time_intro": time_intro, "time_outro": time_outro,
+                "energies": np.real(tivs.energies[0]),
+                "vectors": np.concatenate((tivs.vectors[0].real, tivs.vectors[0].imag), axis=1),
+                "intro": _tiv_to_list(region_tiv(tivs, 0, time_intro)),
+                "outro": _tiv_to_list(region_tiv(tivs, time_outro, duration))}
+    write_annotation(annotation_path, {"segments": segments})
+
+
+def has_segments(song_path, analysis):
+    """Checks if a song already has a segment analysis computed with the given analysis
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters
+    :return: True if the annotation has segments computed with the same parameters
+    """
+
+    segments = read_annotation(get_annotation_path(song_path)).get('segments')
+    return segments is not None and segments.get('analysis') == analysis
+
+
+def load_segments(song_path):
+    """Loads the frame-level TIV sequence of a song
+
+    :param song_path: The path of the track
+    :return: TIVCollection with one TIV per block, and the dictionary with the segment annotation
+            (analysis, block_duration, time_intro, time_outro)
+    """
+
+    segments = read_annotation(get_annotation_path(song_path)).get('segments')
+    if segments is None:
+        raise KeyError("%s has no segment analysis" % song_path)
+    vectors = np.array(segments['vectors'])
+    tivs = TIVCollection.from_arrays(np.array(segments['energies']), vectors[:, :6] + 1j * vectors[:, 6:])
+    return tivs, segments
+
+
+def load_region(song_path, region):
+    """Loads the precomputed TIV of the intro or the outro of a song
+
+    :param song_path: The path of the track
+    :param region: 'intro' or 'outro'
+    :return: TIV of the region, and the parameters of the analysis that computed it
+    """
+
+    if region not in ('intro', 'outro'):
+        raise ValueError("Unknown song region: " + str(region))
+    segments = read_annotation(get_annotation_path(song_path)).get('segments')
+    if segments is None:
+        raise KeyError("%s has no segment analysis" % song_path)
+    return _list_to_tiv(segments[region]), segments['analysis']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Frame-level analysis of the intro and outro of tracks")
+    parser.add_argument('songs', nargs='+', help="audio tracks (.mp3) or music folders")
+    parser.add_argument('--spectral', action='store_true', help="use the spectral fast path")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS), help="analysis preset")
+    args = parser.parse_args()
+
+    for path in args.songs:
+        if os.path.isdir(path):
+            for file in sorted(os.listdir(path)):
+                if file.endswith('.mp3'):
+                    analyze_segments(path + '/' + file, args.spectral, args.preset)
+        else:
+            analyze_segments(path, args.spectral, args.preset)
@@ -0,0 +1,235 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module suggests the order in which the tracks of a crate can be
+played, starting from a given track, so that the sum of the harmonic
+compatibilities between consecutive tracks is maximal.
+
+Every track of the set can be played transposed. A transposed track
+stays transposed while it is playing, so the compatibility of a
+transition depends on the difference between the transpositions of
+both tracks. At each step, the next track is either played in its
+original version or transposed by the pitch shift that maximizes its
+compatibility with the previous track (the one returned by
+get_max_compatibility). The number of transposed tracks can be capped.
+
+All the pairwise compatibilities are computed once, in the 12
+transpositions (compatibility.transposition_matrices). Small crates are
+ordered exactly with dynamic programming over the subsets of tracks;
+bigger crates with a beam search."""
+
+import argparse
+import os
+import numpy as np
+from compatibility import transposition_matrices
+from main import get_annotation_path, load_annotation
+
+EXACT_MAX_TRACKS = 12  # largest crate ordered with the exact dynamic programming
+BEAM_WIDTH = 256  # partial sets kept at each step of the beam search
+
+
+def _pitch_shift(shift):
+    """Maps a transposition (0 to 11 semitones) to a pitch shift between -6 and 5"""
+    return (shift + 6) % 12 - 6
+
+
+def _transitions(scores, best_shift, last, shift, used, max_shifts):
+    """
+    Options for the track that follows a track playing with a given transposition
+
+    :return: List of (scores of every next track, transposition of the next tracks, shifts used) tuples
+    """
+    options = [(scores[-shift % 12, last], np.zeros(scores.shape[2], dtype=int), used)]
+    if used < max_shifts:
+        tracks = np.arange(scores.shape[2])
+        options.append((scores[best_shift[last], last, tracks], (shift + best_shift[last]) % 12, used + 1))
+    return options
+
+
+def _beam_search(scores, best_shift, start, length, max_shifts, beam_width):
+    n = scores.shape[1]
+    visited = np.zeros(n, dtype=bool)
+    visited[start] = True
+    # Partial sets: (total compatibility, track order, transpositions, shifts used, visited tracks)
+    beam = [(0.0, [start], [0], 0, visited)]
+
+    for _ in range(length - 1):
+        candidates = []
+        for state, (total, order, shifts, used, visited) in enumerate(beam):
+            for next_scores, next_shift, next_used in _transitions(scores, best_shift, order[-1], shifts[-1],
+                                                                   used, max_shifts):
+                valid = ~visited
+                if next_used != used:
+                    # Transpositions that wrap back to the original version are not a shift
+                    valid &= next_shift != 0
+                for track in np.flatnonzero(valid):
+                    candidates.append((total + next_scores[track], state, track, next_shift[track], next_used))
+        if not candidates:
+            break
+
+        candidates.sort(key=lambda candidate: -candidate[0])
+        new_beam = []
+        seen = set()
+        for total, state, track, shift, used in candidates:
+            visited = beam[state][4].copy()
+            visited[track] = True
+            # Partial sets with the same tracks, ending in the same way, can only be continued in the same ways
+            key = (visited.tobytes(), track, shift, used)
+            if key in seen:
+                continue
+            seen.add(key)
+            new_beam.append((total, beam[state][1] + [track], beam[state][2] + [shift], used, visited))
+            if len(new_beam) == beam_width:
+                break
+        beam = new_beam
+
+    _, order, shifts, _, _ = beam[0]
+    return order, shifts
+
+
+def _exact(scores, best_shift, start, length, max_shifts):
+    n = scores.shape[1]
+    max_shifts = min(max_shifts, length - 1)
+    n_used = max_shifts + 1
+    masks = np.arange(2 ** n)
+    popcount = np.array([bin(mask).count('1') for mask in masks])
+
+    # Best total compatibility of the partial sets (tracks, last track, its transposition, shifts used),
+    # and the state they come from
+    best = np.full((2 ** n, n, 12, n_used), -np.inf)
+    parent = np.full((2 ** n, n, 12, n_used), -1, dtype=np.int64)
+    best[1 << start, start, 0, 0] = 0
+
+    for size in range(1, length):
+        layer = masks[(popcount == size) & (masks >> start & 1 == 1)]
+        for last in range(n):
+            last_layer = layer[layer >> last & 1 == 1]
+            for shift in range(12):
+                totals = best[last_layer, last, shift]
+                if not np.isfinite(totals).any():
+                    continue
+                for track in range(n):
+                    sources = last_layer >> track & 1 == 0
+                    if not sources.any():
+                        continue
+                    targets = last_layer[sources] | 1 << track
+                    origin = (last * 12 + shift) * n_used
+
+                    # Original version of the next track
+                    candidate = totals[sources] + scores[-shift % 12, last, track]
+                    current = best[targets, track, 0]
+                    improved = candidate > current
+                    best[targets, track, 0] = np.where(improved, candidate, current)
+                    parent[targets, track, 0] = np.where(improved, origin + np.arange(n_used),
+                                                         parent[targets, track, 0])
+
+                    # Next track transposed by the pitch shift that maximizes the compatibility
+                    next_shift = (shift + best_shift[last, track]) % 12
+                    if next_shift == 0 or max_shifts == 0:
+                        continue
+                    candidate = totals[sources, :-1] + scores[best_shift[last, track], last, track]
+                    current = best[targets, track, next_shift, 1:]
+                    improved = candidate > current
+                    best[targets, track, next_shift, 1:] = np.where(improved, candidate, current)
+                    parent[targets, track, next_shift, 1:] = np.where(improved, origin + np.arange(n_used - 1),
+                                                                      parent[targets, track, next_shift, 1:])
+
+    final = masks[(popcount == length) & (masks >> start & 1 == 1)]
+    mask_index, track, shift, used = np.unravel_index(np.argmax(best[final]), best[final].shape)
+    mask = final[mask_index]
+    order, shifts = [], []
+    while True:
+        order.append(int(track))
+        shifts.append(int(shift))
+        origin = parent[mask, track, shift, used]
+        if origin < 0:
+            break
+        mask = mask ^ (1 << int(track))
+        track, rest = divmod(int(origin), 12 * n_used)
+        shift, used = divmod(rest, n_used)
+    return order[::-1], shifts[::-1]
+
+
+def sequence_tracks(scores, start, length=None, max_shifts=0, method='auto', beam_width=BEAM_WIDTH):
+    """
+    Orders a crate of tracks, maximizing the sum of the harmonic compatibilities between consecutive tracks
+
+    :param scores: Harmonic compatibility array (12xNxN) returned by compatibility.transposition_matrices
+    :param start: Index of the first track of the set
+    :param length: Number of tracks of the set. Default: all the tracks of the crate
+    :param max_shifts: Maximum number of transposed tracks. Default zero: original versions only
+    :param method: 'exact' (dynamic programming, up to EXACT_MAX_TRACKS tracks), 'beam' (beam search)
+            or 'auto' (exact for small crates)
+    :param beam_width: Number of partial sets kept at each step of the beam search
+    :return: List with the index of the tracks of the set, in order, and list with the pitch shift
+            (in semitones) of each track
+    """
+
+    n = scores.shape[1]
+    length = n if length is None else min(length, n)
+    if method == 'auto':
+        method = 'exact' if n <= EXACT_MAX_TRACKS else 'beam'
+    if method not in ('exact', 'beam'):
+        raise ValueError("Unknown sequencing method: " + str(method))
+    if method == 'exact' and n > EXACT_MAX_TRACKS:
+        raise ValueError("The exact sequencing supports up to %d tracks" % EXACT_MAX_TRACKS)
+
+    best_shift = np.argmax(scores, axis=0)  # transposition of j that maximizes its compatibility with i
+    if method == 'exact':
+        order, shifts = _exact(scores, best_shift, start, length, max_shifts)
+    else:
+        order, shifts = _beam_search(scores, best_shift, start, length, max_shifts, beam_width)
+    return order, [_pitch_shift(shift) for shift in shifts]
+
+
+def plan_set(song_paths, start_song_path, length=None, max_shifts=0, method='auto', beam_width=BEAM_WIDTH):
+    """
+    Suggests the order in which a crate of analyzed songs can be played
+
+    :param song_paths: List with the paths of the tracks of the crate
+    :param start_song_path: The path of the first track of the set (added to the crate if needed)
+    :param length, max_shifts, method, beam_width: As in sequence_tracks
+    :return: List with one (song path, pitch shift, harmonic compatibility with the previous track) tuple
+            per track of the set, in order. The compatibility of the first track is None.
+    """
+
+    song_paths = [start_song_path] + [song_path for song_path in song_paths if song_path != start_song_path]
+    tivs = []
+    analysis = None
+    for song_path in song_paths:
+        tiv, song_analysis = load_annotation(get_annotation_path(song_path))
+        if analysis is not None and song_analysis != analysis:
+            raise ValueError("%s was analyzed with different analysis parameters" % song_path)
+        analysis = song_analysis
+        tivs.append(tiv)
+
+    scores = transposition_matrices(tivs)
+    order, pitch_shifts = sequence_tracks(scores, 0, length, max_shifts, method, beam_width)
+
+    plan = [(song_paths[order[0]], pitch_shifts[0], None)]
+    for previous, track, previous_shift, pitch_shift in zip(order, order[1:], pitch_shifts, pitch_shifts[1:]):
+        plan.append((song_paths[track], pitch_shift,
+                     float(scores[(pitch_shift - previous_shift) % 12, previous, track])))
+    return plan
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Suggest the order of a DJ set")
+    parser.add_argument('folder', help="music folder with the analyzed tracks (.mp3) of the crate")
+    parser.add_argument('start', help="first track of the set (file name in the folder)")
+    parser.add_argument('--length', type=int, default=None, help="number of tracks of the set")
+    parser.add_argument('--max-shifts', type=int, default=0, help="maximum number of transposed tracks")
+    parser.add_argument('--method', default='auto', choices=['auto', 'exact', 'beam'], help="sequencing method")
+    parser.add_argument('--beam-width', type=int, default=BEAM_WIDTH, help="partial sets kept by the beam search")
+    args = parser.parse_args()
+
+    song_paths = sorted(args.folder + '/' + file for file in os.listdir(args.folder) if file.endswith('.mp3'))
+    start = args.folder + '/' + args.start
+    plan = plan_set(song_paths, start, args.length, args.max_shifts, args.method, args.beam_width)
+    for position, (song_path, pitch_shift, harmonic_compatibility) in enumerate(plan, 1):
+        transition = '' if harmonic_compatibility is None else 'HC %5.1f%%' % harmonic_compatibility
+        print("%2d. %-60s %+d st  %s" % (position, os.path.basename(song_path)[:60], pitch_shift, transition))
+    print("Total harmonic compatibility: %.1f%%" % sum(step[2] for step in plan[1:]))
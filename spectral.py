@@ -0,0 +1,221 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module computes the NNLS chroma of a song directly from the
+magnitude of its harmonic spectrum, without going back to the time
+domain. A single STFT with the framing of audio_to_nnls is computed,
+the source separation is applied to it, and its magnitude is fed to
+LogSpectrum. Only the bins that LogSpectrum reads are separated.
+
+Running this module prints how far the TIVs of this fast path drift
+from the ones of the reference pipeline (decompose_harmonic followed by
+audio_to_nnls)."""
+
+import argparse
+import os
+import numpy as np
+import librosa
+import scipy.ndimage
+from harmonic_mix.tivlib import TIV
+import main
+from main import SR, FRAME_SIZE, HOP_SIZE, get_analysis, get_annotation_path, load_annotation, \
+    decompose_harmonic, audio_to_nnls, scale
+
+# HPSS median filter sizes in the audio_to_nnls STFT of the reference analysis: the reference kernels
+# (13 frames of 512 samples, 31 bins of 2048) rescaled to its hop (2048 samples) and bin width (16384),
+# about 150 ms and 670 Hz (see spectral_kernel_size)
+SPECTRAL_KERNEL_SIZE = (3, 249)
+MAX_FREQUENCY = 3800  # Hz, LogSpectrum does not read the spectrum above this frequency
+FFT_CHUNK = 256  # frames transformed at once
+
+
+def spectral_kernel_size(analysis):
+    """Rescales the HPSS kernel of an analysis to the audio_to_nnls STFT, so that the median
+    filters of the spectral fast path span the same time and frequency ranges
+
+    :param analysis: Dictionary with the analysis parameters (see main.get_analysis)
+    :return: HPSS median filter sizes (harmonic, percussive), in frames and bins. Both are odd.
+    """
+
+    harmonic = analysis['kernel_size'][0] * analysis['hop_length'] / analysis['hop_size']
+    percussive = analysis['kernel_size'][1] * analysis['frame_size'] / analysis['n_fft']
+    return int(round(harmonic)) // 2 * 2 + 1, int(round(percussive)) // 2 * 2 + 1
+
+
+def frame_audio(audio, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+    """Frames the audio as FrameGenerator(startFromZero=True) does,
+    zero-padding the last frames
+
+    :param audio: Audio sample arrangement (1xn)
+    :return: Read-only view of the frames (number of frames x frame_size)
+    """
+
+    n_frames = 1 + max(0, int(np.ceil((len(audio) - frame_size) / hop_size)))
+    padded = np.zeros((n_frames - 1) * hop_size + frame_size, dtype=np.float32)
+    padded[:len(audio)] = audio
+    return np.lib.stride_tricks.sliding_window_view(padded, frame_size)[::hop_size]
+
+
+def separate_harmonic(magnitude, kernel_size=SPECTRAL_KERNEL_SIZE):
+    """Harmonic part of a magnitude spectrogram, as librosa.decompose.hpss computes it
+    (soft mask with power 2). The percussive median filter runs frame by frame, where
+    scipy uses a running median, which is much faster for the wide kernels of this STFT.
+
+    :param magnitude: Magnitude spectrogram (number of frames x number of bins)
+    :param kernel_size: HPSS median filter sizes (harmonic, percussive), in frames and bins
+    :return: Harmonic magnitude spectrogram, with the shape of magnitude
+    """
+
+    harmonic = scipy.ndimage.median_filter(magnitude, size=(kernel_size[0], 1), mode='reflect')
+    percussive = np.empty_like(magnitude)
+    for frame, spectrum in enumerate(magnitude):
+        percussive[frame] = scipy.ndimage.median_filter(spectrum, size=kernel_size[1], mode='reflect')
+    return magnitude * librosa.util.softmask(harmonic, percussive, power=2)
+
+
+def harmonic_spectrogram(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE,
+                         kernel_size=SPECTRAL_KERNEL_SIZE):
+    """Computes the magnitude spectrogram of the harmonic part of the audio
+
+    :param audio: Audio sample arrangement (1xn)
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames
+    :param kernel_size: HPSS median filter sizes (harmonic, percussive), in frames and bins
+    :return: Harmonic magnitude spectrogram (number of frames x frame_size/2+1). Bins above
+            MAX_FREQUENCY are left at zero.
+    """
+
+    frames = frame_audio(audio, frame_size, hop_size)
+    n_bins = min(int(np.ceil(MAX_FREQUENCY * frame_size / sample_rate)) + kernel_size[1] // 2,
+                 frame_size // 2 + 1)
+    # Same window as essentia's Windowing(type='hann', normalized=False)
+    window = np.hanning(frame_size).astype(np.float32)
+
+    magnitude = np.empty((len(frames), n_bins), dtype=np.float32)
+    for start in range(0, len(frames), FFT_CHUNK):
+        spectrum = np.fft.rfft(frames[start:start + FFT_CHUNK] * window, axis=1)
+        magnitude[start:start + FFT_CHUNK] = np.abs(spectrum[:, :n_bins])
+
+    spectrogram = np.zeros((len(frames), frame_size // 2 + 1), dtype=np.float32)
+    spectrogram[:, :n_bins] = separate_harmonic(magnitude, kernel_size)
+    return spectrogram
+
+
+def spectral_chromagram(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE,
+                        kernel_size=SPECTRAL_KERNEL_SIZE):
+    """Computes the NNLS chroma of each frame of the harmonic part of the audio, from
+    the harmonic spectrogram (replaces decompose_harmonic followed by audio_to_chromagram)
+
+    :param audio: Audio sample arrangement
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames
+    :param kernel_size: HPSS median filter sizes (see spectral_kernel_size)
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
+    """
+
+    return spectrogram_to_chromagram(harmonic_spectrogram(audio, sample_rate, frame_size, hop_size, kernel_size),
+                                     sample_rate)
+
+
+def spectrogram_to_chromagram(spectrogram, sample_rate=SR):
+    """Computes the NNLS chroma of each frame of a magnitude spectrogram
+
+    :param spectrogram: Magnitude spectrogram (number of frames x frame_size/2+1), e.g. from harmonic_spectrogram
+    :param sample_rate: Sample rate of the audio
+    :return: Chromagram (number of frames x 12), each chroma starting in C.
+    """
+
+    if main.CHROMA_FRONTEND == 'numpy':
+        import chroma
+        return chroma.spectrogram_to_chromagram(spectrogram, sample_rate)
+
+    from essentia.standard import LogSpectrum, NNLSChroma
+    spectrum_size = spectrogram.shape[1]
+    logspectrum = LogSpectrum(frameSize=spectrum_size, sampleRate=sample_rate)
+    nnls = NNLSChroma(frameSize=spectrum_size, sampleRate=sample_rate, useNNLS=False)
+
+    logfreqspectrogram = []
+    for spectrum in spectrogram:
+        logfreqspectrum, meanTuning, _ = logspectrum(spectrum)
+        logfreqspectrogram.append(logfreqspectrum)
+    logfreqspectrogram = np.array(logfreqspectrogram)
+
+    chroma = nnls(logfreqspectrogram, meanTuning, np.array([]))[3]
+    #Rotate the chroma so that it starts in C
+    return np.roll(np.array(chroma), -3, axis=1)
+
+
+def spectral_chroma(audio, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE,
+                    kernel_size=SPECTRAL_KERNEL_SIZE):
+    """Computes the NNLS chroma of the harmonic part of the audio, from the
+    harmonic spectrogram (replaces decompose_harmonic followed by audio_to_nnls)
+
+    :param audio: Audio sample arrangement
+    :param sample_rate: Sample rate of the audio
+    :param frame_size: Size of the analysis frames
+    :param hop_size: Hop between analysis frames
+    :param kernel_size: HPSS median filter sizes (see spectral_kernel_size)
+    :return: A 12-dimensional chromagram (1x12), the result of averaging the chroma of each frame.
+    """
+
+    return np.mean(spectral_chromagram(audio, sample_rate, frame_size, hop_size, kernel_size), axis=0)
+
+
+def drift_report(song_paths):
+    """
+    Compares the TIVs of the spectral fast path with the ones of the reference
+    pipeline. The reference TIV is read from the annotation of the track when it
+    was computed with the reference analysis, otherwise it is computed.
+
+    :param song_paths: List with the paths of the tracks
+    :return: List with one dictionary per track: relative euclidean distance between
+            both TIVs, harmonic compatibility (%) between them, and their keys
+    """
+
+    report = []
+    for song_path in song_paths:
+        song_audio = main.decode_song(song_path, get_analysis())
+
+        try:
+            reference, analysis = load_annotation(get_annotation_path(song_path))
+        except (IOError, KeyError, TypeError, ValueError):
+            analysis = None
+        if analysis != get_analysis():
+            reference = TIV.from_pcp(audio_to_nnls(decompose_harmonic(song_audio)))
+        fast = TIV.from_pcp(spectral_chroma(song_audio))
+
+        report.append({'song': os.path.basename(song_path),
+                       'distance': TIV.euclidean(reference, fast) / np.linalg.norm(reference.vector),
+                       'harmonic_compatibility': scale(100 * (1 - reference.small_scale_compatibility(fast))),
+                       'reference_key': ' '.join(reference.key()),
+                       'spectral_key': ' '.join(fast.key())})
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="TIV drift of the spectral fast path")
+    parser.add_argument('songs', nargs='+', help="audio tracks (.mp3) or music folders")
+    args = parser.parse_args()
+
+    song_paths = []
+    for path in args.songs:
+        if os.path.isdir(path):
+            song_paths += sorted(path + '/' + file for file in os.listdir(path) if file.endswith('.mp3'))
+        else:
+            song_paths.append(path)
+
+    report = drift_report(song_paths)
+    for row in report:
+        print("%-60s distance %5.1f%%  HC %5.1f%%  key %s / %s" % (
+            row['song'][:60], 100 * row['distance'], row['harmonic_compatibility'],
+            row['reference_key'], row['spectral_key']))
+    if report:
+        distances = [row['distance'] for row in report]
+        same_key = sum(row['reference_key'] == row['spectral_key'] for row in report)
+        print("Mean distance %.1f%%, max distance %.1f%%, same key in %d of %d tracks" % (
+            100 * np.mean(distances), 100 * np.max(distances), same_key, len(report)))
@@ -0,0 +1,262 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module computes the mean NNLS chroma of a song block by block,
+so that the memory used by the analysis does not depend on the length
+of the track (long edits, hour-long DJ mixes...).
+
+The audio is decoded in blocks, source separated with a streaming
+version of decompose_harmonic (the HPSS median filters get the frames
+they need from the neighbouring blocks) and framed for the NNLS chroma
+as it arrives. The NNLS chroma is computed with the frontend of
+audio_to_nnls (see main.CHROMA_FRONTEND), so this module does not need
+essentia either when it is not installed."""
+
+import numpy as np
+import scipy.fft
+import soundfile
+from scipy.signal import get_window
+from scipy.ndimage import median_filter
+from librosa.util import softmask
+import main
+from main import SR, SONG_KEPT, KERNEL_SIZE, N_FFT, HOP_LENGTH, FRAME_SIZE, HOP_SIZE, get_analysis
+
+BLOCK_SIZE = 2 ** 16  # decoded samples per block
+HPSS_CHUNK = 256  # STFT frames separated at once
+NNLS_CHUNK = 512  # log-spectrum frames sent at once to NNLSChroma
+
+
+def decode_blocks(song_path, sample_rate=SR, song_kept=SONG_KEPT, block_size=BLOCK_SIZE):
+    """Decodes the middle part of a song, block by block
+
+    :param song_path: The path of the track
+    :param sample_rate: Sample rate of the decoded audio
+    :param song_kept: Fraction of the song (centered) that is decoded
+    :param block_size: Number of samples of each block
+    :return: Generator of mono float32 audio blocks
+    """
+
+    info = soundfile.info(song_path)
+    kept = song_kept / 2
+    start = int(info.frames / 2 - info.frames * kept)
+    stop = int(info.frames / 2 + info.frames * kept)
+
+    resampler = None
+    if info.samplerate != sample_rate:
+        import soxr
+        resampler = soxr.ResampleStream(info.samplerate, sample_rate, 1, dtype='float32')
+
+    for block in soundfile.blocks(song_path, blocksize=block_size, start=start, stop=stop,
+                                  dtype='float32', always_2d=True):
+        block = block.mean(axis=1)
+        if resampler is not None:
+            block = resampler.resample_chunk(block)
+        yield block
+    if resampler is not None:
+        yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+class HarmonicStream:
+    """Streaming version of decompose_harmonic: STFT, HPSS and inverse STFT
+    computed on consecutive blocks of audio. The output is the same as the
+    one of decompose_harmonic applied to the whole signal."""
+
+    def __init__(self, n_fft=N_FFT, hop_length=HOP_LENGTH, kernel_size=KERNEL_SIZE, chunk=HPSS_CHUNK):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.kernel_size = kernel_size
+        self.chunk = chunk
+        self.margin = kernel_size[0] // 2  # STFT frames of context needed by the harmonic median filter
+        self.window = get_window('hann', n_fft, fftbins=True)
+
+        self._samples = np.zeros(n_fft // 2, dtype=np.float32)  # centered STFT padding
+        self._frames = np.zeros((n_fft // 2 + 1, 0), dtype=np.complex64)  # frames not separated yet
+        self._context = np.zeros((n_fft // 2 + 1, 0), dtype=np.float32)  # magnitudes already separated
+        self._overlap = np.zeros(n_fft - hop_length)
+        self._overlap_norm = np.zeros(n_fft - hop_length)
+        self._to_trim = n_fft // 2  # centered inverse STFT trimming
+
+    def _stft(self, samples):
+        """Computes the STFT frames that are complete, keeping the remaining samples"""
+        n_frames = 1 + (len(samples) - self.n_fft) // self.hop_length if len(samples) >= self.n_fft else 0
+        if n_frames:
+            frames = np.lib.stride_tricks.sliding_window_view(samples, self.n_fft)[::self.hop_length][:n_frames]
+            spectrum = scipy.fft.rfft(frames * self.window, axis=1).T.astype(np.complex64)
+            self._frames = np.concatenate((self._frames, spectrum), axis=1)
+        return samples[n_frames * self.hop_length:]
+
+    def _separate(self, n_frames, last):
+        """Separates the harmonic part of the first n_frames pending frames"""
+        right = self._frames.shape[1] if last else n_frames + self.margin
+        frames = self._frames[:, :right]
+        magnitude = np.abs(frames)
+        with_context = np.concatenate((self._context, magnitude), axis=1)
+
+        harmonic = median_filter(with_context, size=(1, self.kernel_size[0]), mode='reflect')
+        harmonic = harmonic[:, self._context.shape[1]:self._context.shape[1] + n_frames]
+        percussive = median_filter(magnitude[:, :n_frames], size=(self.kernel_size[1], 1), mode='reflect')
+        harmonic_frames = frames[:, :n_frames] * softmask(harmonic, percussive, power=2, split_zeros=False)
+
+        separated = self._context.shape[1] + n_frames
+        self._context = with_context[:, max(0, separated - self.margin):separated]
+        self._frames = self._frames[:, n_frames:]
+        return self._overlap_add(harmonic_frames, last)
+
+    def _overlap_add(self, harmonic_frames, last):
+        """Inverse STFT of consecutive frames, returning the samples that are complete"""
+        n_frames = harmonic_frames.shape[1]
+        length = self.n_fft + self.hop_length * (n_frames - 1)
+        audio = np.zeros(length)
+        norm = np.zeros(length)
+        audio[:len(self._overlap)] = self._overlap
+        norm[:len(self._overlap_norm)] = self._overlap_norm
+        frames = scipy.fft.irfft(harmonic_frames, n=self.n_fft, axis=0) * self.window[:, np.newaxis]
+        for i in range(n_frames):
+            audio[i * self.hop_length:i * self.hop_length + self.n_fft] += frames[:, i]
+            norm[i * self.hop_length:i * self.hop_length + self.n_fft] += self.window ** 2
+
+        ready = length if last else n_frames * self.hop_length
+        self._overlap = audio[ready:]
+        self._overlap_norm = norm[ready:]
+        audio, norm = audio[:ready], norm[:ready]
+        nonzero = norm > np.finfo(np.float32).tiny
+        audio[nonzero] /= norm[nonzero]
+
+        if last:
+            audio = audio[:len(audio) - self.n_fft // 2]
+        trimmed = min(self._to_trim, len(audio))
+        self._to_trim -= trimmed
+        return audio[trimmed:].astype(np.float32)
+
+    def process(self, block):
+        """Adds a block of audio
+
+        :param block: Mono audio samples
+        :return: Harmonic part of the audio that is already complete (may be empty)
+        """
+        self._samples = self._stft(np.concatenate((self._samples, block)))
+        output = []
+        while self._frames.shape[1] >= self.chunk + self.margin:
+            output.append(self._separate(self.chunk, last=False))
+        return np.concatenate(output) if output else np.zeros(0, dtype=np.float32)
+
+    def finish(self):
+        """Ends the stream
+
+        :return: The rest of the harmonic part of the audio
+        """
+        self._stft(np.concatenate((self._samples, np.zeros(self.n_fft // 2, dtype=np.float32))))
+        self._samples = np.zeros(0, dtype=np.float32)
+        if self._frames.shape[1] == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self._separate(self._frames.shape[1], last=True)
+
+
+class ChromaStream:
+    """Streaming version of audio_to_nnls: frames the audio as it arrives
+    and averages the NNLS chroma of the frames. The chroma of each group
+    of frames is computed with the tuning estimated up to that point."""
+
+    def __init__(self, sample_rate=SR, frame_size=FRAME_SIZE, hop_size=HOP_SIZE, chunk=NNLS_CHUNK):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.hop_size = hop_size
+        self.chunk = chunk
+        spectrum_size = frame_size // 2 + 1
+
+        self.frontend = main.CHROMA_FRONTEND
+        if self.frontend == 'numpy':
+            # Same window as essentia's Windowing(type='hann', normalized=False), see chroma.py
+            self.window = np.hanning(frame_size).astype(np.float32)
+            self._tuning_sum = np.zeros(3)
+        else:
+            from essentia.standard import LogSpectrum, Windowing, Spectrum, NNLSChroma
+            self.window = Windowing(type='hann', normalized=False)
+            self.spectrum = Spectrum()
+            self.logspectrum = LogSpectrum(frameSize=spectrum_size, sampleRate=sample_rate)
+            self.nnls = NNLSChroma(frameSize=spectrum_size, sampleRate=sample_rate, useNNLS=False)
+
+        self._samples = np.zeros(0, dtype=np.float32)
+        self._logfreqspectrogram = []  # frames waiting for their chroma (log spectra, or audio frames with NumPy)
+        self._mean_tuning = None
+        self._chroma_sum = np.zeros(12)
+        self._n_frames = 0
+        self._n_logspectra = 0
+
+    def _add_frame(self, frame):
+        if self.frontend == 'numpy':
+            self._logfreqspectrogram.append(frame)
+        else:
+            logfreqspectrum, self._mean_tuning, _ = self.logspectrum(self.spectrum(self.window(frame)))
+            self._logfreqspectrogram.append(logfreqspectrum)
+        self._n_logspectra += 1
+        if len(self._logfreqspectrogram) == self.chunk:
+            self._add_chroma()
+
+    def _numpy_chroma(self):
+        """Chroma of the waiting frames with the NumPy frontend, with the running mean tuning of LogSpectrum"""
+        import chroma
+        spectrogram = np.abs(scipy.fft.rfft(np.array(self._logfreqspectrogram) * self.window, axis=1))
+        logfreqspectrogram, mean_tuning = chroma.log_spectrogram(spectrogram, self.sample_rate)
+        self._tuning_sum += mean_tuning * len(spectrogram)
+        return chroma.nnls_chromagram(logfreqspectrogram, self._tuning_sum / self._n_logspectra)
+
+    def _add_chroma(self):
+        if self._logfreqspectrogram:
+            if self.frontend == 'numpy':
+                chroma = self._numpy_chroma()
+            else:
+                chroma = self.nnls(np.array(self._logfreqspectrogram), self._mean_tuning, np.array([]))[3]
+            self._chroma_sum += np.sum(np.array(chroma), axis=0)
+            self._n_frames += len(self._logfreqspectrogram)
+            self._logfreqspectrogram = []
+
+    def process(self, samples):
+        """Adds audio samples
+
+        :param samples: Mono audio samples
+        """
+        self._samples = np.concatenate((self._samples, samples.astype(np.float32)))
+        start = 0
+        while start + self.frame_size <= len(self._samples):
+            self._add_frame(self._samples[start:start + self.frame_size])
+            start += self.hop_size
+        self._samples = self._samples[start:]
+
+    def finish(self):
+        """Ends the stream, with the same zero-padded last frames as FrameGenerator
+
+        :return: A 12-dimensional chromagram (1x12), the result of averaging the chroma of each frame.
+        """
+        start = 0
+        while len(self._samples) - start > self.frame_size - self.hop_size or self._n_logspectra == 0:
+            frame = np.zeros(self.frame_size, dtype=np.float32)
+            remaining = self._samples[start:start + self.frame_size]
+            frame[:len(remaining)] = remaining
+            self._add_frame(frame)
+            start += self.hop_size
+        self._add_chroma()
+
+        mean_chroma = self._chroma_sum / self._n_frames
+        #Rotate the chroma so that it starts in C
+        return np.roll(mean_chroma, -3)
+
+
+def streaming_chroma(song_path, analysis=None):
+    """Computes the mean NNLS chroma of the harmonic part of the middle of a
+    song (as analyze_song does) with a memory use independent of its length
+
+    :param song_path: The path of the track
+    :param analysis: Dictionary with the analysis parameters (see main.get_analysis). Default: reference analysis.
+    :return: A 12-dimensional chromagram (1x12)
+    """
+
+    analysis = analysis if analysis is not None else get_analysis()
+    harmonic = HarmonicStream(analysis['n_fft'], analysis['hop_length'], analysis['kernel_size'])
+    chroma = ChromaStream(analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+    for block in decode_blocks(song_path, analysis['sample_rate'], analysis['song_kept']):
+        chroma.process(harmonic.process(block))
+    chroma.process(harmonic.finish())
+    return chroma.finish()
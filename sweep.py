@@ -0,0 +1,276 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""This module analyzes a list of tracks with every configuration of a
+grid of analysis parameters, e.g. to tune the cut and the HPSS and NNLS
+sizes for each genre folder.
+
+The analysis of a track is a chain of steps, each of them depending on
+some of the parameters:
+    decode -- sample_rate
+    cut    -- song_kept
+    stft   -- n_fft, hop_length
+    hpss   -- kernel_size
+    chroma -- frame_size, hop_size (NNLS chroma, then TIV)
+With the spectral fast path (see spectral.py), stft and hpss are replaced
+by the harmonic spectrogram, which depends on frame_size and hop_size, and
+on the HPSS kernel rescaled to them (n_fft, hop_length, kernel_size).
+
+For each track, the configurations are grouped by the parameters of the
+first step, and each step is computed once per group before branching
+into the groups of the next step. A track is decoded once per sample
+rate, and its STFT is computed once per cut and STFT size, whatever the
+number of chroma configurations. Configurations that only differ in
+parameters that the analysis does not use share their TIVs.
+
+The TIVs of each configuration are saved in a TIV library file (see
+library.py), and the configurations are listed in a sweep.json file in
+the output folder. Tracks already in every library are skipped, so an
+interrupted sweep can be resumed.
+
+    python sweep.py music/techno --output sweeps/techno --preset fast \\
+        --grid song_kept=0.2,0.3 kernel_size=13x31,7x17 frame_size=4096,8192"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import librosa
+import numpy as np
+from harmonic_mix.tivlib import TIV
+import instrumentation
+from main import PRESETS, get_analysis, decode_audio, cut_song, stft_to_harmonic, audio_to_nnls
+from batch import _init_worker, list_songs, thread_limits
+from library import TIVLibrary
+
+SWEEP_FILE = 'sweep.json'
+
+
+def _decode(song_path, _, analysis):
+    return decode_audio(song_path, analysis)
+
+
+def _cut(song_path, song_audio, analysis):
+    return cut_song(song_audio, analysis['song_kept'])
+
+
+def _stft(song_path, song_audio, analysis):
+    return librosa.stft(song_audio, n_fft=analysis['n_fft'], hop_length=analysis['hop_length'])
+
+
+def _hpss(song_path, decomposed, analysis):
+    return stft_to_harmonic(decomposed, analysis['n_fft'], analysis['hop_length'], analysis['kernel_size'])
+
+
+def _chroma(song_path, harmonic, analysis):
+    return audio_to_nnls(harmonic, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'])
+
+
+def _spectrogram(song_path, song_audio, analysis):
+    from spectral import harmonic_spectrogram, spectral_kernel_size
+    return harmonic_spectrogram(song_audio, analysis['sample_rate'], analysis['frame_size'], analysis['hop_size'],
+                                spectral_kernel_size(analysis))
+
+
+def _spectral_chroma(song_path, spectrogram, analysis):
+    from spectral import spectrogram_to_chromagram
+    return np.mean(spectrogram_to_chromagram(spectrogram, analysis['sample_rate']), axis=0)
+
+
+# Steps of the analysis: (name, parameters, function computing the step from the result of the previous one)
+STEPS = [('decode', ['sample_rate'], _decode),
+         ('cut', ['song_kept'], _cut),
+         ('stft', ['n_fft', 'hop_length'], _stft),
+         ('hpss', ['kernel_size'], _hpss),
+         ('chroma', ['frame_size', 'hop_size'], _chroma)]
+SPECTRAL_STEPS = [('decode', ['sample_rate'], _decode),
+                  ('cut', ['song_kept'], _cut),
+                  ('spectrogram', ['frame_size', 'hop_size', 'n_fft', 'hop_length', 'kernel_size'], _spectrogram),
+                  ('chroma', [], _spectral_chroma)]
+
+
+def grid_configurations(grid, preset='reference', spectral=False):
+    """
+    Lists the configurations of a grid of analysis parameters
+
+    :param grid: Dictionary with the list of values of each swept parameter (see main.PRESETS),
+            e.g. {'song_kept': [0.2, 0.3], 'kernel_size': [(13, 31), (7, 17)]}
+    :param preset: Name of the analysis preset giving the parameters that are not swept
+    :param spectral: If True, the chroma is computed with the spectral fast path
+    :return: List of dictionaries with the analysis parameters (see main.get_analysis)
+    """
+
+    base = get_analysis(preset, spectral)
+    unknown = set(grid) - set(PRESETS[preset])
+    if unknown:
+        raise ValueError("Unknown analysis parameters: " + ', '.join(sorted(unknown)))
+    names = sorted(grid)
+    configurations = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        analysis = dict(base, **dict(zip(names, values)))
+        analysis['kernel_size'] = list(analysis['kernel_size'])
+        configurations.append(analysis)
+    return configurations
+
+
+def sweep_song(song_path, configurations):
+    """
+    Computes the TIVs of a track with every configuration, computing each step once
+    for all the configurations that share its parameters and those of the previous steps
+
+    :param song_path: The path of the track
+    :param configurations: List of dictionaries with the analysis parameters. They must all
+            use the same analysis mode (spectral or not).
+    :return: List with the TIV of each configuration
+    """
+
+    steps = SPECTRAL_STEPS if configurations and configurations[0]['spectral'] else STEPS
+    tivs = [None] * len(configurations)
+
+    def branch(value, step, indices):
+        if step == len(steps):
+            tiv = TIV.from_pcp(value)
+            for index in indices:
+                tivs[index] = tiv
+            return
+        name, parameters, function = steps[step]
+        groups = {}
+        for index in indices:
+            key = json.dumps([configurations[index][parameter] for parameter in parameters])
+            groups.setdefault(key, []).append(index)
+        for group in groups.values():
+            with instrumentation.span('stage', 'sweep_' + name, path=song_path):
+                result = function(song_path, value, configurations[group[0]])
+            branch(result, step + 1, group)
+
+    branch(None, 0, list(range(len(configurations))))
+    return tivs
+
+
+def _sweep_worker(song_path, configurations):
+    try:
+        return song_path, [(tiv.vector, tiv.energy) for tiv in sweep_song(song_path, configurations)], None
+    except Exception as error:
+        return song_path, None, repr(error)
+
+
+def run_sweep(song_paths, configurations, output_folder, workers=None, blas_threads=1, progress=None):
+    """
+    Analyzes tracks with every configuration, in parallel, and saves a TIV library per configuration
+
+    :param song_paths: List with the paths of the tracks
+    :param configurations: List of dictionaries with the analysis parameters (see grid_configurations)
+    :param output_folder: Folder of the TIV libraries and of the sweep.json file
+    :param workers: Number of worker processes. Default: number of CPUs
+    :param blas_threads: Number of BLAS/OpenMP threads of each worker
+    :param progress: Optional function called as progress(done, total, song_path, error)
+            every time a track is finished (see batch.analyze_songs)
+    :return: Dictionary with the error message of every track whose analysis failed
+    """
+
+    if len({analysis['spectral'] for analysis in configurations}) > 1:
+        raise ValueError("The configurations of a sweep must all use the same analysis mode")
+    os.makedirs(output_folder, exist_ok=True)
+    library_names = ['config_%03d.tivlib' % index for index in range(len(configurations))]
+    sweep = {'configurations': [{'library': library_name, 'analysis': analysis}
+                                for library_name, analysis in zip(library_names, configurations)]}
+    sweep_path = os.path.join(output_folder, SWEEP_FILE)
+    if os.path.isfile(sweep_path):
+        with open(sweep_path, 'r') as sweep_file:
+            if json.load(sweep_file) != sweep:
+                raise ValueError("%s holds a sweep with other configurations" % output_folder)
+    else:
+        with open(sweep_path, 'w') as sweep_file:
+            json.dump(sweep, sweep_file, indent=2)
+
+    libraries = [TIVLibrary(os.path.join(output_folder, library_name), 'a', analysis)
+                 for library_name, analysis in zip(library_names, configurations)]
+    songs = [song_path for song_path in song_paths
+             if not all(song_path in library for library in libraries)]
+    errors = {}
+    if not songs:
+        return errors
+
+    workers = min(workers or os.cpu_count(), len(songs))
+    with thread_limits(blas_threads), \
+            ProcessPoolExecutor(max_workers=workers,
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker,
+                                initargs=(blas_threads, 1)) as executor:
+        futures = [executor.submit(_sweep_worker, song_path, configurations) for song_path in songs]
+        for done, future in enumerate(as_completed(futures), 1):
+            song_path, tivs, error = future.result()
+            if error is not None:
+                errors[song_path] = error
+            else:
+                for library, (vector, energy) in zip(libraries, tivs):
+                    library.add(song_path, TIV(complex(energy), np.array(vector)))
+            if progress is not None:
+                progress(done, len(songs), song_path, error)
+    return errors
+
+
+def load_sweep(output_folder):
+    """
+    Opens the TIV libraries of a sweep
+
+    :param output_folder: Output folder of the sweep
+    :return: List of (analysis parameters, TIVLibrary) tuples, one per configuration
+    """
+
+    with open(os.path.join(output_folder, SWEEP_FILE), 'r') as sweep_file:
+        sweep = json.load(sweep_file)
+    return [(configuration['analysis'], TIVLibrary(os.path.join(output_folder, configuration['library'])))
+            for configuration in sweep['configurations']]
+
+
+def parse_grid(items):
+    """
+    Parses grid parameters given as name=value,value... (kernel sizes as 13x31)
+
+    :param items: List of strings
+    :return: Dictionary with the list of values of each parameter
+    """
+
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        if not values:
+            raise ValueError("Grid parameters are given as name=value,value...: " + item)
+        if name == 'kernel_size':
+            grid[name] = [tuple(int(size) for size in value.split('x')) for value in values.split(',')]
+        elif name == 'song_kept':
+            grid[name] = [float(value) for value in values.split(',')]
+        else:
+            grid[name] = [int(value) for value in values.split(',')]
+    return grid
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Analyze music folders with a grid of analysis parameters")
+    parser.add_argument('folders', nargs='+', help="music folders")
+    parser.add_argument('--output', required=True, help="output folder of the TIV libraries")
+    parser.add_argument('--grid', nargs='+', default=[],
+                        help="swept parameters, e.g. song_kept=0.2,0.3 kernel_size=13x31,7x17 frame_size=4096,8192")
+    parser.add_argument('--preset', default='reference', choices=sorted(PRESETS),
+                        help="preset of the parameters that are not swept")
+    parser.add_argument('--spectral', action='store_true', help="use the spectral fast path")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--blas-threads', type=int, default=1, help="BLAS threads per worker")
+    args = parser.parse_args()
+
+    configurations = grid_configurations(parse_grid(args.grid), args.preset, args.spectral)
+
+    def print_progress(done, total, song_path, error):
+        status = 'failed: ' + error if error is not None else 'done'
+        print(round(done * 100 / total, 1), '% progress completed -', os.path.basename(song_path), status)
+
+    song_paths = [song_path for folder in args.folders for song_path in list_songs(folder)]
+    print("%d configurations, %d tracks" % (len(configurations), len(song_paths)))
+    errors = run_sweep(song_paths, configurations, args.output, args.workers, args.blas_threads, print_progress)
+    print("Sweep completed" if not errors else "Sweep completed, %d tracks failed" % len(errors))
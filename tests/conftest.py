@@ -0,0 +1,23 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""Makes the modules of the repository importable from the tests: the
+flat modules from the repository folder, and tivlib as
+harmonic_mix.tivlib, whatever the name of the clone."""
+
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+if importlib.util.find_spec('harmonic_mix') is None:
+    package = types.ModuleType('harmonic_mix')
+    package.__path__ = [ROOT]
+    sys.modules['harmonic_mix'] = package
@@ -0,0 +1,37 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""The streaming mode is part of the saved analysis parameters, so its
+TIVs are not taken for the ones of the default analysis."""
+
+import os
+import numpy as np
+import pytest
+from harmonic_mix.tivlib import TIV
+from cache import analysis_fingerprint
+from main import get_analysis, get_analysis_label, get_annotation_path, is_analyzed, save_analysis
+
+
+def test_streaming_analysis_has_its_own_parameters():
+    streaming = get_analysis(streaming=True)
+
+    assert streaming != get_analysis()
+    assert analysis_fingerprint(streaming) != analysis_fingerprint(get_analysis())
+    assert get_analysis_label(streaming) == 'reference/streaming'
+    with pytest.raises(ValueError):
+        get_analysis(spectral=True, streaming=True)
+    with pytest.raises(ValueError):
+        get_analysis(windows=2, streaming=True)
+
+
+def test_streamed_track_is_not_analyzed_for_the_default_analysis(tmp_path):
+    song_path = str(tmp_path / 'track.mp3')
+    with open(song_path, 'wb') as song_file:
+        song_file.write(np.random.default_rng(0).bytes(4096))
+    os.makedirs(os.path.dirname(get_annotation_path(song_path)))
+    save_analysis(song_path, TIV.from_pcp(np.ones(12) + np.arange(12)), get_analysis(streaming=True))
+
+    assert is_analyzed(song_path, get_analysis(streaming=True))
+    assert not is_analyzed(song_path, get_analysis())
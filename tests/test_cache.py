@@ -0,0 +1,57 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""Annotations written before the analysis parameters and the content
+hash were stored (only the TIV) follow renamed tracks, and are analyzed
+again when their track is replaced."""
+
+import json
+import os
+import numpy as np
+from harmonic_mix.tivlib import TIV
+from batch import pending_songs
+from cache import scan_folders
+from main import get_analysis, get_annotation_path, is_analyzed, tiv_fields
+
+
+def write_legacy_track(song_path, seed):
+    """A track with an annotation that only has the TIV fields"""
+    rng = np.random.default_rng(seed)
+    with open(song_path, 'wb') as song_file:
+        song_file.write(rng.bytes(4096))
+    annotation_path = get_annotation_path(song_path)
+    os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+    fields = {key: value for key, value in tiv_fields(TIV.from_pcp(rng.random(12))).items()
+              if key.startswith('TIV.')}
+    with open(annotation_path, 'w') as annotation_file:
+        json.dump(fields, annotation_file)
+
+
+def test_legacy_annotation_follows_a_renamed_track(tmp_path):
+    folder = str(tmp_path)
+    write_legacy_track(folder + '/old name.mp3', seed=0)
+
+    assert scan_folders([folder])['current'] == [folder + '/old name.mp3']
+    os.rename(folder + '/old name.mp3', folder + '/new name.mp3')
+    result = scan_folders([folder])
+
+    assert result['moved'] == [folder + '/new name.mp3']
+    assert not os.path.exists(get_annotation_path(folder + '/old name.mp3'))
+    assert pending_songs([folder + '/new name.mp3']) == []
+
+
+def test_legacy_annotation_of_a_replaced_track_is_not_current(tmp_path):
+    folder = str(tmp_path)
+    song_path = folder + '/track.mp3'
+    write_legacy_track(song_path, seed=1)
+
+    assert scan_folders([folder])['current'] == [song_path]
+    with open(song_path, 'wb') as song_file:
+        song_file.write(np.random.default_rng(2).bytes(8192))
+    result = scan_folders([folder])
+
+    assert result['pending'] == [song_path]
+    assert not is_analyzed(song_path, get_analysis())
+    assert pending_songs([song_path]) == [song_path]
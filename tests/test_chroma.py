@@ -0,0 +1,40 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""The NumPy chroma frontend gives the chroma of essentia's LogSpectrum
+and NNLSChroma, on synthetic audio."""
+
+import numpy as np
+import pytest
+from chroma import audio_to_chromagram
+from main import SR, FRAME_SIZE, HOP_SIZE
+
+pytest.importorskip('essentia')
+
+TOLERANCE = 5e-5  # relative to the largest chroma value
+
+
+def chord_audio(midi_notes, seconds, seed):
+    """A chord of harmonic tones, slightly detuned, with some noise"""
+    rng = np.random.default_rng(seed)
+    time = np.arange(int(seconds * SR)) / SR
+    audio = 0.01 * rng.standard_normal(time.size)
+    for note in midi_notes:
+        frequency = 440 * 2 ** ((note - 69 + 0.1) / 12)
+        for harmonic in range(1, 6):
+            audio += np.sin(2 * np.pi * harmonic * frequency * time + rng.random() * 2 * np.pi) / harmonic ** 2
+    return (0.1 * audio).astype(np.float32)
+
+
+@pytest.mark.parametrize('midi_notes', [(48, 64, 67, 72), (45, 57, 60, 64, 71)])
+def test_numpy_chroma_matches_essentia(midi_notes):
+    from main import essentia_chromagram
+    audio = chord_audio(midi_notes, 3, seed=midi_notes[0])
+
+    expected = essentia_chromagram(audio, SR, FRAME_SIZE, HOP_SIZE)
+    chromagram = audio_to_chromagram(audio, SR, FRAME_SIZE, HOP_SIZE)
+
+    assert chromagram.shape == expected.shape
+    assert np.max(np.abs(chromagram - expected)) <= TOLERANCE * np.max(np.abs(expected))
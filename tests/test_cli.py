@@ -0,0 +1,39 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""A target track outside the ranked tracks must come from the same
+analysis as them."""
+
+import os
+import numpy as np
+import pytest
+from harmonic_mix.tivlib import TIV
+from cli import build_parser
+from main import get_analysis, get_annotation_path, save_tiv
+
+
+def annotate(song_path, analysis, seed):
+    with open(song_path, 'wb') as song_file:
+        song_file.write(b'')
+    annotation_path = get_annotation_path(song_path)
+    os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+    save_tiv(annotation_path, TIV.from_pcp(np.random.default_rng(seed).random(12)), analysis)
+
+
+@pytest.mark.parametrize('preset, ranked', [('reference', True), ('fast', False)])
+def test_rank_checks_the_analysis_of_the_target(tmp_path, preset, ranked):
+    folder = tmp_path / 'library'
+    folder.mkdir()
+    for i in range(3):
+        annotate(str(folder / ('track%d.mp3' % i)), get_analysis(), seed=i)
+    target = str(tmp_path / 'target.mp3')
+    annotate(target, get_analysis(preset), seed=3)
+    args = build_parser().parse_args(['rank', target, str(folder), '--output', str(tmp_path / 'ranking.csv')])
+
+    if ranked:
+        assert args.function(args) == 0
+    else:
+        with pytest.raises(ValueError):
+            args.function(args)
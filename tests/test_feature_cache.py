@@ -0,0 +1,47 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""Entries of the feature cache depend on the decoder, and an entry
+removed by another process right after it is written is still returned."""
+
+import os
+import numpy as np
+import feature_cache
+import main
+from feature_cache import FeatureCache
+from main import get_analysis
+
+
+def write_track(song_path):
+    with open(song_path, 'wb') as song_file:
+        song_file.write(np.random.default_rng(0).bytes(4096))
+
+
+def test_entries_depend_on_the_decoder(tmp_path, monkeypatch):
+    song_path = str(tmp_path / 'track.mp3')
+    write_track(song_path)
+    cache = FeatureCache(str(tmp_path / 'cache'))
+
+    monkeypatch.setattr(main, 'DECODER', 'essentia')
+    essentia_path = cache.entry_path(song_path, 'audio', get_analysis())
+    monkeypatch.setattr(main, 'DECODER', 'librosa')
+
+    assert cache.entry_path(song_path, 'audio', get_analysis()) != essentia_path
+
+
+def test_put_survives_a_concurrent_eviction(tmp_path, monkeypatch):
+    song_path = str(tmp_path / 'track.mp3')
+    write_track(song_path)
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    array = np.arange(1000, dtype=np.float32)
+
+    def replace_and_evict(source, destination):
+        # Another worker evicts the entry as soon as it is in place
+        os.rename(source, destination)
+        os.remove(destination)
+
+    monkeypatch.setattr(feature_cache.os, 'replace', replace_and_evict)
+
+    np.testing.assert_array_equal(cache.put(song_path, 'audio', get_analysis(), array), array)
@@ -0,0 +1,51 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""Reading tracks again, e.g. as they are analyzed, keeps the cached
+rankings equal to the rankings of a library read from scratch."""
+
+import os
+import numpy as np
+from harmonic_mix.tivlib import TIV
+from main import get_annotation_path, save_tiv
+from ranking import COLUMNS, LibraryCache
+
+
+def annotate(song_path, rng):
+    annotation_path = get_annotation_path(song_path)
+    os.makedirs(os.path.dirname(annotation_path), exist_ok=True)
+    save_tiv(annotation_path, TIV.from_pcp(rng.random(12) ** 3))
+
+
+def assert_same_ranking(ranking, expected):
+    for column in COLUMNS:
+        np.testing.assert_allclose(ranking.values[column], expected.values[column])
+
+
+def test_load_updates_the_cached_rankings(tmp_path):
+    rng = np.random.default_rng(0)
+    song_paths = [str(tmp_path / ('track%d.mp3' % i)) for i in range(8)]
+    for song_path in song_paths[:5]:
+        annotate(song_path, rng)
+    library = LibraryCache(song_paths)
+    library.load()
+    library.ranking(song_paths[0])
+    library.ranking(song_paths[2])
+    displayed = library.cached(song_paths[0])
+    displayed_values = {column: displayed.values[column].copy() for column in COLUMNS}
+
+    # A new track and a track analyzed again
+    annotate(song_paths[6], rng)
+    annotate(song_paths[2], rng)
+    assert library.load([song_paths[6], song_paths[2]]) == 2
+
+    assert library.cached(song_paths[2]) is None
+    fresh = LibraryCache(song_paths)
+    fresh.load()
+    assert_same_ranking(library.cached(song_paths[0]), fresh.ranking(song_paths[0]))
+    assert not np.isnan(library.cached(song_paths[0]).values['HC'][6])
+    # The ranking displayed before the update does not change
+    for column in COLUMNS:
+        np.testing.assert_array_equal(displayed.values[column], displayed_values[column])
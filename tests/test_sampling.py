@@ -0,0 +1,41 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""With one window, the sampled analysis gives the TIV of the default
+analysis of the central part of the song, on a synthetic track."""
+
+import numpy as np
+import soundfile
+from harmonic_mix.tivlib import TIV
+from main import SR, get_analysis, harmonic_part, audio_to_nnls
+from sampling import sampled_tiv
+
+TOLERANCE = 1e-4
+
+
+def write_track(path, seconds=12, seed=0):
+    """A track of harmonic tones that change every second, with some noise"""
+    rng = np.random.default_rng(seed)
+    time = np.arange(int(seconds * SR)) / SR
+    notes = rng.integers(45, 75, size=(seconds, 3))[np.minimum(time.astype(int), seconds - 1)]
+    audio = 0.01 * rng.standard_normal(time.size)
+    for voice in range(notes.shape[1]):
+        frequency = 440 * 2 ** ((notes[:, voice] - 69) / 12)
+        for harmonic in range(1, 5):
+            audio += np.sin(2 * np.pi * harmonic * frequency * time) / harmonic ** 2
+    soundfile.write(str(path), 0.1 * audio, SR, subtype='FLOAT')
+
+
+def test_single_window_matches_default_analysis(tmp_path):
+    song_path = str(tmp_path / 'track.wav')
+    write_track(song_path)
+    analysis = get_analysis()
+
+    expected = TIV.from_pcp(audio_to_nnls(harmonic_part(song_path, analysis), analysis['sample_rate'],
+                                          analysis['frame_size'], analysis['hop_size']))
+    tiv = sampled_tiv(song_path, get_analysis(windows=1))
+
+    np.testing.assert_allclose(tiv.energy, expected.energy, rtol=TOLERANCE)
+    np.testing.assert_allclose(tiv.vector, expected.vector, atol=TOLERANCE)
@@ -0,0 +1,61 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""The top-k search gives the ranking of the brute-force comparison of
+the target track with every track (compare_songs), on synthetic TIVs."""
+
+import numpy as np
+import pytest
+from harmonic_mix.tivlib import TIV
+from main import scale
+from search import CompatibilityIndex
+
+N_TRACKS = 200
+
+
+def random_tivs(n, seed):
+    rng = np.random.default_rng(seed)
+    return [TIV.from_pcp(rng.random(12) ** 3) for _ in range(n)]
+
+
+def brute_force_top_k(query, tivs, k, max_shift, excluded=None):
+    """Ranking of compare_songs: the best harmonic compatibility of every candidate transposed up to max_shift"""
+    results = []
+    for position, candidate in enumerate(tivs):
+        if position == excluded:
+            continue
+        best = None
+        for shift in range(-max_shift, max_shift + 1):
+            harmonic_compatibility = float(scale(100 * (1 - candidate.transpose(shift).small_scale_compatibility(query))))
+            if best is None or harmonic_compatibility > best[0]:
+                best = (harmonic_compatibility, (shift + 6) % 12 - 6)
+        results.append((position, best[0], best[1]))
+    results.sort(key=lambda result: -result[1])
+    return results[:k]
+
+
+@pytest.mark.parametrize('max_shift', [0, 2, 6])
+def test_top_k_matches_brute_force(max_shift):
+    tivs = random_tivs(N_TRACKS, seed=max_shift)
+    index = CompatibilityIndex(range(N_TRACKS), [tiv.vector for tiv in tivs], [tiv.energy for tiv in tivs])
+    query = random_tivs(1, seed=100 + max_shift)[0]
+
+    results = index.top_k(query, k=10, max_shift=max_shift)
+    expected = brute_force_top_k(query, tivs, 10, max_shift)
+
+    assert [result[0] for result in results] == [result[0] for result in expected]
+    np.testing.assert_allclose([result[1] for result in results], [result[1] for result in expected], atol=1e-6)
+    assert [result[2] for result in results] == [result[2] for result in expected]
+
+
+def test_top_k_excludes_the_query_track():
+    tivs = random_tivs(N_TRACKS, seed=7)
+    index = CompatibilityIndex(range(N_TRACKS), [tiv.vector for tiv in tivs], [tiv.energy for tiv in tivs])
+
+    results = index.top_k(3, k=N_TRACKS, max_shift=1)
+    expected = brute_force_top_k(tivs[3], tivs, N_TRACKS, 1, excluded=3)
+
+    assert len(results) == N_TRACKS - 1
+    assert [result[0] for result in results] == [result[0] for result in expected]
@@ -0,0 +1,64 @@
+# Copyright (c) 2021 Gabriel Bibbó, Music Technology Grup, University Pompeu Fabra
+# This is an open-access library distributed under the terms of the Creative Commons Attribution 3.0 Unported License, which permits unrestricted use, distribution, and reproduction in any medium, provided the
+# original author and source are credited.
+# Released under MIT License.
+
+"""The exact sequencing (dynamic programming over the subsets of tracks)
+finds the best set among all the orders of the tracks, on synthetic TIVs."""
+
+import itertools
+import numpy as np
+import pytest
+from harmonic_mix.tivlib import TIV
+from compatibility import transposition_matrices
+from sequencing import sequence_tracks
+
+N_TRACKS = 7
+
+
+def random_scores(n, seed):
+    rng = np.random.default_rng(seed)
+    return transposition_matrices([TIV.from_pcp(rng.random(12) ** 3) for _ in range(n)])
+
+
+def set_total(scores, order, pitch_shifts):
+    return sum(scores[(shift - previous_shift) % 12, previous, track]
+               for previous, track, previous_shift, shift in zip(order, order[1:], pitch_shifts, pitch_shifts[1:]))
+
+
+def brute_force_total(scores, start, length, max_shifts):
+    """Best total compatibility among all the orders, and all the choices of the transposed tracks"""
+    n = scores.shape[1]
+    best_shift = np.argmax(scores, axis=0)
+    best = -np.inf
+    others = [track for track in range(n) if track != start]
+    for rest in itertools.permutations(others, length - 1):
+        order = (start,) + rest
+        for transposed in itertools.product((False, True), repeat=length - 1):
+            if sum(transposed) > max_shifts:
+                continue
+            total, shift = 0.0, 0
+            for last, track, is_transposed in zip(order, order[1:], transposed):
+                if is_transposed:
+                    shift = (shift + best_shift[last, track]) % 12
+                    if shift == 0:
+                        break
+                    total += scores[best_shift[last, track], last, track]
+                else:
+                    total += scores[-shift % 12, last, track]
+                    shift = 0
+            else:
+                best = max(best, total)
+    return best
+
+
+@pytest.mark.parametrize('length, max_shifts', [(N_TRACKS, 0), (N_TRACKS, 2), (5, 0), (5, 4)])
+def test_exact_matches_brute_force(length, max_shifts):
+    scores = random_scores(N_TRACKS, seed=length + max_shifts)
+
+    order, pitch_shifts = sequence_tracks(scores, 2, length, max_shifts, method='exact')
+
+    assert order[0] == 2
+    assert len(order) == length and len(set(order)) == length
+    assert sum(shift != 0 for shift in pitch_shifts) <= max_shifts
+    np.testing.assert_allclose(set_total(scores, order, pitch_shifts), brute_force_total(scores, 2, length, max_shifts))
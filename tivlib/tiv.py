@@ -8,6 +8,10 @@ import matplotlib.pyplot as plt
 
 epsilon = np.finfo(float).eps
 
+# Complex rotations that transpose a TIV vector by 0 to 11 semitones (row k: k semitones)
+TRANSPOSITIONS = np.exp(-2j * np.pi * np.arange(12)[:, np.newaxis] * np.arange(1, 7)[np.newaxis, :] / 12)
+TRANSPOSITIONS.flags.writeable = False
+
 class TIV:
 
     weights = [3, 8, 11.5, 15, 14.5, 7.5]
@@ -152,20 +156,7 @@ class TIV:
         return TIV(self.energy+tiv2.energy, (self.energy * self.vector + tiv2.energy * tiv2.vector) / (self.energy + tiv2.energy))
 
     def key(self, mode='temperley'):
-        if mode == 'temperley':
-            profiles = self.temperley_profiles
-            alpha = 0.55
-        else:
-            profiles = self.shaath_profiles
-            alpha = 0.2
-
-        alpha_tiv = TIV(0, self.vector * alpha)
-        distance = []
-
-        for profile in profiles:
-            distance.append(TIV.euclidean(alpha_tiv, TIV(0,profile)))
-
-        index = np.argmin(distance)
+        index = estimate_keys(self.vector, mode)
         mode = 'maj'
 
         if index >= 12:
@@ -234,16 +225,8 @@ class TIV:
         Get all 12 possible transpositions of the vector
         :return: list containing the 12 transpositions
         """
-        n = 12
-        mod = np.abs(self.vector)
-        phase = 1j * np.angle(self.vector)
-        matmul = -2j * np.pi * (np.ones((6, 12), dtype=np.float64) * np.arange(12))
-        semitones = np.arange(1, 7)
-        semitones = semitones[:, np.newaxis]
-        phase_transposition = semitones * matmul / n  # 12 phase transpositions for each interval
-        transposed_phase = phase_transposition + phase[:, np.newaxis]
-        transposed_vector = mod[:, np.newaxis] * np.exp(transposed_phase)
-        return [TIV(self.energy, transposed_vector[:, i]) for i in range(12)]
+        transposed_vectors = transpose_vectors(self.vector)
+        return [TIV(self.energy, transposed_vectors[i]) for i in range(12)]
 
 
     def small_scale_compatibility(self, cand_TIV):
@@ -268,15 +251,8 @@ class TIV:
         :param tiv2: The other tiv2 to compare to.
         :return: Number of pitch shifts to apply, small scale compatibility for that pitch shift.
         """
-        tiv_tranpositions = tiv2.get_12_transposes()
-        dissonances = []
-        for tiv_tranposition in tiv_tranpositions:
-            dissonances.append(self.small_scale_compatibility(tiv_tranposition))
-        dissonances = np.array(dissonances)
-        pitch_shift = np.argmin(dissonances)
-        if pitch_shift > 5:
-            pitch_shift = pitch_shift - 12
-        return pitch_shift, min(dissonances)
+        pitch_shift, min_compatibility = max_compatibilities(self.vector, tiv2.vector)
+        return int(pitch_shift), float(min_compatibility)
 
     def hchange(self):
         tiv_array = self.vector
@@ -299,7 +275,9 @@ class TIV:
 
 class TIVCollection(TIV):
     """
-    Class to handle lists of TIV. To handle with ease compatibility between audio excerpts
+    Class to handle lists of TIV. To handle with ease compatibility between audio excerpts.
+    The TIVs are stored in contiguous energy (SxN) and vector (SxNx6) arrays; TIV objects
+    are only created when they are accessed.
     """
     def __init__(self, tivlist):
         """
@@ -309,23 +287,101 @@ class TIVCollection(TIV):
         if not all([isinstance(element, list) for element in tivlist]):
             tivlist = [tivlist]
 
-        if not all([ [isinstance(tivi, TIV) for tivi in innertivlist] for innertivlist in tivlist] ):
+        if not all([isinstance(tivi, TIV) for innertivlist in tivlist for tivi in innertivlist]):
             raise TypeError("Some element in the list is not a TIV object")
 
-
-        self.tivlist = tivlist  # Nested list of TIV sequences
-        self.weights = tivlist[0][0].weights
+        self._tivlist = tivlist  # Nested list of TIV sequences
         self.energies = np.array([ [i.energy for i in innertivlist] for innertivlist in tivlist] )
         self.vectors =  np.array([ [i.vector for i in innertivlist] for innertivlist in tivlist] )
         S, N = self.energies.shape[0], self.energies.shape[1]
         self.shape = (S, N)
 
+    @classmethod
+    def from_arrays(cls, energies, vectors):
+        """
+        Wrap energy and vector arrays in a TIVCollection without copying them or creating TIV objects
+        :param energies: N or SxN array with the energy of each TIV
+        :param vectors: Nx6 or SxNx6 complex array with the vector of each TIV
+        :return: TIVCollection object whose energies and vectors are views of the given arrays
+        """
+        energies = np.asarray(energies)
+        vectors = np.asarray(vectors)
+        if energies.ndim == 1:
+            energies = energies[np.newaxis, :]
+            vectors = vectors[np.newaxis, :, :]
+        if vectors.shape != energies.shape + (6,):
+            raise ValueError("Energies and vectors shapes do not match")
+
+        tivcol = cls.__new__(cls)
+        tivcol._tivlist = None
+        tivcol.energies = energies
+        tivcol.vectors = vectors
+        tivcol.shape = energies.shape
+        return tivcol
+
+    @classmethod
+    def concatenate(cls, tivcols, axis=1):
+        """
+        Join several TIVCollections into a new one
+        :param tivcols: List of TIVCollection objects
+        :param axis: 1 to join the TIVs of each sequence (the collections must have the same number of sequences),
+                     0 to join the sequences (the collections must have the same number of TIVs per sequence)
+        :return: TIVCollection object
+        """
+        if axis not in (0, 1):
+            raise ValueError("TIVCollections can only be joined along axis 0 (sequences) or 1 (TIVs)")
+        energies = np.concatenate([tivcol.energies for tivcol in tivcols], axis=axis)
+        vectors = np.concatenate([tivcol.vectors for tivcol in tivcols], axis=axis)
+        return cls.from_arrays(energies, vectors)
+
+    @property
+    def tivlist(self):
+        """
+        Nested list of TIV sequences, built from the arrays on first access
+        """
+        if self._tivlist is None:
+            self._tivlist = [self._sequence(s) for s in range(self.shape[0])]
+        return self._tivlist
+
+    def _sequence(self, s):
+        """
+        List with the TIVs of sequence s, whose vectors are views of the collection arrays
+        """
+        if self._tivlist is not None:
+            return self._tivlist[s]
+        return [TIV(energy, vector) for energy, vector in zip(self.energies[s], self.vectors[s])]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for s in range(self.shape[0]):
+            yield self._sequence(s)
+
     def __getitem__(self, item):
-        return self.tivlist[item]
+        """
+        col[s] returns the list of TIVs of sequence s and col[s, n] the TIV n of sequence s.
+        Slices (col[a:b], col[s, a:b], col[:, a:b]...) return a TIVCollection whose arrays are views of this one.
+        """
+        if isinstance(item, (int, np.integer)):
+            return self._sequence(range(self.shape[0])[item])
+        if isinstance(item, tuple) and len(item) == 2 and all(isinstance(i, (int, np.integer)) for i in item):
+            return TIV(self.energies[item], self.vectors[item])
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) > 2:
+            raise IndexError("TIVCollections only have two dimensions")
+        # Integer indices are turned into length one slices, so that the result keeps both dimensions
+        item = tuple(slice(i, i + 1 or None) if isinstance(i, (int, np.integer)) else i for i in item)
+        return TIVCollection.from_arrays(self.energies[item], self.vectors[item])
 
     def __repr__(self):
+        S, N = self.shape
         return f"TIVCollection ({S} sequences of {N} TIVs)"
 
+    def __str__(self):
+        return self.__repr__()
+
     @classmethod
     def from_pcp(cls, pcp):
         """
@@ -342,37 +398,18 @@ class TIVCollection(TIV):
         else:
             raise TypeError("Vector is not compatible with PCP")
 
-        S, _, N = pcp.shape
-
-        if fft.ndim == 1:
-            fft = fft[:, np.newaxis]
         energy = fft[:, 0, :] + epsilon
         vector = fft[:, 1:7, :]
         vector = ((vector / energy[:, np.newaxis]) * np.array(cls.weights)[:, np.newaxis])
-        return cls( [[TIV(energy[s, n], vector[s, :, n]) for n in range(N) ] for s in range(S)] )
+        return cls.from_arrays(energy, np.ascontiguousarray(vector.transpose(0, 2, 1)))
 
     def get_12_transposes(self):
         """
         Get all 12 possible transpositions for a TIVCollection
         :return:List with all 12 possible transpositions [0-11]
         """
-        n = 12
-        mod = np.abs(self.vectors)
-        phase = 1j * np.angle(self.vectors)
-        matmul = -2j * np.pi * (np.arange(12)[:, np.newaxis] * np.ones((6, 12, len(self.tivlist)), dtype=np.float64))
-        matmul = np.transpose(matmul, axes=(2, 0, 1))
-        semitones = np.arange(1, 7, dtype=np.float64)
-        semitones = semitones[:, np.newaxis]
-        phase_transposition = semitones * matmul / n
-        new_phase = phase[:, :, np.newaxis] + phase_transposition
-        new_vectors = mod[:, :, np.newaxis] * np.exp(new_phase)
-        tivlists = []  # Will be length 12 containing all the 12 pitch shifts.
-        for shift in range(n):
-            set_tivs = []  # Aux variable to hold the set of tivs for this shift
-            for tiv in range(len(self.energies)):
-                set_tivs.append(TIV(self.energies[tiv], new_vectors[tiv, :, shift]))
-            tivlists.append(TIVCollection(set_tivs))
-        return tivlists
+        new_vectors = transpose_vectors(self.vectors)  # S x N x 12 x 6
+        return [TIVCollection.from_arrays(self.energies, new_vectors[:, :, shift]) for shift in range(12)]
 
     def small_scale_compatibility(self, tivcol2):
         """
@@ -399,16 +436,77 @@ class TIVCollection(TIV):
 
     def get_max_compatibility(self, tivcol2):
         """
-        Get the pitch shift that minimizes the small scale compatibility measure
+        Get the pitch shift that minimizes the small scale compatibility measure, for each pair of TIVs
         :param tivcol2: TIVCollection object to compare against
-        :return: A tuple containing pitch shift and small scale compatibility
+        :return: A tuple containing the pitch shift and small scale compatibility arrays (one value per TIV of tivcol2)
         """
-        tiv2transposes = tivcol2.get_12_transposes()
-        compatibilities = np.zeros(12)
-        for idx, transpose in enumerate(tiv2transposes):
-            compatibilities[idx] = self.small_scale_compatibility(transpose)
-
-        pitch_shift = np.argmin(compatibilities)
-        if pitch_shift > 5:
-            pitch_shift = pitch_shift - 12
-        return pitch_shift, np.min(compatibilities)
+        if tivcol2.shape[1] != self.shape[1]:
+            raise ValueError("Compatibility between different TIVCollections sizes are not supported yet")
+        if self.shape[0] != 1:
+            raise ValueError("Query TIV can only have 1 sequence")
+        return max_compatibilities(self.vectors, tivcol2.vectors)
+
+
+def transpose_vectors(vectors, n_semitones=None):
+    """
+    Transpose TIV vectors with the precomputed rotation table, without creating TIV objects
+    :param vectors: Array of TIV vectors (...x6)
+    :param n_semitones: Number of semitones to transpose (negative or positive). None for all 12 transpositions
+    :return: Transposed vectors (...x6), or all 12 transpositions (...x12x6)
+    """
+    vectors = np.asarray(vectors)
+    if n_semitones is None:
+        return vectors[..., np.newaxis, :] * TRANSPOSITIONS
+    return vectors * TRANSPOSITIONS[n_semitones % 12]
+
+
+def estimate_keys(vectors, mode='temperley'):
+    """
+    Estimate the key of many TIV vectors at once, scoring them against all key profiles with one matrix product
+    (the array version of TIV.key)
+    :param vectors: Array of TIV vectors (6 or Nx6)
+    :param mode: 'temperley' or 'shaath' key profiles
+    :return: Index (or array of indices) of the closest key profile, in TIV.key_labels order (0-11 major, 12-23 minor)
+    """
+    if mode == 'temperley':
+        profiles = np.array(TIV.temperley_profiles)
+        alpha = 0.55
+    else:
+        profiles = np.array(TIV.shaath_profiles)
+        alpha = 0.2
+
+    vectors = alpha * np.asarray(vectors)
+    # Squared euclidean distances, without the norm of each vector (it does not change the closest profile)
+    distances = np.sum(np.abs(profiles) ** 2, axis=1) - 2 * np.real(vectors @ np.conj(profiles).T)
+    return np.argmin(distances, axis=-1)
+
+
+def small_scale_compatibilities(vectors1, vectors2):
+    """
+    Small scale compatibility between pairs of TIV vectors, as TIV.small_scale_compatibility
+    :param vectors1: Array of TIV vectors (...x6)
+    :param vectors2: Array of TIV vectors (...x6), broadcastable against vectors1
+    :return: Array with the small scale compatibility of each pair
+    """
+    weights_norm = np.linalg.norm(TIV.weights)
+    relatedness_norm = np.linalg.norm(vectors1 - vectors2, axis=-1) / (2 * weights_norm)
+    dissonance_norm = 1 - np.linalg.norm(vectors1 + vectors2, axis=-1) / (2 * weights_norm)
+    return dissonance_norm * relatedness_norm
+
+
+def max_compatibilities(vectors1, vectors2, shifts=None):
+    """
+    Pitch shift of vectors2 that minimizes the small scale compatibility with vectors1, for many pairs at once
+    (the array version of TIV.get_max_compatibility)
+    :param vectors1: Array of TIV vectors (...x6)
+    :param vectors2: Array of candidate TIV vectors (...x6), broadcastable against vectors1
+    :param shifts: Transpositions allowed for the candidates, in semitones. Default: all 12
+    :return: Array of pitch shifts (in [-6, 5]), array with the small scale compatibility for those pitch shifts
+    """
+    shifts = np.arange(12) if shifts is None else np.unique(np.asarray(shifts) % 12)
+    transposed = np.asarray(vectors2)[..., np.newaxis, :] * TRANSPOSITIONS[shifts]
+    compatibilities = small_scale_compatibilities(np.asarray(vectors1)[..., np.newaxis, :], transposed)
+    best = np.argmin(compatibilities, axis=-1)
+    pitch_shift = shifts[best]
+    pitch_shift = np.where(pitch_shift > 5, pitch_shift - 12, pitch_shift)
+    return pitch_shift, np.take_along_axis(compatibilities, best[..., np.newaxis], axis=-1)[..., 0]
@@ -12,76 +12,139 @@ from tkinter import filedialog as fd
 from tkinter.constants import DISABLED, NORMAL
 import os
 import ntpath
-from os import walk
-from main import compare_songs, analyze_song
+import numpy as np
+from batch import list_songs
+from background import POLL_INTERVAL, analysis_job, library_job, library_ranking_job
+from ranking import LibraryCache
+
+VISIBLE_ROWS = 30  # rows of the table; only these rows are rendered
 
 folderpath = ''  # <---container
+songs = []  # paths of the tracks, in folder order
+library = None  # in-memory TIVs of the folder and cached rankings
+target = None  # path of the target track
+current = None  # ranking of the target track
+sort_column = None  # column the table is sorted by (None: folder order)
+descending = True
+offset = 0  # position of the first visible row
+analysis = None  # background analysis job
+ranking = None  # background ranking job
+loading = None  # background library loading job
 
 # this is the function called when the "Music Folder" button is clicked
 def music_button():
 	""" Display the file path finder to select the music folder."""
 	
-	global folderpath
+	global folderpath, songs, library, target, current, sort_column, offset, loading
 	folderpath = fd.askdirectory()
-	text1.configure(text=folderpath[0:75])
-	text2.configure(text=folderpath[75:])
+	text1.configure(text=folderpath[0:60])
+	text2.configure(text=folderpath[60:])
 	text3.configure(text="")
 	text4.configure(text="")
-	e.delete(*e.get_children())
-	row = 0
-	for (dirpath, dirnames, filenames) in walk(folderpath):
-		for file in filenames:
-			e.insert('', 'end', values=(file.replace(".mp3", ""),
-										'',
-										'',
-										''))
-			row = row + 1
-		break
+	cancel_ranking()
+	songs = list_songs(folderpath) if folderpath else []
+	library = LibraryCache(songs)
+	loading = library_job(library)
+	target = None
+	current = None
+	sort_column = None
+	offset = 0
+	render()
 
 	print(folderpath)
 
+def display_order():
+	"""Index of the tracks, in display order"""
+
+	if current is None:
+		return np.arange(len(songs))
+	return current.order(sort_column, descending)
+
+def render():
+	"""Displays the visible rows of the table, from the cached ranking of the target track."""
+
+	order = display_order()
+	for position, item in enumerate(row_items):
+		if offset + position < len(order):
+			index = order[offset + position]
+			if current is None:
+				song_path, harmonic_compatibility, pitch_shift, min_small_scale_comp = songs[index], None, None, None
+			else:
+				song_path, harmonic_compatibility, pitch_shift, min_small_scale_comp = current.row(index)
+			e.item(item, values=(ntpath.basename(song_path).replace(".mp3", ""),
+								 '' if harmonic_compatibility is None else str(round(harmonic_compatibility, 1)),
+								 '' if pitch_shift is None else '  ' + str(pitch_shift),
+								 '' if min_small_scale_comp is None else str(round(min_small_scale_comp, 1))))
+		else:
+			e.item(item, values=('', '', '', ''))
+	if len(order) > 0:
+		scrollbar.set(offset / len(order), min(1, (offset + VISIBLE_ROWS) / len(order)))
+	else:
+		scrollbar.set(0, 1)
+
+def scroll_to(position):
+	global offset
+	offset = int(max(0, min(position, len(songs) - VISIBLE_ROWS)))
+	render()
+
+def scroll_view(*args):
+	"""Called by the scrollbar: ('moveto', fraction) or ('scroll', number, 'units' or 'pages')"""
+
+	if args[0] == 'moveto':
+		scroll_to(round(float(args[1]) * len(songs)))
+	elif args[0] == 'scroll':
+		step = VISIBLE_ROWS if args[2] == 'pages' else 1
+		scroll_to(offset + int(args[1]) * step)
+
+def mouse_wheel(event):
+	if event.num == 4 or event.delta > 0:
+		scroll_to(offset - 3)
+	else:
+		scroll_to(offset + 3)
+
+def sort_by(column):
+	"""Sorts the table by a column of the ranking ('HC', 'T', 'THC' or None for the folder order),
+	without computing the ranking again. Clicking twice on the same column reverses the order."""
+
+	global sort_column, descending
+	if column == sort_column and column is not None:
+		descending = not descending
+	else:
+		sort_column, descending = column, True
+	scroll_to(0)
+
 # this is the function called when a song is double-clicked
 def main_song_selected(event):
 	"""When a song is double-clicked:
-	1) From the index of the selected song row, the name of the song within the music folder is searched.
+	1) The path of the selected song is taken from its position in the table.
 	2) The name of the song is displayed in the interface.
-	3) The path to the music folder, annotations folder and audio track is defined.
-	4) If there is no annotation folder, an error message is displayed.
-	5) The annotation directory is walked through and, for each track, the harmonic compatibility with 
-	respect to the main track is calculated and the values are displayed in the graphical interface.
+	3) If the song is not analyzed, an error message is displayed.
+	4) The ranking of the tracks with respect to the main track is taken from the cache, or
+	computed in the background from the in-memory library (see poll).
 	"""
 	
-	print(e.index(e.focus()))
-	global folderpath
-	row = 0
-	for (dirpath, dirnames, filenames) in walk(folderpath):
-		for file in filenames:
-			if row == e.index(e.focus()):
-				current_song = file.replace(".mp3", "")
-			row = row + 1
-		break
+	global target, current
+	if not e.focus() or library is None:
+		return
+	position = offset + e.index(e.focus())
+	order = display_order()
+	if position >= len(order):
+		return
+	current_song_path = songs[order[position]]
+	current_song = ntpath.basename(current_song_path).replace(".mp3", "")
 	text3.configure(text=current_song[0:36])
 	text4.configure(text=current_song[36:])
 
-	current_song_path = folderpath + '/' + current_song + ".mp3"
-
-	folder_path, song_name = ntpath.split(current_song_path)
-	annotation_path = folder_path + '/annotations/' + song_name.replace(".mp3", ".json")
-	if os.path.isfile(annotation_path):
-		e.delete(*e.get_children())
-		row = 0
-		# Compute harmonic compatibility
-		for (dirpath, dirnames, filenames) in walk(folderpath):
-			for file in filenames:
-				candidate_song_path = dirpath + '/' + file
-				harmonic_compatibility, pitch_shift, min_small_scale_comp = compare_songs(current_song_path,
-																						  candidate_song_path)
-				e.insert('', 'end', values=(file.replace(".mp3", ""),
-											str(round(harmonic_compatibility, 1)),
-											'  ' + str(pitch_shift),
-											str(round(min_small_scale_comp, 1))))
-				row = row + 1
-			break
+	if loading is not None or library.is_analyzed(current_song_path):
+		cancel_ranking()
+		target = current_song_path
+		cached = library.cached(current_song_path)
+		if cached is not None:
+			current = cached
+			render()
+		elif loading is None:
+			# Compute harmonic compatibility (started by poll once the library is loaded)
+			start_ranking()
 	else:
 		text3.configure(text="You need to analyze first")
 		text4.configure(text="")
@@ -89,62 +152,141 @@ def main_song_selected(event):
 
 # this is the function called when the "Analyze" button is clicked
 def analyze_button():
-	"""Analyzes the audio tracks contained in the previously defined music folder."""
+	"""Analyzes in the background the audio tracks contained in the previously defined music folder."""
 	
+	global analysis
+	if not folderpath or (analysis is not None and analysis.is_running()):
+		return
 	text3.configure(text="Analyzing...")
 	text4.configure(text="")
-	global folderpath
-	i = 0
-	for (dirpath, dirnames, filenames) in walk(folderpath):
-		for file in filenames:
-			song_path = dirpath + '/' + file
-			analyze_song(song_path)
-			i = i + 1
-			text3.configure(text=str(round(i * 100 / len(filenames), 1)) + '% progress completed')
-			print(round(i * 100 / len(filenames), 1), '% progress completed')
-		break
-	text3.configure(text="Analysis completed")
-	print("Analysis completed")
-
-
-
-root = Tk()
-
-# This is the section of code which creates the main window
-root.geometry('580x700')
-root.configure(background='#FFEBCD')
-root.title('Harmonic Compatibility (HC)')
-
-
-# This is the section of code which creates a button
-music_b = Button(root, text='Music Folder', bg='#FFEBCD', font=('verdana', 12, 'normal'), command=music_button).place(x=23, y=10)
-
-
-# This is the section of code which creates a button
-analyze_b = tk.Button(root, text='Analyze', bg='#FFEBCD', font=('verdana', 12, 'normal'), command=analyze_button).place(x=453, y=10)
-
-#This is the section of code which creates a TreeView
-e = ttk.Treeview(root, column=("c1", "c2", "c3", "c4"), show='headings', selectmode="browse", height = 30)
-e.bind('<Double-1>', main_song_selected)
-e.heading("c1", text="Song Name")
-e.heading("c2", text="HC(%)")
-e.heading("c3", text="T(st)")
-e.heading("c4", text="THC(%)")
-e.column('c1', stretch=tk.YES, minwidth=50, width=450)
-e.column('c2', stretch=tk.YES, minwidth=40, width=45)
-e.column('c3', stretch=tk.YES, minwidth=40, width=40)
-e.column('c4', stretch=tk.YES, minwidth=40, width=45)
-e.place(x=0, y=80)
-
-# This is the section of code which creates the a label
-text1 = Label(fg="black", font=("verdana", 9), bg='#FFEBCD')
-text1.place(x=23,y=45)
-text2 = Label(fg="black", font=("verdana", 9), bg='#FFEBCD')
-text2.place(x=23,y=60)
-
-text3 = Label(text= "holu :)", fg="black", font=("Helvetica", 10), bg='#FFEBCD')
-text3.place(x=185,y=15)
-text4 = Label(fg="black", font=("Helvetica", 10), bg='#FFEBCD')
-text4.place(x=185,y=30)
-
-root.mainloop()
+	analysis = analysis_job(folderpath, library)
+
+# this is the function called when the "Cancel" button is clicked
+def cancel_button():
+	"""Stops the analysis and the ranking running in the background."""
+
+	cancel_ranking()
+	if analysis is not None and analysis.is_running():
+		analysis.cancel()
+		text3.configure(text="Cancelling...")
+		text4.configure(text="")
+
+def start_ranking():
+	global ranking
+	ranking = library_ranking_job(library, target)
+
+def cancel_ranking():
+	global ranking
+	if ranking is not None:
+		ranking.cancel()
+		ranking = None
+
+def poll():
+	"""Displays the messages sent by the background jobs. Called every POLL_INTERVAL milliseconds."""
+
+	global analysis, ranking, loading, current
+	if analysis is not None:
+		analyzed = False
+		for kind, payload in analysis.poll():
+			if kind == 'progress':
+				done, total, song_path, error = payload
+				analyzed = analyzed or error is None
+				text3.configure(text=str(round(done * 100 / total, 1)) + '% progress completed')
+				print(round(done * 100 / total, 1), '% progress completed')
+			elif kind == 'done':
+				text3.configure(text="Analysis completed")
+				print("Analysis completed")
+			elif kind == 'cancelled':
+				text3.configure(text="Analysis cancelled")
+				print("Analysis cancelled")
+			elif kind == 'error':
+				text3.configure(text="Analysis failed")
+				print("Analysis failed:", payload)
+		if analyzed and target is not None and loading is None and library.is_analyzed(target):
+			# The tracks analyzed since the last poll are in the library: the cached ranking
+			# of the target track was updated with them
+			cancel_ranking()
+			start_ranking()
+		if not analysis.is_running() and analysis.messages.empty():
+			analysis = None
+
+	if loading is not None:
+		for kind, payload in loading.poll():
+			if kind == 'error':
+				print("Loading failed:", payload)
+		if not loading.is_running() and loading.messages.empty():
+			loading = None
+			if target is not None:
+				start_ranking()
+
+	if ranking is not None:
+		for kind, payload in ranking.poll():
+			if kind == 'done' and payload.current_song_path == target:
+				current = payload
+				render()
+			elif kind == 'error':
+				text3.configure(text="You need to analyze first")
+				text4.configure(text="")
+				print("Ranking failed:", payload)
+		if not ranking.is_running() and ranking.messages.empty():
+			ranking = None
+
+	root.after(POLL_INTERVAL, poll)
+
+
+
+# The interface is only built when run as a script, as the analysis
+# worker processes import this module again
+if __name__ == '__main__':
+	root = Tk()
+
+	# This is the section of code which creates the main window
+	root.geometry('580x700')
+	root.configure(background='#FFEBCD')
+	root.title('Harmonic Compatibility (HC)')
+
+
+	# This is the section of code which creates a button
+	music_b = Button(root, text='Music Folder', bg='#FFEBCD', font=('verdana', 12, 'normal'), command=music_button).place(x=23, y=10)
+
+
+	# This is the section of code which creates a button
+	analyze_b = tk.Button(root, text='Analyze', bg='#FFEBCD', font=('verdana', 12, 'normal'), command=analyze_button).place(x=453, y=10)
+
+	# This is the section of code which creates a button
+	cancel_b = tk.Button(root, text='Cancel', bg='#FFEBCD', font=('verdana', 12, 'normal'), command=cancel_button).place(x=453, y=42)
+
+	#This is the section of code which creates a TreeView
+	table = Frame(root)
+	e = ttk.Treeview(table, column=("c1", "c2", "c3", "c4"), show='headings', selectmode="browse", height = VISIBLE_ROWS)
+	e.bind('<Double-1>', main_song_selected)
+	e.bind('<MouseWheel>', mouse_wheel)
+	e.bind('<Button-4>', mouse_wheel)
+	e.bind('<Button-5>', mouse_wheel)
+	e.heading("c1", text="Song Name", command=lambda: sort_by(None))
+	e.heading("c2", text="HC(%)", command=lambda: sort_by('HC'))
+	e.heading("c3", text="T(st)", command=lambda: sort_by('T'))
+	e.heading("c4", text="THC(%)", command=lambda: sort_by('THC'))
+	e.column('c1', stretch=tk.YES, minwidth=50, width=433)
+	e.column('c2', stretch=tk.YES, minwidth=40, width=45)
+	e.column('c3', stretch=tk.YES, minwidth=40, width=40)
+	e.column('c4', stretch=tk.YES, minwidth=40, width=45)
+	row_items = [e.insert('', 'end', values=('', '', '', '')) for _ in range(VISIBLE_ROWS)]
+	scrollbar = ttk.Scrollbar(table, orient=VERTICAL, command=scroll_view)
+	e.pack(side=LEFT)
+	scrollbar.pack(side=RIGHT, fill=Y)
+	table.place(x=0, y=80)
+
+	# This is the section of code which creates the a label
+	text1 = Label(fg="black", font=("verdana", 9), bg='#FFEBCD')
+	text1.place(x=23,y=45)
+	text2 = Label(fg="black", font=("verdana", 9), bg='#FFEBCD')
+	text2.place(x=23,y=60)
+
+	text3 = Label(text= "holu :)", fg="black", font=("Helvetica", 10), bg='#FFEBCD')
+	text3.place(x=185,y=15)
+	text4 = Label(fg="black", font=("Helvetica", 10), bg='#FFEBCD')
+	text4.place(x=185,y=30)
+
+	root.after(POLL_INTERVAL, poll)
+	root.mainloop()